@@ -0,0 +1,468 @@
+"""
+Online filtering for fitted recurrent SLDS models.
+
+The exact filtering distribution of an SLDS is a mixture whose number of
+components grows with time, so the filter below keeps one Gaussian over the
+continuous state per discrete state and merges the mixture back down to K
+components after every step, as in the interacting multiple model (IMM)
+filter.  The recurrent transition probabilities out of each component are
+evaluated at that component's mean with trans_distn.get_trans_matrices.
+
+Each step takes O(K^2 + K * D^3) time and the filter keeps no history, so
+the cost per observation does not grow with the length of the stream.
+
+The Rao-Blackwellized particle filter instead keeps a set of discrete state
+particles, each with a Kalman belief over the continuous state.  Its cost
+per step is linear in the number of particles and, likewise, constant in time.
+"""
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+
+from rslds.messages import _logsumexp
+
+
+def _regression_params(distn, D_in):
+    """
+    Split the weights of a pybasicbayes regression into the part acting on
+    the continuous states, the part acting on the inputs, and the offset.
+    """
+    A = distn.A
+    if getattr(distn, "affine", False):
+        A, b = A[:, :-1], A[:, -1]
+    else:
+        b = np.zeros(A.shape[0])
+    return A[:, :D_in], A[:, D_in:], b
+
+
+class _FilterBase(object):
+    """
+    Reads the parameters of a fitted recurrent SLDS with Gaussian emissions.
+    The parameters are read once, when the filter is created.
+    """
+    def __init__(self, model):
+        """
+        :param model: a fitted recurrent SLDS
+        """
+        self.trans_distn = model.trans_distn
+        self.K = len(model.dynamics_distns)
+        self.D_latent = D = model.dynamics_distns[0].D_out
+
+        # x_{t+1} = A_k x_t + B_k u_t + b_k + noise, where z_t = k
+        self.As, self.Bs, self.bs = map(np.array, zip(
+            *[_regression_params(d, D) for d in model.dynamics_distns]))
+        self.Qs = np.array([d.sigma for d in model.dynamics_distns])
+
+        # y_t = C_k x_t + D_k u_t + d_k + noise
+        self.Cs, self.Ds, self.ds = map(np.array, zip(
+            *[_regression_params(e, D) for e in model.emission_distns]))
+        self.Rs = np.array([e.sigma for e in model.emission_distns])
+        self.D_input = self.Bs.shape[2]
+
+        self.log_pi_0 = np.log(model.init_state_distn.pi_0)
+        self.mu_init = np.array([d.mu for d in model.init_dynamics_distns])
+        self.sigma_init = np.array([d.sigma for d in model.init_dynamics_distns])
+
+    @staticmethod
+    def _mixture_moments(p, means, covs):
+        mean = p.dot(means)
+        dmu = means - mean
+        return mean, np.einsum('k,kij->ij', p, covs) + (p[:, None] * dmu).T.dot(dmu)
+
+    def step(self, y, u=None):
+        raise NotImplementedError
+
+    def update(self, data, inputs=None):
+        """
+        Incorporate a batch of consecutive observations.
+
+        :param data:   observations (N x D_obs)
+        :param inputs: inputs (N x D_input)
+        :return:       filtering probabilities (N x K) and means (N x D)
+        """
+        data = np.atleast_2d(data)
+        N = data.shape[0]
+        inputs = np.zeros((N, self.D_input)) if inputs is None else np.atleast_2d(inputs)
+
+        probs, means = np.empty((N, self.K)), np.empty((N, self.D_latent))
+        for n in range(N):
+            probs[n], means[n] = self.step(data[n], inputs[n])
+        return probs, means
+
+
+class RecurrentSLDSFilter(_FilterBase):
+    """
+    Streaming filter for a fitted PGRecurrentSLDS or SoftmaxRecurrentSLDS
+    with Gaussian emissions.  Feed it observations with step (one at a time)
+    or update (a small batch).
+    """
+    def __init__(self, model):
+        super(RecurrentSLDSFilter, self).__init__(model)
+        self.reset()
+
+    def reset(self):
+        """ Forget all observations seen so far. """
+        self.t = 0
+        self.log_weights = None
+        self.means = None
+        self.covs = None
+        self.log_likelihood = 0.
+        self._prev_input = None
+
+    @property
+    def state_probs(self):
+        """ Filtering distribution of the current discrete state (K) """
+        return np.exp(self.log_weights)
+
+    @property
+    def mean(self):
+        """ Filtering mean of the current continuous state (D) """
+        return self.state_probs.dot(self.means)
+
+    @property
+    def covariance(self):
+        """ Filtering covariance of the current continuous state (D x D) """
+        return self._mixture_moments(self.state_probs, self.means, self.covs)[1]
+
+    def _predict(self):
+        K = self.K
+        if self.t == 0:
+            return self.log_pi_0.copy(), self.mu_init.copy(), self.sigma_init.copy()
+
+        # Transition probabilities out of each component, at its mean
+        Ps = self.trans_distn.get_trans_matrices(self.means)
+        log_trans = np.log(Ps[np.arange(K), np.arange(K)])
+
+        # Propagate each component through the dynamics of its discrete state
+        u = self._prev_input
+        means = np.einsum('kij,kj->ki', self.As, self.means) + self.Bs.dot(u) + self.bs
+        covs = np.matmul(np.matmul(self.As, self.covs), np.swapaxes(self.As, 1, 2)) + self.Qs
+
+        # Mix the components that lead into each next discrete state
+        log_joint = self.log_weights[:, None] + log_trans
+        log_pred = _logsumexp(log_joint, axis=0)
+        mix = np.exp(log_joint - log_pred)
+        mus = mix.T.dot(means)
+        dmu = means[:, None, :] - mus[None, :, :]
+        sigmas = np.einsum('jk,jab->kab', mix, covs) \
+            + np.einsum('jk,jka,jkb->kab', mix, dmu, dmu)
+        return log_pred, mus, sigmas
+
+    def step(self, y, u=None):
+        """
+        Incorporate one observation.
+
+        :param y: observation at the current time step (D_obs).  Entries
+                  that are NaN are treated as missing.
+        :param u: inputs at the current time step (D_input)
+        :return:  filtering probabilities of the discrete state (K) and
+                  filtering mean of the continuous state (D)
+        """
+        y = np.asarray(y, dtype=float)
+        u = np.zeros(self.D_input) if u is None else np.asarray(u, dtype=float)
+        log_weights, mus, sigmas = self._predict()
+
+        obs = ~np.isnan(y)
+        if np.any(obs):
+            for k in range(self.K):
+                C, R = self.Cs[k][obs], self.Rs[k][np.ix_(obs, obs)]
+                resid = y[obs] - C.dot(mus[k]) - self.Ds[k][obs].dot(u) - self.ds[k][obs]
+                CS = C.dot(sigmas[k])
+                factor = cho_factor(CS.dot(C.T) + R, lower=True)
+
+                # Kalman update and marginal likelihood of the observation
+                log_weights[k] += -0.5 * resid.dot(cho_solve(factor, resid)) \
+                    - np.sum(np.log(np.diag(factor[0]))) \
+                    - 0.5 * resid.size * np.log(2 * np.pi)
+                mus[k] = mus[k] + CS.T.dot(cho_solve(factor, resid))
+                sigmas[k] = sigmas[k] - CS.T.dot(cho_solve(factor, CS))
+
+        normalizer = _logsumexp(log_weights, axis=0)
+        self.log_likelihood += normalizer
+        self.log_weights = log_weights - normalizer
+        self.means, self.covs = mus, sigmas
+        self._prev_input = u
+        self.t += 1
+        return self.state_probs, self.mean
+
+
+def _systematic_resample(weights):
+    """ indices of N particles drawn by systematic resampling """
+    N = weights.size
+    positions = (np.random.rand() + np.arange(N)) / N
+    return np.minimum(np.searchsorted(np.cumsum(weights), positions), N - 1)
+
+
+class RaoBlackwellizedParticleFilter(_FilterBase):
+    """
+    Rao-Blackwellized particle filter for a fitted recurrent SLDS with
+    Gaussian emissions.  Each particle carries a discrete state and a
+    Kalman belief over the continuous state.  The next discrete state is
+    proposed from its exact conditional given the particle and the new
+    observation, and the recurrent transition is evaluated at the
+    particle's mean.  All particles are propagated at once, and the
+    particles are resampled systematically when the effective sample
+    size drops below resample_threshold * num_particles.
+    """
+    def __init__(self, model, num_particles=100, resample_threshold=0.5):
+        """
+        :param num_particles:      number of particles
+        :param resample_threshold: resample when the effective sample size
+                                   falls below this fraction of particles
+        """
+        super(RaoBlackwellizedParticleFilter, self).__init__(model)
+        self.num_particles = num_particles
+        self.resample_threshold = resample_threshold
+        self.reset()
+
+    def reset(self):
+        """ Forget all observations seen so far. """
+        N = self.num_particles
+        self.t = 0
+        self.log_weights = -np.log(N) * np.ones(N)
+        self.stateseq = None
+        self.means = None
+        self.covs = None
+        self.log_likelihood = 0.
+        self.num_resamples = 0
+        self._prev_input = None
+
+    @property
+    def weights(self):
+        return np.exp(self.log_weights)
+
+    @property
+    def effective_sample_size(self):
+        return 1. / np.sum(self.weights ** 2)
+
+    @property
+    def state_probs(self):
+        """ Filtering distribution of the current discrete state (K) """
+        return np.bincount(self.stateseq, weights=self.weights, minlength=self.K)
+
+    @property
+    def mean(self):
+        """ Filtering mean of the current continuous state (D) """
+        return self.weights.dot(self.means)
+
+    @property
+    def covariance(self):
+        """ Filtering covariance of the current continuous state (D x D) """
+        return self._mixture_moments(self.weights, self.means, self.covs)[1]
+
+    def _predict(self):
+        """
+        :return: log prior of each particle's next discrete state (N x K)
+                 and the predicted mean (N x K x D) and covariance
+                 (N x K x D x D) of its continuous state under each
+        """
+        N, K, D = self.num_particles, self.K, self.D_latent
+        if self.t == 0:
+            return np.tile(self.log_pi_0, (N, 1)), \
+                np.tile(self.mu_init, (N, 1, 1)), \
+                np.tile(self.sigma_init, (N, 1, 1, 1))
+
+        z = self.stateseq
+        Ps = self.trans_distn.get_trans_matrices(self.means)
+        log_prior = np.log(Ps[np.arange(N), z])
+
+        # The continuous states follow the dynamics of the current discrete
+        # states, so their prediction is the same for every next state
+        u, A = self._prev_input, self.As[z]
+        mus = np.einsum('nij,nj->ni', A, self.means) + self.Bs[z].dot(u) + self.bs[z]
+        sigmas = np.matmul(np.matmul(A, self.covs), np.swapaxes(A, 1, 2)) + self.Qs[z]
+        return log_prior, np.broadcast_to(mus[:, None, :], (N, K, D)), \
+            np.broadcast_to(sigmas[:, None, :, :], (N, K, D, D))
+
+    def step(self, y, u=None):
+        """
+        Incorporate one observation.
+
+        :param y: observation at the current time step (D_obs).  Entries
+                  that are NaN are treated as missing.
+        :param u: inputs at the current time step (D_input)
+        :return:  filtering probabilities of the discrete state (K) and
+                  filtering mean of the continuous state (D)
+        """
+        N, K = self.num_particles, self.K
+        y = np.asarray(y, dtype=float)
+        u = np.zeros(self.D_input) if u is None else np.asarray(u, dtype=float)
+        log_joint, mus, sigmas = self._predict()
+
+        # Predictive likelihood of y under each particle and discrete state
+        obs = ~np.isnan(y)
+        if np.any(obs):
+            C, R = self.Cs[:, obs], self.Rs[:, obs][:, :, obs]
+            resid = y[obs] - np.einsum('kpd,nkd->nkp', C, mus) \
+                - (self.Ds[:, obs].dot(u) + self.ds[:, obs])
+            CS = np.matmul(C[None, :, :, :], sigmas)
+            S = np.matmul(CS, np.swapaxes(C, 1, 2)[None, :, :, :]) + R
+            Sinv_resid_CS = np.linalg.solve(S, np.concatenate((resid[..., None], CS), axis=-1))
+            log_joint += -0.5 * np.sum(resid * Sinv_resid_CS[..., 0], axis=-1) \
+                - 0.5 * np.linalg.slogdet(S)[1] - 0.5 * resid.shape[-1] * np.log(2 * np.pi)
+
+        # Propose the discrete states from their conditional
+        log_marginal = _logsumexp(log_joint, axis=1)
+        cdf = np.cumsum(np.exp(log_joint - log_marginal[:, None]), axis=1)
+        z = np.minimum(np.sum(cdf < np.random.rand(N)[:, None], axis=1), K - 1)
+
+        # Kalman update of the chosen discrete states
+        n = np.arange(N)
+        mus, sigmas = mus[n, z], sigmas[n, z]
+        if np.any(obs):
+            CS, Sinv_resid_CS = CS[n, z], Sinv_resid_CS[n, z]
+            mus += np.einsum('npd,np->nd', CS, Sinv_resid_CS[:, :, 0])
+            sigmas -= np.matmul(np.swapaxes(CS, 1, 2), Sinv_resid_CS[:, :, 1:])
+
+        log_weights = self.log_weights + log_marginal
+        normalizer = _logsumexp(log_weights, axis=0)
+        self.log_likelihood += normalizer
+        self.log_weights = log_weights - normalizer
+        self.stateseq, self.means, self.covs = z, mus, sigmas
+        self._prev_input = u
+        self.t += 1
+
+        if self.effective_sample_size < self.resample_threshold * N:
+            self.resample()
+
+        return self.state_probs, self.mean
+
+    def resample(self):
+        """ Systematically resample the particles and reset their weights. """
+        N = self.num_particles
+        idx = _systematic_resample(self.weights)
+        self.stateseq, self.means, self.covs = \
+            self.stateseq[idx], self.means[idx], self.covs[idx]
+        self.log_weights = -np.log(N) * np.ones(N)
+        self.num_resamples += 1
+
+
+class _RingBuffer(object):
+    """
+    Holds the last `capacity` rows of a stream.  Every row is written twice,
+    `capacity` apart, so the stored rows are always a contiguous view.
+    """
+    def __init__(self, capacity, shape=(), dtype=float):
+        self.capacity = capacity
+        self.buffer = np.zeros((2 * capacity,) + tuple(shape), dtype=dtype)
+        self.head = 0
+        self.size = 0
+
+    def append(self, row):
+        self.buffer[self.head] = self.buffer[self.head + self.capacity] = row
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    @property
+    def rows(self):
+        stop = self.head + self.capacity if self.size == self.capacity else self.head
+        return self.buffer[stop - self.size:stop]
+
+    @rows.setter
+    def rows(self, value):
+        for i, row in enumerate(value):
+            self.buffer[(self.head - self.size + i) % self.capacity] = row
+            self.buffer[(self.head - self.size + i) % self.capacity + self.capacity] = row
+
+
+class FixedLagSmoother(object):
+    """
+    Fixed-lag smoother for a fitted PGRecurrentSLDS.  The last lag+1
+    observations, and the discrete and continuous states sampled for them,
+    are kept in ring buffers along with the state just before them.  Each
+    new observation triggers block Gibbs updates of that window given the
+    state before it (PGRecurrentSLDSStates.resample_window), and then the
+    step `lag` steps back is smoothed with the window's messages
+    (PGRecurrentSLDSStates.smooth_window).  The memory and the cost per
+    step depend on the lag but not on the length of the stream.
+    """
+    def __init__(self, model, lag, num_sweeps=1):
+        """
+        :param model:      a fitted PGRecurrentSLDS
+        :param lag:        delay, in time steps, of the smoothed estimates
+        :param num_sweeps: Gibbs sweeps over the window per time step
+        """
+        self.model = model
+        self.lag = lag
+        self.num_sweeps = num_sweeps
+        self.K = len(model.dynamics_distns)
+        self.D_latent = model.dynamics_distns[0].D_out
+        self.D_input = model.dynamics_distns[0].D_in - self.D_latent
+        self.reset()
+
+    def reset(self):
+        """ Forget all observations seen so far. """
+        self.t = 0
+        self._data = None
+        self._inputs = _RingBuffer(self.lag + 2, (self.D_input,))
+        self._stateseq = _RingBuffer(self.lag + 2, dtype=np.int32)
+        self._gaussian_states = _RingBuffer(self.lag + 2, (self.D_latent,))
+
+    def _initialize_step(self):
+        """ Draw the discrete and continuous states of a new time step """
+        model = self.model
+        if self.t == 0:
+            z = np.random.choice(self.K, p=model.init_state_distn.pi_0)
+            return z, model.init_dynamics_distns[z].mu
+
+        z_prev = self._stateseq.rows[-1]
+        x_prev = self._gaussian_states.rows[-1]
+        P = model.trans_distn.get_trans_matrices(x_prev[None, :])[0]
+        z = np.random.choice(self.K, p=P[z_prev])
+        A, B, b = _regression_params(model.dynamics_distns[z_prev], self.D_latent)
+        x = A.dot(x_prev) + B.dot(self._inputs.rows[-1]) + b
+        return z, x
+
+    def _window_states(self):
+        kwargs = dict(inputs=self._inputs.rows.copy()) if self.D_input > 0 else {}
+        return self.model._states_class(
+            model=self.model, data=self._data.rows.copy(),
+            stateseq=self._stateseq.rows.copy(),
+            gaussian_states=self._gaussian_states.rows.copy(), **kwargs)
+
+    def step(self, y, u=None):
+        """
+        Incorporate one observation.
+
+        :param y: observation at the current time step (D_obs)
+        :param u: inputs at the current time step (D_input)
+        :return:  None for the first lag steps.  Afterward, the time step
+                  `lag` steps back, the marginal probabilities of its
+                  discrete state (K) and the mean of its continuous state (D).
+        """
+        y = np.asarray(y)
+        if self._data is None:
+            self._data = _RingBuffer(self.lag + 2, y.shape, y.dtype)
+
+        z, x = self._initialize_step()
+        self._data.append(y)
+        self._inputs.append(np.zeros(self.D_input) if u is None else u)
+        self._stateseq.append(z)
+        self._gaussian_states.append(x)
+        self.t += 1
+
+        # The first state in a full buffer precedes the window and stays fixed
+        s = self._window_states()
+        start = 1 if self.t > self.lag + 1 else 0
+        for _ in range(self.num_sweeps):
+            s.resample_window(start, s.T)
+        self._stateseq.rows = s.stateseq
+        self._gaussian_states.rows = s.gaussian_states
+
+        if self.t <= self.lag:
+            return None
+        expected_states, mus = s.smooth_window(start, s.T)
+        i = s.T - self.lag - 1 - start
+        return self.t - self.lag - 1, expected_states[i], mus[i]
+
+    def flush(self):
+        """
+        Smooth the last lag time steps, which have not been returned yet.
+
+        :return: their marginal discrete state probabilities (lag x K) and
+                 continuous state means (lag x D)
+        """
+        s = self._window_states()
+        start = 1 if self.t > self.lag + 1 else 0
+        expected_states, mus = s.smooth_window(start, s.T)
+        n = expected_states.shape[0] - min(self.lag, self.t)
+        return expected_states[n:], mus[n:]
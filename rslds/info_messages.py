@@ -0,0 +1,340 @@
+"""
+Parallel in time message passing for the information-form chain over the
+continuous states of an SLDS.
+
+The chain is given by the same potentials that pylds' info_E_step and
+info_sample take: an initial potential (J_init, h_init, log_Z_init), pair
+potentials (J_pair_11, J_pair_21, J_pair_22, h_pair_1, h_pair_2, log_Z_pair)
+coupling x_t and x_{t+1} through
+
+    -1/2 x_t^T J11 x_t - x_{t+1}^T J21 x_t - 1/2 x_{t+1}^T J22 x_{t+1}
+    + h1^T x_t + h2^T x_{t+1} + log_Z,
+
+and node potentials (J_node, h_node, log_Z_node).
+
+The sequence is split into chunks at separators 0 = s_0 < ... < s_C = T-1.
+First, each chunk marginalizes out its interior states to leave a pair
+potential on its two separators.  These are independent, so they are
+computed in parallel.  Then a short sequential pass over the separators
+gives the messages at the separators, and finally each chunk smooths (or
+samples) its own states given those messages, again in parallel.  The
+results equal those of the sequential filter up to numerical error.
+
+The chunk functions are module level so that they can be sent to a
+multiprocessing pool as well as a thread pool.  They are written in numpy,
+so each time step carries some interpreter overhead; this pays off for
+long sequences with a pool of workers, or with a large latent dimension.
+"""
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
+
+from rslds.messages import _chunk_boundaries
+
+
+### Information form utilities
+def _info_lognorm(J, h):
+    """ log of the integral of exp(-1/2 x^T J x + h^T x) """
+    L = np.linalg.cholesky(J)
+    v = solve_triangular(L, h, lower=True)
+    return 0.5 * v.dot(v) - np.sum(np.log(np.diag(L))) \
+        + 0.5 * h.size * np.log(2 * np.pi)
+
+
+def _info_marginalize(J, h, J_other, J_cross, h_other):
+    """
+    Marginalize x out of a potential on (x, y) with precision
+    [[J, J_cross^T], [J_cross, J_other]] and linear term [h, h_other].
+
+    :return: J and h of the potential on y, and the log normalizer
+    """
+    factor = cho_factor(J, lower=True)
+    J_out = J_other - J_cross.dot(cho_solve(factor, J_cross.T))
+    h_out = h_other - J_cross.dot(cho_solve(factor, h))
+    return J_out, h_out, _info_lognorm(J, h)
+
+
+def _info_sample_gaussian(J, h, rng):
+    L = np.linalg.cholesky(J)
+    mu = cho_solve((L, True), h)
+    return mu + solve_triangular(L.T, rng.randn(h.size), lower=False)
+
+
+def _info_filter(J_init, h_init, pairs, nodes):
+    """
+    Filter along a segment of the chain.
+
+    :return: predicted and filtered (J, h) stacks and the log normalizer
+             of the segment
+    """
+    J_11, J_21, J_22, h_1, h_2, log_Z_pair = pairs
+    J_node, h_node, log_Z_node = nodes
+    T, n = h_node.shape
+
+    J_predict, h_predict = np.empty((T, n, n)), np.empty((T, n))
+    J_filter, h_filter = np.empty((T, n, n)), np.empty((T, n))
+    J_predict[0], h_predict[0] = J_init, h_init
+    lognorm = 0
+    for t in range(T):
+        J_filter[t] = J_predict[t] + J_node[t]
+        h_filter[t] = h_predict[t] + h_node[t]
+        lognorm += log_Z_node[t]
+        if t == T - 1:
+            break
+
+        J_predict[t+1], h_predict[t+1], lognorm_t = _info_marginalize(
+            J_filter[t] + J_11[t], h_filter[t] + h_1[t], J_22[t], J_21[t], h_2[t])
+        lognorm += lognorm_t + log_Z_pair[t]
+
+    lognorm += _info_lognorm(J_filter[-1], h_filter[-1])
+    return J_predict, h_predict, J_filter, h_filter, lognorm
+
+
+def _info_params(J_init, h_init, log_Z_init,
+                 J_pair_11, J_pair_21, J_pair_22, h_pair_1, h_pair_2, log_Z_pair,
+                 J_node, h_node, log_Z_node):
+    """ broadcast the potentials to full (T-1) pair and (T) node stacks """
+    T, n = h_node.shape
+    _stack = lambda X, N, ndim: np.broadcast_to(X, (N,) + np.shape(X)[-ndim:]) \
+        if np.ndim(X) == ndim else np.asarray(X)[:N]
+    pairs = (_stack(J_pair_11, T-1, 2), _stack(J_pair_21, T-1, 2), _stack(J_pair_22, T-1, 2),
+             _stack(h_pair_1, T-1, 1), _stack(h_pair_2, T-1, 1),
+             np.broadcast_to(log_Z_pair, (T-1,)) if np.ndim(log_Z_pair) == 0
+             else np.asarray(log_Z_pair)[:T-1])
+    nodes = (_stack(J_node, T, 2), h_node,
+             np.broadcast_to(log_Z_node, (T,)) if np.ndim(log_Z_node) == 0
+             else np.asarray(log_Z_node))
+    return (J_init, h_init, log_Z_init), pairs, nodes
+
+
+def _slice(params, start, stop):
+    return tuple(p[start:stop] for p in params)
+
+
+### Chunk functions
+def _chunk_reduce(args):
+    """
+    Marginalize out the interior states of a chunk, leaving a pair
+    potential on its separators (x_start, x_stop).  The joint potential
+    on (x_start, x_t) is carried forward as t advances.
+    """
+    pairs, nodes = args
+    J_11, J_21, J_22, h_1, h_2, log_Z_pair = pairs
+    J_node, h_node, log_Z_node = nodes
+    n = h_1.shape[1]
+
+    J = np.zeros((2 * n, 2 * n))
+    J[:n, :n], J[n:, :n], J[:n, n:], J[n:, n:] = J_11[0], J_21[0], J_21[0].T, J_22[0]
+    h = np.concatenate((h_1[0], h_2[0]))
+    lognorm = log_Z_pair[0]
+
+    # Interior state t has node potential nodes[t-1]
+    for t in range(1, h_1.shape[0]):
+        J[n:, n:] += J_node[t-1]
+        h[n:] += h_node[t-1]
+        lognorm += log_Z_node[t-1]
+
+        # Marginalize x_t out of the potential on (x_start, x_t, x_{t+1})
+        J_other = np.zeros((2 * n, 2 * n))
+        J_other[:n, :n], J_other[n:, n:] = J[:n, :n], J_22[t]
+        J_cross = np.vstack((J[:n, n:], J_21[t]))
+        J, h, lognorm_t = _info_marginalize(
+            J[n:, n:] + J_11[t], h[n:] + h_1[t], J_other, J_cross,
+            np.concatenate((h[:n], h_2[t])))
+        lognorm += lognorm_t + log_Z_pair[t]
+
+    return J[:n, :n], J[n:, :n], J[n:, n:], h[:n], h[n:], lognorm
+
+
+def _chunk_smooth(args):
+    """ smooth a chunk given the messages into its first and last states """
+    J_init, h_init, pairs, nodes = args
+    J_11, J_21, J_22, h_1, h_2, _ = pairs
+    J_predict, h_predict, J_smooth, h_smooth, _ = _info_filter(J_init, h_init, pairs, nodes)
+    T, n = h_smooth.shape
+
+    mus, sigmas = np.empty((T, n)), np.empty((T, n, n))
+    E_xtp1_xtT = np.empty((T-1, n, n))
+    sigmas[-1] = np.linalg.inv(J_smooth[-1])
+    mus[-1] = sigmas[-1].dot(h_smooth[-1])
+    for t in range(T-2, -1, -1):
+        # Precision of x_{t+1} given x_t
+        factor = cho_factor(J_smooth[t+1] - J_predict[t+1] + J_22[t], lower=True)
+        J_smooth[t] += J_11[t] - J_21[t].T.dot(cho_solve(factor, J_21[t]))
+        h_smooth[t] += h_1[t] - J_21[t].T.dot(
+            cho_solve(factor, h_smooth[t+1] - h_predict[t+1] + h_2[t]))
+
+        sigmas[t] = np.linalg.inv(J_smooth[t])
+        mus[t] = sigmas[t].dot(h_smooth[t])
+        E_xtp1_xtT[t] = -cho_solve(factor, J_21[t].dot(sigmas[t])) \
+            + np.outer(mus[t+1], mus[t])
+
+    return mus, sigmas, E_xtp1_xtT
+
+
+def _chunk_sample(args):
+    """ sample the interior states of a chunk given both separators """
+    pairs, nodes, x_start, x_stop, seed = args
+    J_11, J_21, J_22, h_1, h_2, log_Z_pair = pairs
+    J_node, h_node, log_Z_node = nodes
+    T, n = h_node.shape
+    if T == 0:
+        return np.zeros((0, n))
+
+    # Condition the first and last interior states on the separators
+    J_node, h_node = J_node.copy(), h_node.copy()
+    J_node[0] += J_22[0]
+    h_node[0] += h_2[0] - J_21[0].dot(x_start)
+    J_node[-1] += J_11[-1]
+    h_node[-1] += h_1[-1] - J_21[-1].T.dot(x_stop)
+
+    interior = _slice(pairs, 1, T)
+    _, _, J_filter, h_filter, _ = _info_filter(
+        np.zeros((n, n)), np.zeros(n), interior, (J_node, h_node, log_Z_node))
+
+    rng = np.random.RandomState(seed)
+    x = np.empty((T, n))
+    x[-1] = _info_sample_gaussian(J_filter[-1], h_filter[-1], rng)
+    for t in range(T-2, -1, -1):
+        x[t] = _info_sample_gaussian(
+            J_filter[t] + interior[0][t],
+            h_filter[t] + interior[3][t] - interior[1][t].T.dot(x[t+1]), rng)
+    return x
+
+
+### Messages over the separators
+def _separator_messages(init, pairs, nodes, bounds, pool):
+    _map = map if pool is None else pool.map
+    reduced = list(_map(_chunk_reduce, [
+        (_slice(pairs, start, stop), _slice(nodes, start+1, stop))
+        for start, stop in zip(bounds[:-1], bounds[1:])]))
+
+    # Forward filter over the separators
+    J_init, h_init, log_Z_init = init
+    J_node, h_node, log_Z_node = nodes
+    C = len(reduced)
+    J_predict, h_predict = [J_init], [h_init]
+    J_filter, h_filter = [], []
+    lognorm = log_Z_init
+    for c, s in enumerate(bounds):
+        J_filter.append(J_predict[c] + J_node[s])
+        h_filter.append(h_predict[c] + h_node[s])
+        lognorm += log_Z_node[s]
+        if c == C:
+            break
+
+        J_11, J_21, J_22, h_1, h_2, log_Z = reduced[c]
+        J_p, h_p, lognorm_c = _info_marginalize(
+            J_filter[c] + J_11, h_filter[c] + h_1, J_22, J_21, h_2)
+        J_predict.append(J_p)
+        h_predict.append(h_p)
+        lognorm += lognorm_c + log_Z
+    lognorm += _info_lognorm(J_filter[-1], h_filter[-1])
+
+    return reduced, J_predict, h_predict, J_filter, h_filter, lognorm
+
+
+def parallel_info_E_step(J_init, h_init, log_Z_init,
+                         J_pair_11, J_pair_21, J_pair_22, h_pair_1, h_pair_2, log_Z_pair,
+                         J_node, h_node, log_Z_node,
+                         num_chunks=1, pool=None):
+    """
+    Smooth the information-form chain, like pylds' info_E_step, by splitting
+    the sequence into chunks that are processed in parallel.
+
+    :param num_chunks: number of chunks of time steps
+    :param pool:       a thread or process pool with a map method, e.g. a
+                       multiprocessing.Pool.  If None, the chunks are
+                       processed one after the other.
+    :return:           lognorm, smoothed_mus, smoothed_sigmas, E_xtp1_xtT
+    """
+    init, pairs, nodes = _info_params(
+        J_init, h_init, log_Z_init,
+        J_pair_11, J_pair_21, J_pair_22, h_pair_1, h_pair_2, log_Z_pair,
+        J_node, h_node, log_Z_node)
+    T, n = h_node.shape
+    if T == 1:
+        J, h = J_init + nodes[0][0], h_init + h_node[0]
+        sigma = np.linalg.inv(J)
+        lognorm = log_Z_init + nodes[2][0] + _info_lognorm(J, h)
+        return lognorm, sigma.dot(h)[None, :], sigma[None, :, :], np.zeros((0, n, n))
+
+    bounds = _chunk_boundaries(T, num_chunks)
+    reduced, J_predict, h_predict, _, _, lognorm = \
+        _separator_messages(init, pairs, nodes, bounds, pool)
+
+    # Backward messages into each separator from the states after it
+    C = len(reduced)
+    J_backward, h_backward = [None] * (C + 1), [None] * (C + 1)
+    J_backward[C], h_backward[C] = np.zeros((n, n)), np.zeros(n)
+    for c in range(C - 1, 0, -1):
+        J_11, J_21, J_22, h_1, h_2, _ = reduced[c]
+        s = bounds[c+1]
+        J_backward[c], h_backward[c], _ = _info_marginalize(
+            J_22 + nodes[0][s] + J_backward[c+1], h_2 + h_node[s] + h_backward[c+1],
+            J_11, J_21.T, h_1)
+
+    # Smooth each chunk, including both of its separators
+    def _chunk_args(c, start, stop):
+        J_n, h_n, log_Z_n = _slice(nodes, start, stop+1)
+        J_n, h_n = J_n.copy(), h_n.copy()
+        J_n[-1] += J_backward[c+1]
+        h_n[-1] += h_backward[c+1]
+        return J_predict[c], h_predict[c], _slice(pairs, start, stop), (J_n, h_n, log_Z_n)
+
+    _map = map if pool is None else pool.map
+    chunks = list(_map(_chunk_smooth, [
+        _chunk_args(c, start, stop)
+        for c, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))]))
+
+    smoothed_mus, smoothed_sigmas = np.empty((T, n)), np.empty((T, n, n))
+    E_xtp1_xtT = np.empty((T-1, n, n))
+    for start, stop, (mus, sigmas, E_pairs) in zip(bounds[:-1], bounds[1:], chunks):
+        smoothed_mus[start:stop+1] = mus
+        smoothed_sigmas[start:stop+1] = sigmas
+        E_xtp1_xtT[start:stop] = E_pairs
+
+    return lognorm, smoothed_mus, smoothed_sigmas, E_xtp1_xtT
+
+
+def parallel_info_sample(J_init, h_init, log_Z_init,
+                         J_pair_11, J_pair_21, J_pair_22, h_pair_1, h_pair_2, log_Z_pair,
+                         J_node, h_node, log_Z_node,
+                         num_chunks=1, pool=None):
+    """
+    Sample the information-form chain, like pylds' info_sample.  The states
+    at the separators are sampled first, and then each chunk samples its
+    interior given the separators on either side, in parallel.  Each chunk
+    gets its own seed drawn from numpy's global random state.  The other
+    arguments are as in parallel_info_E_step.
+
+    :return: lognorm, sampled states (T x n)
+    """
+    init, pairs, nodes = _info_params(
+        J_init, h_init, log_Z_init,
+        J_pair_11, J_pair_21, J_pair_22, h_pair_1, h_pair_2, log_Z_pair,
+        J_node, h_node, log_Z_node)
+    T, n = h_node.shape
+    bounds = _chunk_boundaries(T, num_chunks) if T > 1 else np.array([0])
+    reduced, _, _, J_filter, h_filter, lognorm = \
+        _separator_messages(init, pairs, nodes, bounds, pool)
+
+    # Sample the separators backward
+    x = np.empty((T, n))
+    C = len(reduced)
+    x[bounds[C]] = _info_sample_gaussian(J_filter[C], h_filter[C], np.random)
+    for c in range(C - 1, -1, -1):
+        J_11, J_21, J_22, h_1, h_2, _ = reduced[c]
+        x[bounds[c]] = _info_sample_gaussian(
+            J_filter[c] + J_11, h_filter[c] + h_1 - J_21.T.dot(x[bounds[c+1]]),
+            np.random)
+
+    seeds = np.random.randint(2 ** 31 - 1, size=C)
+    _map = map if pool is None else pool.map
+    chunks = list(_map(_chunk_sample, [
+        (_slice(pairs, start, stop), _slice(nodes, start+1, stop),
+         x[start], x[stop], seed)
+        for start, stop, seed in zip(bounds[:-1], bounds[1:], seeds)]))
+    for start, stop, chunk in zip(bounds[:-1], bounds[1:], chunks):
+        x[start+1:stop] = chunk
+
+    return lognorm, x
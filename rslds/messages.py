@@ -0,0 +1,884 @@
+"""
+Log-space message passing for HMMs with time-varying transition matrices.
+
+The transition potentials are given as log transition matrices, either a
+single (K x K) matrix shared by all time steps or a (T-1 x K x K) stack
+where log_trans_matrices[t] governs the transition from z_t to z_{t+1}.
+Working with log transition matrices directly avoids exponentiating the
+stack only to take its log again inside the message passing.
+
+The transition potentials may also be an implicit operator, like
+rslds.transitions.StickBreakingTransitionOperator, that exposes
+blocks(reverse=False), yielding (start, stop, log_block) triples.
+The messages then only hold one block of transition matrices in memory
+at a time.  Operators with row_invariant = True, whose transition
+matrices have identical rows, expose their (T-1 x K) log_rows and get
+dedicated O(T*K) message passing.  So do operators with
+shared_plus_diagonal = True, whose rows are a shared distribution with
+a per-row correction of the diagonal entry and of the entries after it
+(see rslds.transitions.SharedPlusDiagonalTransitionOperator).
+"""
+import numpy as np
+
+
+def _logsumexp(a, axis):
+    amax = a.max(axis=axis, keepdims=True)
+    amax[~np.isfinite(amax)] = 0
+    out = np.log(np.sum(np.exp(a - amax), axis=axis))
+    out += np.squeeze(amax, axis=axis)
+    return out
+
+
+def _log_trans_blocks(log_trans_matrices, T, reverse=False):
+    """
+    Iterate over (start, stop, log_block) triples, where log_block[t-start]
+    is the log transition matrix from z_t to z_{t+1} for start <= t < stop.
+    """
+    if hasattr(log_trans_matrices, "blocks"):
+        assert len(log_trans_matrices) == T - 1
+        for block in log_trans_matrices.blocks(reverse=reverse):
+            yield block
+    elif log_trans_matrices.ndim == 3:
+        assert log_trans_matrices.shape[0] == T - 1
+        yield 0, T - 1, log_trans_matrices
+    else:
+        K = log_trans_matrices.shape[0]
+        yield 0, T - 1, np.broadcast_to(log_trans_matrices, (T - 1, K, K))
+
+
+def _sample_log(logp, rng=np.random):
+    p = np.exp(logp - logp.max())
+    cp = np.cumsum(p)
+    return min(np.searchsorted(cp, rng.rand() * cp[-1], side="right"),
+               p.size - 1)
+
+
+def _sample_log_rows(logps):
+    """ sample one index from each row of a (T x K) array of log weights """
+    p = np.exp(logps - logps.max(axis=1, keepdims=True))
+    cp = np.cumsum(p, axis=1)
+    u = np.random.rand(cp.shape[0], 1) * cp[:, -1:]
+    return np.minimum((cp <= u).sum(axis=1), p.shape[1] - 1).astype(np.int32)
+
+
+def _is_row_invariant(log_trans_matrices):
+    return getattr(log_trans_matrices, "row_invariant", False)
+
+
+### Row invariant transition matrices
+# When every row of A[t] equals exp(log_rows[t]), the forward message
+# factors as alphal[t+1] = logsumexp(alphal[t]) + log_rows[t] + aBl[t+1]
+# and the backward message is constant across states. Both reduce to
+# cumulative sums of per-time-step log normalizers.
+def _row_invariant_node_potentials(log_rows, log_pi_0, log_likelihoods):
+    node = np.empty_like(log_likelihoods)
+    node[0] = log_pi_0 + log_likelihoods[0]
+    node[1:] = log_rows + log_likelihoods[1:]
+    return node
+
+
+def _row_invariant_messages_forwards_log(log_rows, log_pi_0, log_likelihoods):
+    alphal = _row_invariant_node_potentials(log_rows, log_pi_0, log_likelihoods)
+    log_Z = _logsumexp(alphal, axis=1)
+    alphal[1:] += np.cumsum(log_Z)[:-1, None]
+    return alphal
+
+
+def _row_invariant_messages_backwards_log(log_rows, log_likelihoods):
+    log_Z = _logsumexp(log_rows + log_likelihoods[1:], axis=1)
+    betal = np.zeros_like(log_likelihoods)
+    betal[:-1] = np.cumsum(log_Z[::-1])[::-1, None]
+    return betal
+
+
+def _row_invariant_sample_forwards_log(betal, log_rows, log_pi_0, log_likelihoods):
+    # Given the observations, the states are independent across time
+    logps = _row_invariant_node_potentials(log_rows, log_pi_0, log_likelihoods)
+    return _sample_log_rows(logps + betal)
+
+
+### Shared plus diagonal transition matrices
+# log A[t,i,j] = S[t,j] + (d[t,i] if j == i) + (r[t,i] if j > i), so sums
+# over i or j of A[t,i,j] times a vector are prefix and suffix sums.
+def _is_shared_plus_diagonal(log_trans_matrices):
+    return getattr(log_trans_matrices, "shared_plus_diagonal", False)
+
+
+def _exclusive_prefix_sums(a):
+    """ p[..., j] = sum_{i < j} a[..., i], without cancellation """
+    p = np.zeros_like(a)
+    np.cumsum(a[..., :-1], axis=-1, out=p[..., 1:])
+    return p
+
+
+def _exclusive_suffix_sums(a):
+    """ s[..., j] = sum_{i > j} a[..., i], without cancellation """
+    s = np.zeros_like(a)
+    s[..., :-1] = np.cumsum(a[..., :0:-1], axis=-1)[..., ::-1]
+    return s
+
+
+def _spd_forward_sums(a, ed, er):
+    """ c[..., j] = sum_i a[..., i] exp(log A[i,j] - S[j]) """
+    return _exclusive_suffix_sums(a) + a * ed + _exclusive_prefix_sums(a * er)
+
+
+def _spd_messages_forwards_log(op, log_pi_0, log_likelihoods):
+    aBl = log_likelihoods
+    S, ed, er = op.log_shared, np.exp(op.log_diag), np.exp(op.log_tail)
+
+    alphal = np.empty_like(aBl)
+    alphal[0] = log_pi_0 + aBl[0]
+    with np.errstate(divide="ignore"):
+        for t in range(aBl.shape[0] - 1):
+            amax = alphal[t].max()
+            c = _spd_forward_sums(np.exp(alphal[t] - amax), ed[t], er[t])
+            alphal[t+1] = amax + np.log(c) + S[t] + aBl[t+1]
+
+    return alphal
+
+
+def _spd_messages_backwards_log(op, log_likelihoods):
+    aBl = log_likelihoods
+    S, ed, er = op.log_shared, np.exp(op.log_diag), np.exp(op.log_tail)
+
+    betal = np.empty_like(aBl)
+    betal[-1] = 0
+    with np.errstate(divide="ignore"):
+        for t in range(aBl.shape[0] - 2, -1, -1):
+            u = S[t] + betal[t+1] + aBl[t+1]
+            umax = u.max()
+            v = np.exp(u - umax)
+            betal[t] = umax + np.log(_exclusive_prefix_sums(v) + v * ed[t]
+                                     + er[t] * _exclusive_suffix_sums(v))
+
+    return betal
+
+
+def _spd_sample_forwards_log(betal, op, log_pi_0, log_likelihoods):
+    aBl = log_likelihoods
+    T = aBl.shape[0]
+
+    stateseq = np.empty(T, dtype=np.int32)
+    stateseq[0] = _sample_log(log_pi_0 + aBl[0] + betal[0])
+    for t in range(T - 1):
+        stateseq[t+1] = _sample_log(
+            op.log_row(t, stateseq[t]) + aBl[t+1] + betal[t+1])
+
+    return stateseq
+
+
+def _spd_expected_transcounts(op, log_likelihoods, alphal, betal):
+    # Unnormalized joints are a[t,i] * v[t,j] * exp(log A[t,i,j] - S[t,j])
+    ed, er = np.exp(op.log_diag), np.exp(op.log_tail)
+    a = np.exp(alphal[:-1] - alphal[:-1].max(1, keepdims=True))
+    u = op.log_shared + betal[1:] + log_likelihoods[1:]
+    v = np.exp(u - u.max(1, keepdims=True))
+
+    # Normalize each time step's joint distribution
+    Z = np.sum(_spd_forward_sums(a, ed, er) * v, axis=1)
+    a /= Z[:, None]
+
+    return np.tril(a.T.dot(v), -1) \
+        + np.diag(np.sum(a * ed * v, axis=0)) \
+        + np.triu((a * er).T.dot(v), 1)
+
+
+def messages_forwards_log(log_trans_matrices, log_pi_0, log_likelihoods):
+    """
+    Compute the forward messages alphal[t] = log p(z_t, y_{1:t})
+
+    :param log_trans_matrices: (K x K) or (T-1 x K x K) log transition
+                               matrices, or an implicit operator
+    :param log_pi_0:           length K log initial state distribution
+    :param log_likelihoods:    (T x K) log likelihoods
+    :return:                   (T x K) forward messages
+    """
+    if _is_row_invariant(log_trans_matrices):
+        return _row_invariant_messages_forwards_log(
+            log_trans_matrices.log_rows, log_pi_0, log_likelihoods)
+    if _is_shared_plus_diagonal(log_trans_matrices):
+        return _spd_messages_forwards_log(
+            log_trans_matrices, log_pi_0, log_likelihoods)
+
+    aBl = log_likelihoods
+    T = aBl.shape[0]
+
+    alphal = np.empty_like(aBl)
+    alphal[0] = log_pi_0 + aBl[0]
+    for start, stop, Al in _log_trans_blocks(log_trans_matrices, T):
+        for t in range(start, stop):
+            alphal[t+1] = _logsumexp(alphal[t][:, None] + Al[t-start], axis=0) \
+                          + aBl[t+1]
+
+    return alphal
+
+
+def messages_backwards_log(log_trans_matrices, log_likelihoods):
+    """
+    Compute the backward messages betal[t] = log p(y_{t+1:T} | z_t)
+
+    :param log_trans_matrices: (K x K) or (T-1 x K x K) log transition
+                               matrices, or an implicit operator
+    :param log_likelihoods:    (T x K) log likelihoods
+    :return:                   (T x K) backward messages
+    """
+    if _is_row_invariant(log_trans_matrices):
+        return _row_invariant_messages_backwards_log(
+            log_trans_matrices.log_rows, log_likelihoods)
+    if _is_shared_plus_diagonal(log_trans_matrices):
+        return _spd_messages_backwards_log(log_trans_matrices, log_likelihoods)
+
+    aBl = log_likelihoods
+    T = aBl.shape[0]
+
+    betal = np.empty_like(aBl)
+    betal[-1] = 0
+    for start, stop, Al in _log_trans_blocks(log_trans_matrices, T, reverse=True):
+        for t in range(stop - 1, start - 1, -1):
+            betal[t] = _logsumexp(Al[t-start] + (betal[t+1] + aBl[t+1]), axis=1)
+
+    return betal
+
+
+def sample_forwards_log(betal, log_trans_matrices, log_pi_0, log_likelihoods):
+    """
+    Sample a state sequence given the backward messages
+
+    :return: length T int32 state sequence
+    """
+    if _is_row_invariant(log_trans_matrices):
+        return _row_invariant_sample_forwards_log(
+            betal, log_trans_matrices.log_rows, log_pi_0, log_likelihoods)
+    if _is_shared_plus_diagonal(log_trans_matrices):
+        return _spd_sample_forwards_log(
+            betal, log_trans_matrices, log_pi_0, log_likelihoods)
+
+    aBl = log_likelihoods
+    T = aBl.shape[0]
+
+    stateseq = np.empty(T, dtype=np.int32)
+    stateseq[0] = _sample_log(log_pi_0 + aBl[0] + betal[0])
+    for start, stop, Al in _log_trans_blocks(log_trans_matrices, T):
+        for t in range(start, stop):
+            stateseq[t+1] = _sample_log(
+                Al[t-start, stateseq[t]] + aBl[t+1] + betal[t+1])
+
+    return stateseq
+
+
+def _expected_states(alphal, betal):
+    expected_states = alphal + betal
+    expected_states -= expected_states.max(1)[:, None]
+    np.exp(expected_states, out=expected_states)
+    expected_states /= expected_states.sum(1)[:, None]
+    return expected_states
+
+
+def expected_statistics(trans_matrices, log_likelihoods, alphal, betal):
+    """
+    Compute the expected states and transition counts from the messages,
+    given the transition probabilities rather than their logs.  The joint
+    distribution of z_t and z_{t+1} is proportional to
+    a[t,i] A[t,i,j] b[t,j], with a and b the exponentiated messages, so
+    the counts are contractions of the stack and no transcendental
+    functions of it are evaluated.
+
+    :param trans_matrices:  (K x K) or (T-1 x K x K) transition matrices
+    :return: expected_states, (K x K) expected_transcounts summed over
+             time, normalizer
+    """
+    expected_states = _expected_states(alphal, betal)
+    normalizer = _logsumexp(alphal[0] + betal[0], axis=0)
+
+    a = np.exp(alphal[:-1] - alphal[:-1].max(1, keepdims=True))
+    u = betal[1:] + log_likelihoods[1:]
+    b = np.exp(u - u.max(1, keepdims=True))
+    if trans_matrices.ndim == 3:
+        Z = np.einsum('ti,tij,tj->t', a, trans_matrices, b)
+        expected_transcounts = np.einsum('ti,tij,tj->ij', a / Z[:, None], trans_matrices, b)
+    else:
+        Z = np.einsum('ti,ij,tj->t', a, trans_matrices, b)
+        expected_transcounts = (a / Z[:, None]).T.dot(b) * trans_matrices
+
+    return expected_states, expected_transcounts, normalizer
+
+
+def expected_statistics_log(log_trans_matrices, log_likelihoods, alphal, betal):
+    """
+    Compute the expected states and transition counts from the messages.
+    The expected transition counts are summed over time, and only one
+    block of joint probabilities is held in memory at a time.
+
+    :return: expected_states, (K x K) expected_transcounts, normalizer
+    """
+    T, K = log_likelihoods.shape
+    expected_states = _expected_states(alphal, betal)
+    normalizer = _logsumexp(alphal[0] + betal[0], axis=0)
+
+    # With identical rows, z_t and z_{t+1} are independent given the data
+    if _is_row_invariant(log_trans_matrices):
+        expected_transcounts = expected_states[:-1].T.dot(expected_states[1:])
+        return expected_states, expected_transcounts, normalizer
+    if _is_shared_plus_diagonal(log_trans_matrices):
+        expected_transcounts = _spd_expected_transcounts(
+            log_trans_matrices, log_likelihoods, alphal, betal)
+        return expected_states, expected_transcounts, normalizer
+
+    expected_transcounts = np.zeros((K, K))
+    for start, stop, Al in _log_trans_blocks(log_trans_matrices, T):
+        log_joints = alphal[start:stop, :, None] \
+            + (betal[start+1:stop+1, None, :] + log_likelihoods[start+1:stop+1, None, :]) \
+            + Al
+        log_joints -= log_joints.max(axis=(1, 2), keepdims=True)
+        joints = np.exp(log_joints)
+        joints /= joints.sum(axis=(1, 2), keepdims=True)
+        expected_transcounts += joints.sum(0)
+
+    return expected_states, expected_transcounts, normalizer
+
+
+### Viterbi decoding
+# Max-product message passing: score[t, j] is the log probability of the
+# best path ending in z_t = j, and args[t, j] is its state at time t-1.
+# The row invariant and shared plus diagonal operators get O(T*K) versions,
+# since the maximum over the previous state factors the same way the sum does.
+def _running_argmax(a):
+    """ index of the maximum of a[..., :j+1], for every j """
+    idx = np.arange(a.shape[-1])
+    idx = np.where(a >= np.maximum.accumulate(a, axis=-1), idx, 0)
+    return np.maximum.accumulate(idx, axis=-1)
+
+
+def _spd_max_product(score, ld, lt):
+    """
+    Maximize score[i] + log A[i,j] - S[j] over i, for every j.
+
+    :return: the maxima and the maximizing i's
+    """
+    K = score.shape[0]
+    cands = np.full((3, K), -np.inf)
+    args = np.zeros((3, K), dtype=np.int32)
+
+    # i > j: suffix maxima of score, shifted by one
+    rev = _running_argmax(score[::-1])
+    cands[0, :-1] = score[::-1][rev][::-1][1:]
+    args[0, :-1] = (K - 1 - rev)[::-1][1:]
+
+    # i = j
+    cands[1] = score + ld
+    args[1] = np.arange(K)
+
+    # i < j: prefix maxima of score + r, shifted by one
+    c = score + lt
+    fwd = _running_argmax(c)
+    cands[2, 1:] = c[fwd][:-1]
+    args[2, 1:] = fwd[:-1]
+
+    best = cands.argmax(0)
+    return cands[best, np.arange(K)], args[best, np.arange(K)]
+
+
+def viterbi_log(log_trans_matrices, log_pi_0, log_likelihoods):
+    """
+    Find the most likely state sequence, argmax_z log p(z, y).
+
+    :param log_trans_matrices: (K x K) or (T-1 x K x K) log transition
+                               matrices, or an implicit operator
+    :param log_pi_0:           length K log initial state distribution
+    :param log_likelihoods:    (T x K) log likelihoods
+    :return:                   length T int32 state sequence, and its
+                               log joint probability with the data
+    """
+    aBl = log_likelihoods
+    T, K = aBl.shape
+
+    # With identical rows, the states are independent given the data
+    if _is_row_invariant(log_trans_matrices):
+        node = _row_invariant_node_potentials(
+            log_trans_matrices.log_rows, log_pi_0, aBl)
+        stateseq = node.argmax(1).astype(np.int32)
+        return stateseq, node[np.arange(T), stateseq].sum()
+
+    args = np.zeros((T, K), dtype=np.int32)
+    score = log_pi_0 + aBl[0]
+    if _is_shared_plus_diagonal(log_trans_matrices):
+        op = log_trans_matrices
+        for t in range(T - 1):
+            score, args[t+1] = _spd_max_product(score, op.log_diag[t], op.log_tail[t])
+            score += op.log_shared[t] + aBl[t+1]
+    else:
+        for start, stop, Al in _log_trans_blocks(log_trans_matrices, T):
+            for t in range(start, stop):
+                scores = score[:, None] + Al[t-start]
+                args[t+1] = scores.argmax(0)
+                score = scores[args[t+1], np.arange(K)] + aBl[t+1]
+
+    # Trace the best path back from its final state
+    stateseq = np.empty(T, dtype=np.int32)
+    stateseq[-1] = score.argmax()
+    for t in range(T - 1, 0, -1):
+        stateseq[t-1] = args[t, stateseq[t]]
+    return stateseq, score.max()
+
+
+def _viterbi(args):
+    # Module level so that it can be sent to a process pool
+    return viterbi_log(*args)
+
+
+def batch_viterbi_log(problems, pool=None):
+    """
+    Decode many sequences, optionally in parallel.
+
+    :param problems: list of (log_trans_matrices, log_pi_0, log_likelihoods)
+    :param pool:     optional pool with a map method, like a
+                     multiprocessing.Pool.  The transition potentials
+                     must be picklable to use a process pool.
+    :return:         list of state sequences and array of their scores
+    """
+    _map = map if pool is None else pool.map
+    results = list(_map(_viterbi, problems))
+    stateseqs = [stateseq for stateseq, _ in results]
+    scores = np.array([score for _, score in results])
+    return stateseqs, scores
+
+
+### Pruned message passing
+# For large K most transition probabilities are negligible.  The pruned
+# forward pass keeps a beam of states at each time step: the beam_size
+# states with the largest filtering probabilities and/or those whose
+# filtering log probability is at least log_threshold.  Messages are only
+# passed out of the beam, which costs O(B*K) per step in the forward pass
+# and O(B^2) per step in the backward pass and the expected statistics.
+# States outside the beam get forward and backward messages of -inf.  Each
+# step reports the fraction of the filtering probability it discarded.
+def _beam(alpha, beam_size, log_threshold):
+    """
+    :return: sorted indices of the states in the beam, and the fraction of
+             the filtering probability outside of it
+    """
+    logp = alpha - _logsumexp(alpha, axis=0)
+    keep = np.arange(alpha.size)
+    if beam_size is not None and beam_size < alpha.size:
+        keep = np.argpartition(-logp, beam_size - 1)[:beam_size]
+    if log_threshold is not None:
+        # Always keep the most likely state
+        keep = keep[logp[keep] >= min(log_threshold, logp.max())]
+    keep.sort()
+    return keep, max(0., 1. - np.exp(logp[keep]).sum())
+
+
+def pruned_messages_forwards_log(log_trans_matrices, log_pi_0, log_likelihoods,
+                                 beam_size=None, log_threshold=None):
+    """
+    Compute the forward messages, like messages_forwards_log, keeping only
+    a beam of states at each time step.
+
+    :param beam_size:     keep at most this many states per time step
+    :param log_threshold: drop states whose filtering log probability is
+                          below this value
+    :return: (T x K) forward messages, -inf outside the beam, and the
+             fraction of the filtering probability discarded at each step
+    """
+    aBl = log_likelihoods
+    T, K = aBl.shape
+
+    alphal = -np.inf * np.ones((T, K))
+    discarded = np.zeros(T)
+    alpha = log_pi_0 + aBl[0]
+    beam, discarded[0] = _beam(alpha, beam_size, log_threshold)
+    alphal[0, beam] = alpha[beam]
+    for start, stop, Al in _log_trans_blocks(log_trans_matrices, T):
+        for t in range(start, stop):
+            alpha = _logsumexp(alphal[t, beam][:, None] + Al[t-start][beam], axis=0) \
+                + aBl[t+1]
+            beam, discarded[t+1] = _beam(alpha, beam_size, log_threshold)
+            alphal[t+1, beam] = alpha[beam]
+
+    return alphal, discarded
+
+
+def pruned_messages_backwards_log(log_trans_matrices, log_likelihoods, alphal):
+    """
+    Compute the backward messages over the beams of the pruned forward pass.
+
+    :return: (T x K) backward messages, -inf outside the beam
+    """
+    aBl = log_likelihoods
+    T, K = aBl.shape
+
+    betal = -np.inf * np.ones((T, K))
+    next_beam = np.flatnonzero(np.isfinite(alphal[-1]))
+    betal[-1, next_beam] = 0
+    for start, stop, Al in _log_trans_blocks(log_trans_matrices, T, reverse=True):
+        for t in range(stop - 1, start - 1, -1):
+            beam = np.flatnonzero(np.isfinite(alphal[t]))
+            betal[t, beam] = _logsumexp(
+                Al[t-start][np.ix_(beam, next_beam)]
+                + (betal[t+1, next_beam] + aBl[t+1, next_beam]), axis=1)
+            next_beam = beam
+
+    return betal
+
+
+def pruned_sample_backwards_log(alphal, log_trans_matrices):
+    """
+    Sample a state sequence backward given the pruned forward messages,
+    using p(z_t | z_{t+1}, y_{1:t}) \propto alphal[t] * A_t[:, z_{t+1}].
+
+    :return: length T int32 state sequence
+    """
+    T = alphal.shape[0]
+    stateseq = np.empty(T, dtype=np.int32)
+    stateseq[-1] = _sample_log(alphal[-1])
+    for start, stop, Al in _log_trans_blocks(log_trans_matrices, T, reverse=True):
+        for t in range(stop - 1, start - 1, -1):
+            stateseq[t] = _sample_log(alphal[t] + Al[t-start][:, stateseq[t+1]])
+
+    return stateseq
+
+
+def pruned_expected_statistics_log(log_trans_matrices, log_likelihoods, alphal, betal,
+                                   joints_callback=None):
+    """
+    Compute the expected states and transition counts, like
+    expected_statistics_log, from the pruned messages.  Only the joint
+    probabilities between consecutive beams are formed.
+
+    :param joints_callback: if given, called as joints_callback(t, t+1, joints)
+                            with the (1 x K x K) joint distribution of z_t
+                            and z_{t+1}
+    :return: expected_states, (K x K) expected_transcounts, normalizer
+    """
+    aBl = log_likelihoods
+    T, K = aBl.shape
+    expected_states = _expected_states(alphal, betal)
+    normalizer = _logsumexp(alphal[-1], axis=0)
+
+    expected_transcounts = np.zeros((K, K))
+
+    for start, stop, Al in _log_trans_blocks(log_trans_matrices, T):
+        for t in range(start, stop):
+            beam = np.flatnonzero(np.isfinite(betal[t]))
+            next_beam = np.flatnonzero(np.isfinite(betal[t+1]))
+            log_joints = alphal[t, beam][:, None] \
+                + Al[t-start][np.ix_(beam, next_beam)] \
+                + (betal[t+1, next_beam] + aBl[t+1, next_beam])
+            joints = np.exp(log_joints - log_joints.max())
+            joints /= joints.sum()
+
+            expected_transcounts[np.ix_(beam, next_beam)] += joints
+            if joints_callback is not None:
+                joints_t = np.zeros((1, K, K))
+                joints_t[0][np.ix_(beam, next_beam)] = joints
+                joints_callback(t, t + 1, joints_t)
+
+    return expected_states, expected_transcounts, normalizer
+
+
+### Low memory expected statistics
+# The joint probabilities of (z_t, z_{t+1}) form a (T-1 x K x K) array.
+# expected_statistics_blocked hands them to the caller one block of time
+# steps at a time, during a backward pass over the blocks, so only one block
+# is ever held in memory.  With checkpointing, the forward pass keeps only
+# the first forward message of each block and the backward pass recomputes
+# the others from it, so with blocks of sqrt(T) steps the messages take
+# O(sqrt(T) * K) memory, apart from the (T x K) expected states.
+def expected_statistics_blocked(log_trans_matrices, log_pi_0, log_likelihoods,
+                                block_size=None, checkpoint=False,
+                                joints_callback=None):
+    """
+    Compute the expected states and the expected transition counts, summed
+    over time, one block of time steps at a time.
+
+    :param block_size:      number of transitions per block (default: sqrt(T))
+    :param checkpoint:      if True, only store the forward messages at the
+                            start of each block and recompute the rest
+    :param joints_callback: if given, called as
+                            joints_callback(start, stop, joints) where
+                            joints[t-start] is the joint distribution of
+                            z_t and z_{t+1}, for each block in reverse order
+    :return: expected_states, expected_transcounts, normalizer
+    """
+    aBl = log_likelihoods
+    T, K = aBl.shape
+    block_size = block_size or int(np.ceil(np.sqrt(T)))
+    bounds = np.append(np.arange(0, T - 1, block_size), T - 1)
+    blocks = list(zip(bounds[:-1], bounds[1:]))
+
+    # Forward pass
+    if checkpoint:
+        alpha_starts = [log_pi_0 + aBl[0]]
+        for start, stop in blocks:
+            alpha_starts.append(_chunk_forwards((
+                _trans_chunk(log_trans_matrices, start, stop),
+                alpha_starts[-1], aBl[start+1:stop+1]))[-1])
+        alpha_last = alpha_starts[-1]
+    else:
+        alphal = messages_forwards_log(log_trans_matrices, log_pi_0, aBl)
+        alpha_last = alphal[-1]
+    normalizer = _logsumexp(alpha_last, axis=0)
+
+    # Backward pass, forming the expected statistics of each block
+    expected_states = np.empty((T, K))
+    expected_states[-1] = alpha_last
+    expected_transcounts = np.zeros((K, K))
+    beta = np.zeros(K)
+    for c in range(len(blocks) - 1, -1, -1):
+        start, stop = blocks[c]
+        chunk = _trans_chunk(log_trans_matrices, start, stop)
+        if checkpoint:
+            alphas = np.vstack((alpha_starts[c][None, :], _chunk_forwards(
+                (chunk, alpha_starts[c], aBl[start+1:stop]))))
+        else:
+            alphas = alphal[start:stop]
+
+        betas = _chunk_backwards((chunk, beta, aBl[start+1:stop+1]))
+        betas_next = np.vstack((betas[1:], beta[None, :]))
+
+        log_joints = alphas[:, :, None] \
+            + (betas_next + aBl[start+1:stop+1])[:, None, :] \
+            + _dense_chunk(chunk, stop - start)
+        log_joints -= log_joints.max(axis=(1, 2), keepdims=True)
+        joints = np.exp(log_joints)
+        joints /= joints.sum(axis=(1, 2), keepdims=True)
+        expected_transcounts += joints.sum(0)
+        if joints_callback is not None:
+            joints_callback(start, stop, joints)
+
+        expected_states[start:stop] = alphas + betas
+        beta = betas[0]
+
+    expected_states -= expected_states.max(1)[:, None]
+    np.exp(expected_states, out=expected_states)
+    expected_states /= expected_states.sum(1)[:, None]
+    return expected_states, expected_transcounts, normalizer
+
+
+### Parallel in time message passing
+# Split the T-1 transitions into chunks at boundaries 0 = b_0 < ... < b_C = T-1.
+# In the log semiring, chunk c has the (K x K) transfer matrix
+#     M_c[i,j] = log sum_{paths from z_{b_c}=i to z_{b_{c+1}}=j} prod_t A_t L_{t+1}
+# The chunks' transfer matrices are independent, so they are computed in
+# parallel. A short sequential scan over the chunks gives the messages at
+# the boundaries, and then every chunk fills in its own messages in
+# parallel. Computing M_c costs O(K^3) per time step rather than O(K^2),
+# so this pays off when the number of workers exceeds about K.
+#
+# The chunk functions are module level so that they can be sent to a
+# multiprocessing pool as well as a thread pool.
+def _chunk_boundaries(T, num_chunks):
+    num_chunks = max(1, min(num_chunks, T - 1))
+    return np.unique(np.linspace(0, T - 1, num_chunks + 1).astype(int))
+
+
+def _trans_chunk(log_trans_matrices, start, stop):
+    """ the part of the transition potentials to send to a worker """
+    if isinstance(log_trans_matrices, np.ndarray):
+        return log_trans_matrices[start:stop] \
+            if log_trans_matrices.ndim == 3 else log_trans_matrices
+    elif hasattr(log_trans_matrices, "view"):
+        return log_trans_matrices.view(start, stop)
+    return log_trans_matrices.log_block(start, stop)
+
+
+def _dense_chunk(chunk, n):
+    """ the (n x K x K) log transition matrices of a chunk """
+    if hasattr(chunk, "log_block"):
+        return chunk.log_block(0, n)
+    elif chunk.ndim == 2:
+        return np.broadcast_to(chunk, (n,) + chunk.shape)
+    return chunk
+
+
+def _chunk_log_product(args):
+    chunk, aBl = args
+    Al = _dense_chunk(chunk, aBl.shape[0])
+    M = Al[0] + aBl[0]
+    for t in range(1, aBl.shape[0]):
+        M = _logsumexp(M[:, :, None] + (Al[t] + aBl[t]), axis=1)
+    return M
+
+
+def _chunk_forwards(args):
+    chunk, alpha_start, aBl = args
+    Al = _dense_chunk(chunk, aBl.shape[0])
+    alphal = np.empty_like(aBl)
+    alpha = alpha_start
+    for t in range(aBl.shape[0]):
+        alpha = alphal[t] = _logsumexp(alpha[:, None] + Al[t], axis=0) + aBl[t]
+    return alphal
+
+
+def _chunk_backwards(args):
+    chunk, beta_stop, aBl = args
+    Al = _dense_chunk(chunk, aBl.shape[0])
+    betal = np.empty_like(aBl)
+    beta = beta_stop
+    for t in range(aBl.shape[0] - 1, -1, -1):
+        beta = betal[t] = _logsumexp(Al[t] + (beta + aBl[t]), axis=1)
+    return betal
+
+
+def _chunk_sample(args):
+    """ sample z_{start+1:stop} given z_start and z_stop """
+    chunk, aBl, z_start, z_stop, seed = args
+    n, K = aBl.shape
+    Al = _dense_chunk(chunk, n)
+    rng = np.random.RandomState(seed)
+
+    # Backward messages conditioned on the final state
+    betal = np.empty((n, K))
+    betal[-1] = -np.inf
+    betal[-1, z_stop] = 0
+    for t in range(n - 1, 0, -1):
+        betal[t-1] = _logsumexp(Al[t] + (betal[t] + aBl[t]), axis=1)
+
+    stateseq = np.empty(n, dtype=np.int32)
+    z = z_start
+    for t in range(n - 1):
+        z = stateseq[t] = _sample_log(Al[t, z] + aBl[t] + betal[t], rng=rng)
+    stateseq[-1] = z_stop
+    return stateseq
+
+
+def _is_structured(log_trans_matrices):
+    # These already have O(T*K) message passing, so they aren't chunked
+    return _is_row_invariant(log_trans_matrices) or \
+        _is_shared_plus_diagonal(log_trans_matrices)
+
+
+def chunk_transfer_matrices(log_trans_matrices, log_likelihoods, num_chunks, pool=None):
+    """
+    Compute the (K x K) log transfer matrices of the chunks in parallel.
+    They can be passed to the parallel message passing functions to share
+    them between the forward, backward, and sampling passes.
+
+    :return: list of transfer matrices, one per chunk
+    """
+    bounds = _chunk_boundaries(log_likelihoods.shape[0], num_chunks)
+    _map = map if pool is None else pool.map
+    return list(_map(_chunk_log_product, [
+        (_trans_chunk(log_trans_matrices, start, stop), log_likelihoods[start+1:stop+1])
+        for start, stop in zip(bounds[:-1], bounds[1:])]))
+
+
+def parallel_messages_forwards_log(log_trans_matrices, log_pi_0, log_likelihoods,
+                                   num_chunks, pool=None, products=None):
+    """
+    Compute the forward messages, like messages_forwards_log, by splitting
+    the sequence into chunks that are processed in parallel.
+
+    :param num_chunks: number of chunks of time steps
+    :param pool:       a thread or process pool with a map method, e.g. a
+                       multiprocessing.Pool.  If None, the chunks are
+                       processed one after the other.
+    :param products:   chunk transfer matrices from chunk_transfer_matrices,
+                       if they have already been computed
+    :return:           (T x K) forward messages
+    """
+    if _is_structured(log_trans_matrices):
+        return messages_forwards_log(log_trans_matrices, log_pi_0, log_likelihoods)
+
+    aBl = log_likelihoods
+    T = aBl.shape[0]
+    alphal = np.empty_like(aBl)
+    alphal[0] = log_pi_0 + aBl[0]
+    if T == 1:
+        return alphal
+
+    bounds = _chunk_boundaries(T, num_chunks)
+    if products is None:
+        products = chunk_transfer_matrices(log_trans_matrices, aBl, num_chunks, pool)
+
+    # Scan over the chunks for the messages at their boundaries
+    for start, stop, M in zip(bounds[:-1], bounds[1:], products):
+        alphal[stop] = _logsumexp(alphal[start][:, None] + M, axis=0)
+
+    _map = map if pool is None else pool.map
+    chunks = list(_map(_chunk_forwards, [
+        (_trans_chunk(log_trans_matrices, start, stop), alphal[start], aBl[start+1:stop+1])
+        for start, stop in zip(bounds[:-1], bounds[1:])]))
+    for start, stop, chunk in zip(bounds[:-1], bounds[1:], chunks):
+        alphal[start+1:stop] = chunk[:-1]
+
+    return alphal
+
+
+def parallel_messages_backwards_log(log_trans_matrices, log_likelihoods,
+                                    num_chunks, pool=None, products=None):
+    """
+    Compute the backward messages, like messages_backwards_log, by splitting
+    the sequence into chunks that are processed in parallel.  The arguments
+    are as in parallel_messages_forwards_log.
+
+    :return: (T x K) backward messages
+    """
+    if _is_structured(log_trans_matrices):
+        return messages_backwards_log(log_trans_matrices, log_likelihoods)
+
+    aBl = log_likelihoods
+    T = aBl.shape[0]
+    betal = np.empty_like(aBl)
+    betal[-1] = 0
+    if T == 1:
+        return betal
+
+    bounds = _chunk_boundaries(T, num_chunks)
+    if products is None:
+        products = chunk_transfer_matrices(log_trans_matrices, aBl, num_chunks, pool)
+
+    # Scan backward over the chunks for the messages at their boundaries
+    for start, stop, M in reversed(list(zip(bounds[:-1], bounds[1:], products))):
+        betal[start] = _logsumexp(M + betal[stop], axis=1)
+
+    _map = map if pool is None else pool.map
+    chunks = list(_map(_chunk_backwards, [
+        (_trans_chunk(log_trans_matrices, start, stop), betal[stop], aBl[start+1:stop+1])
+        for start, stop in zip(bounds[:-1], bounds[1:])]))
+    for start, stop, chunk in zip(bounds[:-1], bounds[1:], chunks):
+        betal[start+1:stop] = chunk[1:]
+
+    return betal
+
+
+def parallel_sample_forwards_log(betal, log_trans_matrices, log_pi_0, log_likelihoods,
+                                 num_chunks, pool=None, products=None):
+    """
+    Sample a state sequence given the backward messages, like
+    sample_forwards_log.  The states at the chunk boundaries are sampled
+    first, using the chunk transfer matrices, and then each chunk samples
+    its interior given the states at both of its ends, in parallel.  Each
+    chunk gets its own seed drawn from numpy's global random state.
+
+    :return: length T int32 state sequence
+    """
+    if _is_structured(log_trans_matrices):
+        return sample_forwards_log(betal, log_trans_matrices, log_pi_0, log_likelihoods)
+
+    aBl = log_likelihoods
+    T = aBl.shape[0]
+    stateseq = np.empty(T, dtype=np.int32)
+    stateseq[0] = _sample_log(log_pi_0 + aBl[0] + betal[0])
+    if T == 1:
+        return stateseq
+
+    bounds = _chunk_boundaries(T, num_chunks)
+    if products is None:
+        products = chunk_transfer_matrices(log_trans_matrices, aBl, num_chunks, pool)
+
+    for start, stop, M in zip(bounds[:-1], bounds[1:], products):
+        stateseq[stop] = _sample_log(M[stateseq[start]] + betal[stop])
+
+    seeds = np.random.randint(2 ** 31 - 1, size=len(bounds) - 1)
+    _map = map if pool is None else pool.map
+    chunks = list(_map(_chunk_sample, [
+        (_trans_chunk(log_trans_matrices, start, stop), aBl[start+1:stop+1],
+         stateseq[start], stateseq[stop], seed)
+        for start, stop, seed in zip(bounds[:-1], bounds[1:], seeds)]))
+    for start, stop, chunk in zip(bounds[:-1], bounds[1:], chunks):
+        stateseq[start+1:stop] = chunk[:-1]
+
+    return stateseq
+
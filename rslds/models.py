@@ -1,3 +1,5 @@
+from functools import partial
+
 import numpy as np
 
 from pyhsmm.models import _HMMGibbsSampling, _HMMEM, _HMMMeanField
@@ -10,6 +12,10 @@ from pyslds.models import _SLDSGibbsMixin, _SLDSVBEMMixin, _SLDSMeanFieldMixin
 
 from rslds.states import InputHMMStates, PGRecurrentSLDSStates, SoftmaxRecurrentSLDSStates
 import rslds.transitions as transitions
+import rslds.messages as messages
+from rslds.util import polya_gamma_samplers
+from rslds.filtering import RecurrentSLDSFilter, RaoBlackwellizedParticleFilter, \
+    FixedLagSmoother
 
 ### Input-driven HMMs
 class _InputHMMMixin(object):
@@ -86,6 +92,97 @@ class _InputHMMMixin(object):
         )
         self._clear_caches()
 
+    ### Batched transition evaluation
+    def batch_trans_potentials(self, states_list=None):
+        """
+        Evaluate the transition potentials of many sequences in one pass.
+        The covariates of all sequences whose transitions aren't cached
+        are concatenated into one ragged buffer, indexed by offsets, and
+        the transition model is evaluated once on the whole buffer. Each
+        states object then caches a zero-copy view of its own time steps.
+        This avoids paying the per-call overhead once per sequence when
+        there are many short sequences.
+
+        :param states_list: the states to update (default: all of them)
+        """
+        states_list = self.states_list if states_list is None else states_list
+
+        # Group the states by the transition quantity they use
+        groups = {}
+        for s in states_list:
+            if s.uses_trans_operator:
+                name = "log_trans_operator"
+            elif s.compiled_messages:
+                name = "trans_matrix"
+            else:
+                name = "log_trans_matrix"
+            if not s.has_cached_trans(name):
+                groups.setdefault(name, []).append(s)
+
+        for name, group in groups.items():
+            if len(group) < 2:
+                continue
+
+            covs = [s.covariates for s in group]
+            offsets = np.cumsum([0] + [c.shape[0] for c in covs])
+            buffer = np.concatenate(covs, axis=0)
+
+            if name == "log_trans_operator":
+                batch = self.trans_distn.get_trans_operator(buffer)
+                for s, start, stop in zip(group, offsets[:-1], offsets[1:]):
+                    s.set_cached_trans(name, batch.view(
+                        start, stop, block_size=s.trans_operator_block_size))
+            else:
+                get_batch = self.trans_distn.get_trans_matrices if name == "trans_matrix" \
+                    else self.trans_distn.get_log_trans_matrices
+                batch = get_batch(buffer)
+                for s, start, stop in zip(group, offsets[:-1], offsets[1:]):
+                    s.set_cached_trans(name, batch[start:stop])
+
+    def resample_states(self, num_procs=0):
+        self.batch_trans_potentials()
+        super(_InputHMMMixin, self).resample_states(num_procs=num_procs)
+
+    def _E_step(self):
+        self.batch_trans_potentials()
+        super(_InputHMMMixin, self)._E_step()
+
+    ### Viterbi decoding
+    def viterbi(self, states_list=None, pool=None, num_procs=0):
+        """
+        Find the most likely discrete state sequence of each sequence,
+        given its covariates (or continuous states).  The transition
+        potentials are evaluated for all the sequences in one batch, and
+        the sequences are decoded in parallel if a pool is given or
+        num_procs > 0.  The model's states are left unchanged.
+
+        :param states_list: the states to decode (default: all of them)
+        :param pool:        optional pool with a map method
+        :param num_procs:   if positive and no pool is given, decode in a
+                            multiprocessing pool with this many processes
+        :return:            list of state sequences and array of their
+                            log joint probabilities with the data
+        """
+        states_list = self.states_list if states_list is None else states_list
+        self.batch_trans_potentials(states_list)
+        problems = [s.viterbi_potentials for s in states_list]
+
+        if pool is None and num_procs > 0:
+            from multiprocessing import Pool
+            pool = Pool(num_procs)
+            try:
+                return messages.batch_viterbi_log(problems, pool=pool)
+            finally:
+                pool.close()
+                pool.join()
+
+        return messages.batch_viterbi_log(problems, pool=pool)
+
+    def _Viterbi_E_step(self):
+        stateseqs, scores = self.viterbi()
+        for s, stateseq, score in zip(self.states_list, stateseqs, scores):
+            s.stateseq, s.viterbi_score = stateseq, score
+
 
 class PGInputHMM(_InputHMMMixin, _HMMGibbsSampling):
     _trans_class = transitions.InputHMMTransitions
@@ -258,12 +355,94 @@ class _RecurrentSLDSBase(object):
         self.states_list.append(
                 self._states_class(model=self, data=data, **kwargs))
 
+    def online_filter(self):
+        """
+        Return a RecurrentSLDSFilter that tracks a stream of new
+        observations under the current parameters.
+        """
+        return RecurrentSLDSFilter(self)
+
+    def particle_filter(self, num_particles=100, resample_threshold=0.5):
+        """
+        Return a RaoBlackwellizedParticleFilter that tracks a stream of new
+        observations under the current parameters.
+        """
+        return RaoBlackwellizedParticleFilter(
+            self, num_particles=num_particles, resample_threshold=resample_threshold)
+
 
 class PGRecurrentSLDS(_RecurrentSLDSBase, _SLDSGibbsMixin, PGInputHMM):
 
     _states_class = PGRecurrentSLDSStates
     _trans_class = transitions.InputHMMTransitions
 
+    def __init__(self, dynamics_distns, emission_distns, init_dynamics_distns,
+                 num_pg_threads=None, pg_seed=None,
+                 window_size=None, window_order="cycle", **kwargs):
+        """
+        :param num_pg_threads: number of threads for Polya-gamma sampling
+                               (default: the OpenMP thread count)
+        :param pg_seed:        seed for the Polya-gamma samplers, for
+                               reproducible auxiliary variable draws
+        :param window_size:    if given, resample the states with block
+                               updates of windows of this many time steps
+                               rather than whole sequences at once
+        :param window_order:   "cycle" or "random"; see
+                               PGRecurrentSLDSStates.resample_windowed
+        """
+        # One pool of Polya-gamma samplers shared by all sequences
+        self.ppgs = polya_gamma_samplers(num_pg_threads, pg_seed)
+        self.window_size = window_size
+        self.window_order = window_order
+
+        super(PGRecurrentSLDS, self).__init__(
+            dynamics_distns, emission_distns, init_dynamics_distns, **kwargs)
+        self.trans_distn.ppgs = self.ppgs
+
+    def resample_states(self, num_procs=0):
+        if self.window_size is not None:
+            for s in self.states_list:
+                s.resample_windowed(self.window_size, order=self.window_order)
+            return
+
+        if num_procs != 0:
+            return super(PGRecurrentSLDS, self).resample_states(num_procs=num_procs)
+
+        self.batch_trans_potentials()
+        for s in self.states_list:
+            s.resample(resample_trans_omegas=False)
+        self.resample_trans_omegas()
+
+    def resample_trans_omegas(self):
+        """
+        Resample the transition auxiliary variables of all sequences with
+        a single call to pgdrawvpar.  The draws are written into one buffer
+        and each sequence's trans_omegas becomes a view of its own part.
+        """
+        states_list = [s for s in self.states_list if s.T > 1]
+        if len(states_list) == 0:
+            return
+
+        b_pgs, psis = zip(*[s.trans_omega_params() for s in states_list])
+        offsets = np.cumsum([0] + [b_pg.size for b_pg in b_pgs])
+        omegas = np.empty(offsets[-1])
+
+        import pypolyagamma as ppg
+        ppg.pgdrawvpar(self.ppgs,
+                       np.concatenate([b_pg.ravel() for b_pg in b_pgs]).astype(float),
+                       np.concatenate([psi.ravel() for psi in psis]),
+                       omegas)
+
+        for s, start, stop in zip(states_list, offsets[:-1], offsets[1:]):
+            s.trans_omegas = omegas[start:stop].reshape(s.trans_omegas.shape)
+
+    def fixed_lag_smoother(self, lag, num_sweeps=1):
+        """
+        Return a FixedLagSmoother that smooths a stream of new observations
+        with a delay of `lag` steps under the current parameters.
+        """
+        return FixedLagSmoother(self, lag, num_sweeps=num_sweeps)
+
     def resample_trans_distn(self):
         # Include the auxiliary variables used for state resampling
         self.trans_distn.resample(
@@ -296,16 +475,24 @@ class SoftmaxRecurrentSLDS(_RecurrentSLDSBase, _SLDSMeanFieldMixin, _SLDSVBEMMix
     _states_class = SoftmaxRecurrentSLDSStates
     _trans_class = transitions.SoftmaxInputHMMTransitions
 
+    def _expected_trans_stats(self, states_list=None):
+        """
+        Sum the states' contracted transition statistics in place, so
+        the M-step memory doesn't grow with the number of time steps.
+        """
+        states_list = self.states_list if states_list is None else states_list
+        J_stats, h_stats = (np.copy(x) for x in states_list[0].E_trans_stats)
+        for s in states_list[1:]:
+            J_stats += s.E_trans_stats[0]
+            h_stats += s.E_trans_stats[1]
+        return J_stats, h_stats
+
     def _M_step_trans_distn(self):
-        stack_tuples = lambda lst: list(map(lambda xs: np.concatenate(xs, axis=0), zip(*lst)))
-        self.trans_distn.max_likelihood(
-            stats=stack_tuples([s.E_trans_stats for s in self.states_list]))
+        self.trans_distn.max_likelihood(stats=self._expected_trans_stats())
 
     def meanfield_update_trans_distn(self):
         # Include the auxiliary variables of the lower bound
-        stack_tuples = lambda lst: list(map(lambda xs: np.concatenate(xs, axis=0), zip(*lst)))
-        self.trans_distn.meanfieldupdate(
-            stats=stack_tuples([s.E_trans_stats for s in self.states_list]))
+        self.trans_distn.meanfieldupdate(stats=self._expected_trans_stats())
 
     def _init_mf_from_gibbs(self):
         self.trans_distn._initialize_mean_field()
@@ -322,6 +509,116 @@ class SoftmaxRecurrentSLDS(_RecurrentSLDSBase, _SLDSMeanFieldMixin, _SLDSVBEMMix
         self.meanfield_update_emission_distns()
         super(SoftmaxRecurrentSLDS, self).meanfield_update_parameters()
 
+    ### Stochastic variational inference
+    def svi(self, num_iters, minibatch_size, stepsize_schedule=None,
+            delay=1.0, forgetting_rate=0.6, num_local_iters=1):
+        """
+        Fit the mean field posterior with stochastic variational inference.
+        Each iteration updates the local factors, q(z) q(x), of a random
+        minibatch of sequences and takes a natural gradient step on the
+        global factors.  Call _init_mf_from_gibbs first.
+
+        :param num_iters:         number of minibatch steps
+        :param minibatch_size:    number of sequences per minibatch
+        :param stepsize_schedule: function mapping the iteration to a step
+                                  size in (0, 1].  Defaults to the
+                                  Robbins-Monro schedule
+                                  (itr + delay)^(-forgetting_rate)
+        :param num_local_iters:   local mean field updates per sequence
+        :return:                  the step sizes used
+        """
+        if stepsize_schedule is None:
+            assert delay >= 1 and 0.5 < forgetting_rate <= 1
+            stepsize_schedule = lambda itr: (itr + delay) ** (-forgetting_rate)
+
+        N = len(self.states_list)
+        minibatch_size = min(minibatch_size, N)
+        prob = minibatch_size / float(N)
+
+        stepsizes = []
+        for itr in range(num_iters):
+            stepsize = stepsize_schedule(itr)
+            minibatch = np.random.choice(N, size=minibatch_size, replace=False)
+            self.meanfield_sgdstep(minibatch, prob, stepsize,
+                                   num_local_iters=num_local_iters)
+            stepsizes.append(stepsize)
+        return stepsizes
+
+    def meanfield_sgdstep(self, minibatch, prob, stepsize, num_local_iters=1):
+        """
+        Update the local factors of a minibatch of sequences, then take a
+        natural gradient step on the global factors of the transition,
+        dynamics, and emission distributions, scaling the minibatch's
+        statistics by 1 / prob.
+
+        :param minibatch: indices into states_list
+        :param prob:      fraction of the sequences in the minibatch
+        :param stepsize:  step size in (0, 1]
+        """
+        assert 0 < stepsize <= 1
+        mb_states_list = [self.states_list[i] for i in minibatch]
+        for s in mb_states_list:
+            for _ in range(num_local_iters):
+                s.meanfieldupdate()
+
+        self._meanfield_sgdstep_parameters(mb_states_list, prob, stepsize)
+
+    def _meanfield_sgdstep_parameters(self, mb_states_list, prob, stepsize):
+        self._meanfield_sgdstep_init_dynamics_distns(mb_states_list, prob, stepsize)
+        self._meanfield_sgdstep_dynamics_distns(mb_states_list, prob, stepsize)
+        self._meanfield_sgdstep_emission_distns(mb_states_list, prob, stepsize)
+        self.trans_distn.meanfieldupdate(
+            stats=self._expected_trans_stats(mb_states_list), prob=prob, stepsize=stepsize)
+        self.init_state_distn.meanfield_sgdstep(
+            [s.expected_states[0] for s in mb_states_list], prob, stepsize)
+        self._clear_caches()
+
+    def _meanfield_sgdstep_init_dynamics_distns(self, mb_states_list, prob, stepsize):
+        sum_tuples = lambda lst: list(map(sum, zip(*lst)))
+        E_stats = lambda i, s: \
+            tuple(s.expected_states[0, i] * stat for stat in s.E_init_stats)
+
+        # pybasicbayes' Gaussian.meanfield_sgdstep only takes data and weights,
+        # so take the natural gradient step on its natural parameters here
+        for state, d in enumerate(self.init_dynamics_distns):
+            stats = d._stats_ensure_array(
+                sum_tuples(E_stats(state, s) for s in mb_states_list))
+            d.mf_natural_hypparam = \
+                (1 - stepsize) * d.mf_natural_hypparam \
+                + stepsize * (d.natural_hypparam + stats / prob)
+
+    def _meanfield_sgdstep_dynamics_distns(self, mb_states_list, prob, stepsize):
+        # The dynamics of z_t take x_t to x_{t+1}
+        contract = partial(np.tensordot, axes=1)
+        sum_tuples = lambda lst: list(map(sum, zip(*lst)))
+        E_stats = lambda i, s: \
+            tuple(contract(s.expected_states[:-1, i], stat) for stat in s.E_dynamics_stats)
+
+        for state, d in enumerate(self.dynamics_distns):
+            d.meanfield_sgdstep(
+                None, None, prob, stepsize,
+                stats=sum_tuples(E_stats(state, s) for s in mb_states_list))
+
+    def _meanfield_sgdstep_emission_distns(self, mb_states_list, prob, stepsize):
+        sum_tuples = lambda lst: list(map(sum, zip(*lst)))
+
+        if self._single_emission:
+            E_stats = lambda s: \
+                tuple(np.sum(stat, axis=0) for stat in s.E_emission_stats)
+
+            self._emission_distn.meanfield_sgdstep(
+                None, None, prob, stepsize,
+                stats=sum_tuples(E_stats(s) for s in mb_states_list))
+        else:
+            contract = partial(np.tensordot, axes=1)
+            E_stats = lambda i, s: \
+                tuple(contract(s.expected_states[:, i], stat) for stat in s.E_emission_stats)
+
+            for state, d in enumerate(self.emission_distns):
+                d.meanfield_sgdstep(
+                    None, None, prob, stepsize,
+                    stats=sum_tuples(E_stats(state, s) for s in mb_states_list))
+
 
 class SoftmaxRecurrentOnlySLDS(SoftmaxRecurrentSLDS):
     _trans_class = transitions.SoftmaxInputOnlyHMMTransitions
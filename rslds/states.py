@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 from scipy.misc import logsumexp
 
@@ -6,17 +8,277 @@ from pyhsmm.internals.hmm_states import HMMStatesEigen
 
 from pyslds.states import _SLDSStatesCountData, _SLDSStatesMaskedData
 
-from rslds.util import one_hot, logistic
+from rslds.util import one_hot, logistic, polya_gamma_samplers
+import rslds.messages as messages
+import rslds.info_messages as info_messages
 
 class InputHMMStates(HMMStatesEigen):
 
+    # The transition matrices are cached and keyed on the version of the
+    # transition parameters and of the covariates. Setting the covariates
+    # or updating the transition distribution invalidates the cache.
+    _covariates_version = 0
+    _trans_cache = None
+
+    # If set, message passing evaluates the transition matrices a block of
+    # this many time steps at a time rather than materializing the full
+    # (T-1 x K x K) stack. Requires a trans_distn with get_trans_operator.
+    trans_block_size = None
+
+    # If num_time_chunks > 1, message passing splits the sequence into that
+    # many chunks and processes them in parallel with message_pool, a thread
+    # or process pool with a map method (see rslds.messages).  This costs
+    # O(K^3) rather than O(K^2) per time step, so it pays off for long
+    # sequences when there are more workers than states.  The recurrent
+    # SLDS states also use them for their continuous states
+    # (see rslds.info_messages).
+    num_time_chunks = None
+    message_pool = None
+
+    # If beam_size or beam_log_threshold is set, resampling and the E-step
+    # only pass messages between the states in a beam at each time step
+    # (see rslds.messages).  The fraction of the filtering probability
+    # discarded at each step is kept in pruned_mass; if its sum is not
+    # small, the beam is too narrow.
+    beam_size = None
+    beam_log_threshold = None
+    pruned_mass = None
+
     def __init__(self, covariates, *args, **kwargs):
         self.covariates = covariates
+        self.trans_block_size = kwargs.pop("trans_block_size", None)
+        self.num_time_chunks = kwargs.pop("num_time_chunks", None)
+        self.message_pool = kwargs.pop("message_pool", None)
+        self.beam_size = kwargs.pop("beam_size", None)
+        self.beam_log_threshold = kwargs.pop("beam_log_threshold", None)
         super(InputHMMStates, self).__init__(*args, **kwargs)
 
+    @property
+    def covariates(self):
+        return self._covariates
+
+    @covariates.setter
+    def covariates(self, value):
+        self._covariates = value
+        self._covariates_version += 1
+
+    def _trans_cache_entries(self):
+        """
+        Return the dict of cached transition quantities that are valid for
+        the current parameters and covariates, or None if they can't be cached.
+        """
+        trans_distn = self.model.trans_distn
+        param_version = getattr(trans_distn, "param_version", None)
+        if param_version is None:
+            return None
+
+        key = (param_version, self._covariates_version)
+        cache = self._trans_cache
+        if cache is None or cache[0] is not trans_distn or cache[1] != key:
+            cache = self._trans_cache = (trans_distn, key, {})
+        return cache[2]
+
+    def _cached_trans(self, name, compute):
+        entries = self._trans_cache_entries()
+        if entries is None:
+            return compute()
+
+        if name not in entries:
+            entries[name] = compute()
+        return entries[name]
+
+    def has_cached_trans(self, name):
+        entries = self._trans_cache_entries()
+        return entries is not None and name in entries
+
+    def set_cached_trans(self, name, value):
+        """
+        Store a precomputed transition quantity, e.g. a view into a
+        batch evaluated for many sequences at once.  Returns False if
+        the transition model does not support caching.
+        """
+        entries = self._trans_cache_entries()
+        if entries is None:
+            return False
+        entries[name] = value
+        return True
+
+    def clear_trans_cache(self):
+        self._trans_cache = None
+
     @property
     def trans_matrix(self):
-        return self.model.trans_distn.get_trans_matrices(self.covariates)
+        return self._cached_trans(
+            "trans_matrix",
+            lambda: self.model.trans_distn.get_trans_matrices(self.covariates))
+
+    @property
+    def log_trans_matrix(self):
+        return self._cached_trans(
+            "log_trans_matrix",
+            lambda: self.model.trans_distn.get_log_trans_matrices(self.covariates))
+
+    @property
+    def uses_trans_operator(self):
+        """
+        Message passing uses an implicit transition operator rather than
+        the dense stack if trans_block_size is set or if the transition
+        model has a compact structured representation (e.g. input-only
+        transitions).
+        """
+        trans_distn = self.model.trans_distn
+        use_operator = self.trans_block_size is not None or \
+            getattr(trans_distn, "compact_trans_operator", False)
+        return use_operator and hasattr(trans_distn, "get_trans_operator")
+
+    @property
+    def trans_operator_block_size(self):
+        return self.trans_block_size or 1024
+
+    @property
+    def log_trans_potential(self):
+        """
+        The log transition matrices used for message passing: either the
+        dense stack or an implicit operator (see uses_trans_operator).
+        """
+        if not self.uses_trans_operator:
+            return self.log_trans_matrix
+
+        return self._cached_trans(
+            "log_trans_operator",
+            lambda: self.model.trans_distn.get_trans_operator(
+                self.covariates, block_size=self.trans_operator_block_size))
+
+    ### Message passing directly on the log transition matrices
+    def log_likelihood(self):
+        if self._normalizer is None:
+            self.messages_forwards_log()
+        return self._normalizer
+
+    @property
+    def parallel_messages(self):
+        return self.num_time_chunks is not None and self.num_time_chunks > 1
+
+    @property
+    def compiled_messages(self):
+        """
+        Dense (T-1 x K x K) stacks go through pyhsmm's compiled message
+        passing, which handles time-varying transition matrices.  It takes
+        the transition probabilities, which the transition model computes
+        directly (see trans_matrix), so the log stack is never formed.
+        Implicit operators and parallel chunks use rslds.messages instead.
+        """
+        return not self.parallel_messages and not self.uses_trans_operator
+
+    def messages_forwards_log(self, products=None):
+        if self.compiled_messages:
+            alphal = self._messages_forwards_log(self.trans_matrix, self.pi_0, self.aBl)
+        elif self.parallel_messages:
+            alphal = messages.parallel_messages_forwards_log(
+                self.log_trans_potential, np.log(self.pi_0), self.aBl,
+                self.num_time_chunks, pool=self.message_pool, products=products)
+        else:
+            alphal = messages.messages_forwards_log(
+                self.log_trans_potential, np.log(self.pi_0), self.aBl)
+        assert not np.any(np.isnan(alphal))
+        self._normalizer = logsumexp(alphal[-1])
+        return alphal
+
+    def messages_backwards_log(self, products=None):
+        if self.compiled_messages:
+            betal = self._messages_backwards_log(self.trans_matrix, self.aBl)
+        elif self.parallel_messages:
+            betal = messages.parallel_messages_backwards_log(
+                self.log_trans_potential, self.aBl,
+                self.num_time_chunks, pool=self.message_pool, products=products)
+        else:
+            betal = messages.messages_backwards_log(self.log_trans_potential, self.aBl)
+        assert not np.isnan(betal).any()
+        self._normalizer = logsumexp(np.log(self.pi_0) + betal[0] + self.aBl[0])
+        return betal
+
+    def sample_forwards_log(self, betal, products=None):
+        if self.compiled_messages:
+            self.stateseq = self._sample_forwards_log(
+                betal, self.trans_matrix, self.pi_0, self.aBl)
+        elif self.parallel_messages:
+            self.stateseq = messages.parallel_sample_forwards_log(
+                betal, self.log_trans_potential, np.log(self.pi_0), self.aBl,
+                self.num_time_chunks, pool=self.message_pool, products=products)
+        else:
+            self.stateseq = messages.sample_forwards_log(
+                betal, self.log_trans_potential, np.log(self.pi_0), self.aBl)
+
+    def _chunk_transfer_matrices(self):
+        # Share the chunks' transfer matrices between passes
+        log_trans_potential = self.log_trans_potential
+        if not self.parallel_messages or self.T < 2 or \
+                messages._is_structured(log_trans_potential):
+            return None
+        return messages.chunk_transfer_matrices(
+            log_trans_potential, self.aBl, self.num_time_chunks, pool=self.message_pool)
+
+    @property
+    def pruned_messages(self):
+        return self.beam_size is not None or self.beam_log_threshold is not None
+
+    def pruned_messages_forwards_log(self):
+        alphal, self.pruned_mass = messages.pruned_messages_forwards_log(
+            self.log_trans_potential, np.log(self.pi_0), self.aBl,
+            beam_size=self.beam_size, log_threshold=self.beam_log_threshold)
+        self._normalizer = logsumexp(alphal[-1])
+        return alphal
+
+    def resample_log(self):
+        if self.pruned_messages:
+            alphal = self.pruned_messages_forwards_log()
+            self.stateseq = messages.pruned_sample_backwards_log(
+                alphal, self.log_trans_potential)
+            return
+
+        products = self._chunk_transfer_matrices()
+        betal = self.messages_backwards_log(products=products)
+        self.sample_forwards_log(betal, products=products)
+
+    def resample(self):
+        if not self.fixed_stateseq:
+            return self.resample_log()
+
+    ### Viterbi decoding
+    @property
+    def viterbi_potentials(self):
+        """
+        (log_trans_matrices, log_pi_0, log_likelihoods) to decode
+        """
+        return self.log_trans_potential, np.log(self.pi_0), self.aBl
+
+    def Viterbi(self):
+        self.stateseq, self.viterbi_score = \
+            messages.viterbi_log(*self.viterbi_potentials)
+
+    def E_step(self):
+        """
+        Compute the expected states and the expected transition counts,
+        summed over time into a (K x K) matrix on every message passing path.
+        """
+        self.clear_caches()
+        if self.pruned_messages:
+            alphal = self.pruned_messages_forwards_log()
+            betal = messages.pruned_messages_backwards_log(
+                self.log_trans_potential, self.aBl, alphal)
+            self.all_expected_stats = messages.pruned_expected_statistics_log(
+                self.log_trans_potential, self.aBl, alphal, betal)
+            return
+
+        products = self._chunk_transfer_matrices()
+        alphal = self.messages_forwards_log(products=products)
+        betal = self.messages_backwards_log(products=products)
+        if self.compiled_messages:
+            self.all_expected_stats = messages.expected_statistics(
+                self.trans_matrix, self.aBl, alphal, betal)
+        else:
+            self.all_expected_stats = messages.expected_statistics_log(
+                self.log_trans_potential, self.aBl, alphal, betal)
 
     def generate_states(self, initial_condition=None, with_noise=True, stateseq=None):
         """
@@ -25,11 +287,19 @@ class InputHMMStates(HMMStatesEigen):
         likely discrete state, we randomly sample the discrete statse.
         """
         if stateseq is None:
-            As = self.trans_matrix
             self.stateseq = -1 * np.ones(self.T, dtype=np.int32)
             self.stateseq[0] = np.random.choice(self.num_states)
-            for t in range(1, self.T):
-                self.stateseq[t] = sample_discrete(As[t-1, self.stateseq[t-1], :].ravel())
+
+            log_trans_potential = self.log_trans_potential
+            if hasattr(log_trans_potential, "log_row"):
+                # Only evaluate the rows we need
+                for t in range(1, self.T):
+                    A_row = np.exp(log_trans_potential.log_row(t-1, self.stateseq[t-1]))
+                    self.stateseq[t] = sample_discrete(A_row)
+            else:
+                As = self.trans_matrix
+                for t in range(1, self.T):
+                    self.stateseq[t] = sample_discrete(As[t-1, self.stateseq[t-1], :].ravel())
 
         else:
             assert stateseq.shape == (self.T,)
@@ -51,6 +321,13 @@ class _RecurrentSLDSStatesBase(object):
         if covariates is not None:
             raise NotImplementedError("Not supporting exogenous inputs yet")
 
+        # The SLDS states do not call InputHMMStates.__init__
+        self.trans_block_size = kwargs.pop("trans_block_size", None)
+        self.num_time_chunks = kwargs.pop("num_time_chunks", None)
+        self.message_pool = kwargs.pop("message_pool", None)
+        self.beam_size = kwargs.pop("beam_size", None)
+        self.beam_log_threshold = kwargs.pop("beam_log_threshold", None)
+
         super(_RecurrentSLDSStatesBase, self).\
             __init__(model, data=data, **kwargs)
 
@@ -61,6 +338,24 @@ class _RecurrentSLDSStatesBase(object):
     def trans_distn(self):
         return self.model.trans_distn
 
+    @property
+    def gaussian_states(self):
+        return self._gaussian_states
+
+    @gaussian_states.setter
+    def gaussian_states(self, value):
+        # The covariates are a view of the continuous states
+        self._gaussian_states = value
+        self.covariates = value[:-1]
+
+    def gaussian_states_updated(self):
+        """
+        Call after modifying gaussian_states in place.  The covariates
+        are the continuous states, so this invalidates the transition
+        matrices cached for them.
+        """
+        self.covariates = self.gaussian_states[:-1]
+
     def generate_states(self, initial_condition=None, with_noise=True, stateseq=None):
         """
         Jointly sample the discrete and continuous states
@@ -120,14 +415,10 @@ class PGRecurrentSLDSStates(_RecurrentSLDSStatesBase,
                      stateseq=stateseq, gaussian_states=gaussian_states,
                      **kwargs)
 
-        # Initialize the Polya gamma samplers if they haven't already been set
+        # Initialize the Polya gamma samplers if they haven't already been set.
+        # Use the model's shared pool if it has one.
         if not hasattr(self, 'ppgs'):
-            import pypolyagamma as ppg
-
-            # Initialize the Polya-gamma samplers
-            num_threads = ppg.get_omp_num_threads()
-            seeds = np.random.randint(2 ** 16, size=num_threads)
-            self.ppgs = [ppg.PyPolyaGamma(seed) for seed in seeds]
+            self.ppgs = getattr(model, 'ppgs', None) or polya_gamma_samplers()
 
         # Initialize auxiliary variables for transitions
         self.trans_omegas = np.ones((self.T-1, self.num_states-1))
@@ -149,41 +440,59 @@ class PGRecurrentSLDSStates(_RecurrentSLDSStatesBase,
         # Add the potential from the transitions
         trans_distn, omega = self.trans_distn, self.trans_omegas
 
-        prev_state = one_hot(self.stateseq[:-1], self.num_states)
-        next_state = one_hot(self.stateseq[1:], self.num_states)
-
         A = trans_distn.A[:, :self.num_states]
         C = trans_distn.A[:, self.num_states:self.num_states+self.D_latent]
         # D = trans_distn.A[:, self.num_states+self.D_latent:]
         b = trans_distn.b
 
-        CCT = np.array([np.outer(cp, cp) for cp in C]). \
-            reshape((trans_distn.D_out, self.D_latent ** 2))
+        # J_node[t] = sum_k omega[t,k] c_k c_k^T
+        CCT = (C[:, :, None] * C[:, None, :]).reshape((C.shape[0], self.D_latent ** 2))
         J_node = np.dot(omega, CCT)
 
+        # The activations not explained by the continuous states
+        psi_rest = A.T[self.stateseq[:-1]] + b.T
+        # psi_rest += self.inputs.dot(D.T)
+
+        next_state = one_hot(self.stateseq[1:], self.num_states)
         kappa = trans_distn.kappa_func(next_state[:,:-1])
-        h_node = kappa.dot(C)
-        h_node -= (omega * b.T).dot(C)
-        h_node -= (omega * prev_state.dot(A.T)).dot(C)
-        # h_node[:-1] -= (omega * self.inputs.dot(D.T)).dot(C)
+        h_node = (kappa - omega * psi_rest).dot(C)
 
         # Restore J_node to its original shape
         J_node = J_node.reshape((self.T-1, self.D_latent, self.D_latent))
         return J_node, h_node
 
-    def resample(self, niter=1):
+    def resample(self, niter=1, resample_trans_omegas=True):
+        """
+        :param resample_trans_omegas: if False, leave the transition auxiliary
+                                      variables to the caller, e.g. to draw
+                                      those of all sequences at once
+        """
         super(PGRecurrentSLDSStates, self).resample(niter=niter)
-        self.resample_transition_auxiliary_variables()
+        if resample_trans_omegas:
+            self.resample_transition_auxiliary_variables()
 
     def resample_gaussian_states(self):
-        super(PGRecurrentSLDSStates, self).resample_gaussian_states()
+        if self.parallel_messages:
+            self._aBl = None  # clear any caching
+            self._gaussian_normalizer, self.gaussian_states = \
+                info_messages.parallel_info_sample(
+                    *self.info_params, num_chunks=self.num_time_chunks,
+                    pool=self.message_pool)
+        else:
+            super(PGRecurrentSLDSStates, self).resample_gaussian_states()
         self.covariates = self.gaussian_states[:-1].copy()
 
-    def resample_transition_auxiliary_variables(self):
-        # Resample the auxiliary variable for the transition matrix
+    def trans_omega_params(self, start=0, stop=None):
+        """
+        Return the Polya-gamma shape and tilting parameters, (b_pg, psi),
+        of the transition auxiliary variables given the current states.
+
+        :param start, stop: only return those of transitions start:stop
+        """
         trans_distn = self.trans_distn
-        prev_state = one_hot(self.stateseq[:-1], self.num_states)
-        next_state = one_hot(self.stateseq[1:], self.num_states)
+        stop = self.T - 1 if stop is None else stop
+        prev_state = one_hot(self.stateseq[start:stop], self.num_states)
+        next_state = one_hot(self.stateseq[start+1:stop+1], self.num_states)
 
         A = trans_distn.A[:, :self.num_states]
         C = trans_distn.A[:, self.num_states:self.num_states + self.D_latent]
@@ -191,15 +500,194 @@ class PGRecurrentSLDSStates(_RecurrentSLDSStatesBase,
         b = trans_distn.b
 
         psi = prev_state.dot(A.T) \
-              + self.covariates.dot(C.T) \
+              + self.covariates[start:stop].dot(C.T) \
               + b.T \
               # + self.inputs.dot(D.T) \
 
         b_pg = trans_distn.b_func(next_state[:,:-1])
+        return b_pg, psi
+
+    def resample_transition_auxiliary_variables(self):
+        # Resample the auxiliary variable for the transition matrix
+        b_pg, psi = self.trans_omega_params()
 
         import pypolyagamma as ppg
         ppg.pgdrawvpar(self.ppgs, b_pg.ravel(), psi.ravel(), self.trans_omegas.ravel())
 
+    ### Windowed block Gibbs
+    # Resample the discrete states, continuous states and transition
+    # auxiliary variables of a window of time steps given the states on
+    # either side of it.  Only the window's transition matrices and
+    # information-form potentials are formed, and only the window's rows of
+    # aBl are updated, so the cost of a window does not depend on T.
+    # Windows that do not touch (e.g. every other window) are conditionally
+    # independent given the rest.
+    def window_bounds(self, window_size, offset=0):
+        """
+        Split 0..T into consecutive windows of at most window_size steps.
+
+        :param offset: start of the second window, so that the window
+                       edges can be moved between sweeps
+        :return: list of (start, stop) pairs
+        """
+        starts = np.unique(np.concatenate(
+            ([0], np.arange(offset % window_size, self.T, window_size))))
+        stops = np.append(starts[1:], self.T)
+        return list(zip(starts, stops))
+
+    def resample_windowed(self, window_size, order="cycle"):
+        """
+        One Gibbs sweep made of block updates of windows of time steps.
+
+        :param window_size: number of time steps per window
+        :param order:       "cycle" to visit the windows from left to right,
+                            "random" to draw a new offset of the window edges
+                            and visit the windows in a random order
+        """
+        if order == "cycle":
+            windows = self.window_bounds(window_size)
+        elif order == "random":
+            windows = self.window_bounds(window_size, np.random.randint(window_size))
+            windows = [windows[i] for i in np.random.permutation(len(windows))]
+        else:
+            raise ValueError("order must be 'cycle' or 'random'")
+
+        for start, stop in windows:
+            self.resample_window(start, stop)
+
+    def resample_window(self, start, stop):
+        """
+        Resample the states in time steps start:stop given those outside,
+        along with the auxiliary variables of the transitions that touch them.
+        """
+        assert 0 <= start < stop <= self.T
+        self.resample_discrete_window(start, stop)
+        self.resample_gaussian_window(start, stop)
+        self.resample_trans_omegas_window(start, stop)
+
+    def smooth_window(self, start, stop):
+        """
+        Smooth the states in time steps start:stop given those outside.
+
+        :return: marginal probabilities of the discrete states given the
+                 continuous states, and means of the continuous states
+                 given the discrete states and auxiliary variables
+        """
+        log_trans, log_pi_0, aBl = self._window_discrete_potentials(start, stop)
+        alphal = messages.messages_forwards_log(log_trans, log_pi_0, aBl)
+        betal = messages.messages_backwards_log(log_trans, aBl)
+        expected_states = np.exp(alphal + betal - (alphal + betal).max(1)[:, None])
+        expected_states /= expected_states.sum(1)[:, None]
+
+        _, mus, _, _ = info_messages.parallel_info_E_step(
+            *self._window_gaussian_potentials(start, stop),
+            num_chunks=self.num_time_chunks or 1, pool=self.message_pool)
+        return expected_states, mus
+
+    def _window_discrete_potentials(self, start, stop):
+        T, z = self.T, self.stateseq
+
+        # Transitions into z[start] through z[stop], where they exist
+        log_trans = self.trans_distn.get_log_trans_matrices(
+            self.covariates[max(start-1, 0):min(stop, T-1)])
+        aBl = self.aBl[start:stop].copy()
+
+        if start > 0:
+            log_pi_0 = log_trans[0, z[start-1]]
+            log_trans = log_trans[1:]
+        else:
+            log_pi_0 = np.log(self.pi_0)
+
+        if stop < T:
+            aBl[-1] += log_trans[-1][:, z[stop]]
+            log_trans = log_trans[:-1]
+
+        return log_trans, log_pi_0, aBl
+
+    def _window_view(self, lo, hi):
+        """
+        A shallow copy of these states restricted to time steps lo:hi, so
+        that the pyslds potentials and likelihoods can be evaluated there.
+        """
+        view = copy.copy(self)
+        view.T = hi - lo
+        for name in ("stateseq", "data", "inputs", "mask", "omega"):
+            if getattr(self, name, None) is not None:
+                setattr(view, name, getattr(self, name)[lo:hi])
+        view.gaussian_states = self.gaussian_states[lo:hi]
+        view.trans_omegas = self.trans_omegas[lo:hi-1]
+        view.clear_caches()
+        return view
+
+    def _window_gaussian_potentials(self, start, stop):
+        T, x = self.T, self.gaussian_states
+
+        # Potentials of time steps start-1 through stop, where they exist
+        lo, hi = max(start-1, 0), min(stop+1, T)
+        init, pairs, nodes = info_messages._info_params(
+            *self._window_view(lo, hi).info_params)
+        J_11, J_21, J_22, h_1, h_2, _ = pairs
+        J_node, h_node, log_Z_node = info_messages._slice(nodes, start-lo, stop-lo)
+        J_node, h_node = J_node.copy(), h_node.copy()
+
+        # Condition on the continuous states on either side of the window
+        if start > 0:
+            J_init = J_22[0]
+            h_init = h_2[0] - J_21[0].dot(x[start-1])
+        else:
+            J_init, h_init = init[0], init[1]
+
+        if stop < T:
+            J_node[-1] += J_11[stop-1-lo]
+            h_node[-1] += h_1[stop-1-lo] - J_21[stop-1-lo].T.dot(x[stop])
+
+        return (J_init, h_init, 0) + info_messages._slice(pairs, start-lo, stop-1-lo) \
+            + (J_node, h_node, log_Z_node)
+
+    def _update_window_aBl(self, start, stop):
+        """
+        Recompute the rows of aBl that depend on the continuous states
+        in time steps start:stop, i.e. rows start-1 through stop-1.
+        """
+        if self._aBl is None:
+            return
+
+        # Start the view a step early so that its first row, which holds
+        # the initial state likelihood, is only used if it is row 0
+        first = max(start-1, 0)
+        lo, hi = max(start-2, 0), min(stop+1, self.T)
+        aBl = self._window_view(lo, hi).aBl
+        self._aBl[first:stop] = aBl[first-lo:stop-lo]
+
+    def resample_discrete_window(self, start, stop):
+        log_trans, log_pi_0, aBl = self._window_discrete_potentials(start, stop)
+        betal = messages.messages_backwards_log(log_trans, aBl)
+        self.stateseq[start:stop] = \
+            messages.sample_forwards_log(betal, log_trans, log_pi_0, aBl)
+
+    def resample_gaussian_window(self, start, stop):
+        x = self.gaussian_states
+        _, x[start:stop] = info_messages.parallel_info_sample(
+            *self._window_gaussian_potentials(start, stop),
+            num_chunks=self.num_time_chunks or 1, pool=self.message_pool)
+
+        # The likelihoods depend on the continuous states
+        self._update_window_aBl(start, stop)
+        self.gaussian_states_updated()
+
+    def resample_trans_omegas_window(self, start, stop):
+        # Transitions start-1 through stop-1 involve the window's states
+        lo, hi = max(start-1, 0), min(stop, self.T-1)
+        if hi <= lo:
+            return
+
+        b_pg, psi = self.trans_omega_params(lo, hi)
+        omegas = np.empty(b_pg.size)
+
+        import pypolyagamma as ppg
+        ppg.pgdrawvpar(self.ppgs, b_pg.ravel().astype(float), psi.ravel(), omegas)
+        self.trans_omegas[lo:hi] = omegas.reshape(b_pg.shape)
+
 
 ##
 # Recurrent SLDS with softmax transition model.
@@ -212,44 +700,274 @@ class _SoftmaxRecurrentSLDSStatesBase(_RecurrentSLDSStatesBase,
     """
     Implement variational EM with the JJ96 lower bound to update q(z) and q(x)
     """
+    # If estep_block_size is set, or estep_checkpoint is True, the discrete
+    # state E-step forms the joint probabilities of consecutive states one
+    # block of time steps at a time rather than as (T-1 x K x K) temporaries,
+    # and with estep_checkpoint it only keeps the forward messages at the
+    # block boundaries (see rslds.messages.expected_statistics_blocked).
+    # Either option also turns off store_expected_joints by default, so
+    # the full (T-1 x K x K) expected_joints is never allocated.
+    estep_block_size = None
+    estep_checkpoint = False
+
+    # If store_expected_joints is False, the E-step only keeps the time sums
+    # of the joint probabilities of consecutive states, which is all the
+    # transition statistics need.  expected_joints is then recomputed from
+    # the last E-step's potentials whenever it is accessed.  The potentials
+    # are kept either way, since Viterbi decodes q(z) with them too.
+    # If it is left unset (None), the joints are stored unless one of the
+    # low-memory E-step options above is set, so that those options never
+    # allocate the (T-1 x K x K) array.  Set it to True to store them anyway.
+    _store_expected_joints = None
+    _expected_joints = None
+    _discrete_potentials = None
+
+    # The auxiliary variables of the JJ96 bound, a and bs, are updated by
+    # block coordinate ascent for at most aux_max_iter rounds.  A time step
+    # drops out of the active set once its a and bs change by less than
+    # aux_tol in a round, and the rounds stop when no time steps are left.
+    # With aux_tol = None every time step gets all aux_max_iter rounds.
+    # The number of rounds each time step took is kept in aux_num_iters.
+    aux_max_iter = 10
+    aux_tol = 1e-6
+    aux_num_iters = None
+
+    _E_xxT_cache = None
+
     def __init__(self, model, **kwargs):
+        self.estep_block_size = kwargs.pop("estep_block_size", None)
+        self.estep_checkpoint = kwargs.pop("estep_checkpoint", False)
+        self.store_expected_joints = kwargs.pop("store_expected_joints", None)
+        self.aux_max_iter = kwargs.pop("aux_max_iter", 10)
+        self.aux_tol = kwargs.pop("aux_tol", 1e-6)
+
         super(_SoftmaxRecurrentSLDSStatesBase, self).__init__(model, **kwargs)
         self.a = np.zeros((self.T - 1,))
         self.bs = np.ones((self.T - 1, self.num_states))
 
+    @property
+    def E_xxT(self):
+        """
+        (T x D x D) second moments E[x_t x_t^T] under q(x).  They are
+        computed once per update of q(x), i.e. of the smoothed moments.
+        """
+        mus, sigmas = self.smoothed_mus, self.smoothed_sigmas
+        cache = self._E_xxT_cache
+        if cache is None or cache[0] is not mus or cache[1] is not sigmas:
+            cache = self._E_xxT_cache = \
+                (mus, sigmas, sigmas + mus[:, :, None] * mus[:, None, :])
+        return cache[2]
+
+    @staticmethod
+    def _jj_lambda(bs):
+        return 0.5 / bs * (logistic(bs) - 0.5)
+
     @property
     def lambda_bs(self):
-        return 0.5 / self.bs * (logistic(self.bs) - 0.5)
+        return self._jj_lambda(self.bs)
 
-    def _set_expected_trans_stats(self):
+    def _update_auxiliary_vars(self, m, s, n_iter=None, tol=None):
         """
-        Compute the expected stats for updating the transition distn
-        stats = E_u_zp1T, E_uuT, E_u, a, lambda_bs
+        Block coordinate updates of a and bs, given m_{tk} = E[v_{tk}]
+        and s_{tk} = E[v_{tk}^2], only updating the time steps that
+        have not converged yet.
+
+        :return: the number of rounds run
         """
-        T, D, K = self.T, self.D_latent, self.num_states
+        K = self.num_states
+        n_iter = self.aux_max_iter if n_iter is None else n_iter
+        tol = self.aux_tol if tol is None else tol
+
+        a, bs = self.a.copy(), self.bs.copy()
+        num_iters = np.zeros(a.shape[0], dtype=int)
+        active = np.arange(a.shape[0])
+        for itr in range(n_iter):
+            if active.size == 0:
+                break
+
+            m_act, s_act, bs_act = m[active], s[active], bs[active]
+            lambda_bs = self._jj_lambda(bs_act)
+
+            # Eq (42)
+            a_act = 2 * (m_act * lambda_bs).sum(axis=1) + K / 2.0 - 1.0
+            a_act /= 2 * lambda_bs.sum(axis=1)
+
+            # Eq (43)
+            bs_act = np.sqrt(s_act - 2 * m_act * a_act[:, None] + a_act[:, None] ** 2)
 
+            # Drop the time steps that have converged
+            change = np.maximum(abs(a_act - a[active]), abs(bs_act - bs[active]).max(axis=1))
+            a[active], bs[active] = a_act, bs_act
+            num_iters[active] += 1
+            if tol is not None:
+                active = active[change >= tol]
+
+        self.a, self.bs = a, bs
+        self.aux_num_iters = num_iters
+        return num_iters.max() if num_iters.size > 0 else 0
+
+    @property
+    def low_memory_estep(self):
+        return self.estep_block_size is not None or self.estep_checkpoint
+
+    @property
+    def store_expected_joints(self):
+        if self._store_expected_joints is None:
+            return not self.low_memory_estep
+        return self._store_expected_joints
+
+    @store_expected_joints.setter
+    def store_expected_joints(self, value):
+        self._store_expected_joints = value
+
+    @property
+    def expected_joints(self):
+        """
+        (T-1 x K x K) joint probabilities of consecutive discrete states
+        """
+        if self._expected_joints is not None:
+            return self._expected_joints
+        elif self._discrete_potentials is not None and self.pruned_messages:
+            return self._pruned_expected_stats(
+                *self._discrete_potentials, store_joints=True)[1]
+        elif self._discrete_potentials is not None:
+            return self._blocked_expected_stats(
+                *self._discrete_potentials, store_joints=True)[1]
+
+        # Initialized from a single state sequence
         E_z = self.expected_states
-        E_z_zp1T = self.expected_joints
-        E_x = self.smoothed_mus
-        E_x_xT = self.smoothed_sigmas + E_x[:, :, None] * E_x[:, None, :]
+        return E_z[:-1, :, None] * E_z[1:, None, :]
+
+    @expected_joints.setter
+    def expected_joints(self, value):
+        self._expected_joints = value
+
+    def _blocked_expected_stats(self, trans_potential, init_potential, likelihood_potential,
+                                store_joints):
+        T, K = self.T, self.num_states
+        expected_joints = np.empty((T - 1, K, K)) if store_joints else None
+
+        def _store_joints(start, stop, joints):
+            expected_joints[start:stop] = joints
+
+        expected_states, expected_transcounts, normalizer = \
+            messages.expected_statistics_blocked(
+                np.log(trans_potential), np.log(init_potential), likelihood_potential,
+                block_size=self.estep_block_size, checkpoint=self.estep_checkpoint,
+                joints_callback=_store_joints if store_joints else None)
+        return expected_states, expected_joints, expected_transcounts, normalizer
+
+    def _pruned_expected_stats(self, trans_potential, init_potential, likelihood_potential,
+                               store_joints):
+        T, K = self.T, self.num_states
+        log_trans = np.log(trans_potential)
+        alphal, self.pruned_mass = messages.pruned_messages_forwards_log(
+            log_trans, np.log(init_potential), likelihood_potential,
+            beam_size=self.beam_size, log_threshold=self.beam_log_threshold)
+        betal = messages.pruned_messages_backwards_log(log_trans, likelihood_potential, alphal)
+
+        expected_joints = np.empty((T - 1, K, K)) if store_joints else None
+
+        def _store_joints(start, stop, joints):
+            expected_joints[start:stop] = joints
+
+        expected_states, expected_transcounts, normalizer = \
+            messages.pruned_expected_statistics_log(
+                log_trans, likelihood_potential, alphal, betal,
+                joints_callback=_store_joints if store_joints else None)
+        return expected_states, expected_joints, expected_transcounts, normalizer
+
+    def _discrete_expected_stats(self, trans_potential, init_potential, likelihood_potential):
+        """
+        Run the message passing algorithm for the discrete states.
 
-        # Combine to get trans stats
-        # E_u = [E[z], E[x]]
-        E_u = np.concatenate((E_z[:-1], E_x[:-1]), axis=1)
+        :return: expected_states, expected_joints, expected_transcounts, normalizer.
+                 expected_joints is None unless store_expected_joints is True.
+        """
+        self._discrete_potentials = \
+            (trans_potential, init_potential, likelihood_potential)
+        if self.pruned_messages:
+            return self._pruned_expected_stats(
+                trans_potential, init_potential, likelihood_potential,
+                store_joints=self.store_expected_joints)
+        if not self.store_expected_joints:
+            return self._blocked_expected_stats(
+                trans_potential, init_potential, likelihood_potential, store_joints=False)
+        if self.low_memory_estep:
+            return self._blocked_expected_stats(
+                trans_potential, init_potential, likelihood_potential, store_joints=True)
+
+        alphal = self._messages_forwards_log(trans_potential, init_potential, likelihood_potential)
+        betal = self._messages_backwards_log(trans_potential, likelihood_potential)
+
+        # Convert messages into expectations
+        expected_states = alphal + betal
+        expected_states -= expected_states.max(1)[:, None]
+        np.exp(expected_states, out=expected_states)
+        expected_states /= expected_states.sum(1)[:, None]
+
+        Al = np.log(trans_potential)
+        log_joints = alphal[:-1, :, None] + betal[1:, None, :] \
+            + likelihood_potential[1:, None, :] + Al[None, :, :]
+        log_joints -= log_joints.max(axis=(1, 2), keepdims=True)
+        joints = np.exp(log_joints)
+        joints /= joints.sum(axis=(1, 2), keepdims=True)
+
+        # Compute the log normalizer log p(x_{1:T} | \theta, a, b)
+        normalizer = logsumexp(alphal[0] + betal[0])
+        return expected_states, joints, joints.sum(0), normalizer
+
+    @property
+    def viterbi_potentials(self):
+        """
+        After an E-step, decode the variational posterior q(z) with the
+        potentials of that E-step's message passing.  Before that, fall
+        back to the transitions and likelihoods at the current x.
+        """
+        if self._discrete_potentials is None:
+            return super(_SoftmaxRecurrentSLDSStatesBase, self).viterbi_potentials
+
+        trans_potential, init_potential, likelihood_potential = self._discrete_potentials
+        return np.log(trans_potential), np.log(init_potential), likelihood_potential
+
+    def _set_expected_trans_stats(self):
+        """
+        Compute the expected stats for updating the transition distn.
+        With u_t = [z_t, x_t], the update of output k has natural parameters
+
+            J_k = J_0 + 2 sum_t lambda_{tk} E[u_t u_t^T]
+            h_k = h_0 + sum_t E[u_t z_{t+1,k}] - sum_t (1/2 - 2 lambda_{tk} a_t) E[u_t]
 
-        # E_u_zp1T = [ E[z zp1^T],  E[x, zp1^T] ]
-        E_x_zp1T = E_x[:-1, :, None] * E_z[1:, None, :]
-        E_u_zp1T = np.concatenate((E_z_zp1T, E_x_zp1T), axis=1)
+        so the states only keep the contracted sums, which don't grow with T.
 
+        stats = J_stats (K x K+D x K+D), h_stats (K x K+D)
+        """
+        D, K = self.D_latent, self.num_states
+
+        E_z = self.expected_states[:-1]
+        E_x = self.smoothed_mus[:-1]
+        E_x_xT = self.E_xxT[:-1]
+        lambda_bs = self.lambda_bs
+
+        # sum_t lambda_{tk} E[u_t u_t^T] where
         # E_uuT = [[ diag(E[z]),  E[z]E[x^T] ]
         #          [ E[x]E[z^T],  E[xxT]     ]]
-        E_u_uT = np.zeros((T - 1, K + D, K + D))
-        E_u_uT[:, np.arange(K), np.arange(K)] = E_z[:-1]
-        E_u_uT[:, :K, K:] = E_z[:-1, :, None] * E_x[:-1, None, :]
-        E_u_uT[:, K:, :K] = E_x[:-1, :, None] * E_z[:-1, None, :]
-        E_u_uT[:, K:, K:] = E_x_xT[:-1]
+        J_stats = np.zeros((K, K + D, K + D))
+        J_stats[:, np.arange(K), np.arange(K)] = lambda_bs.T.dot(E_z)
+        J_stats[:, :K, K:] = np.einsum('tk, ti, td -> kid', lambda_bs, E_z, E_x)
+        J_stats[:, K:, :K] = np.swapaxes(J_stats[:, :K, K:], 1, 2)
+        J_stats[:, K:, K:] = np.einsum('tk, tij -> kij', lambda_bs, E_x_xT)
+        J_stats *= 2
 
-        self.E_trans_stats = (E_u_zp1T, E_u_uT, E_u, self.a, self.lambda_bs)
+        # sum_t E[u_t z_{t+1}^T] = [ E[z zp1^T],  E[x, zp1^T] ] summed over time
+        E_u_zp1T = np.concatenate(
+            (self.expected_transcounts, E_x.T.dot(self.expected_states[1:])), axis=0)
+
+        # E_u = [E[z], E[x]]
+        E_u = np.concatenate((E_z, E_x), axis=1)
+        h_stats = E_u_zp1T.T - (0.5 - 2 * lambda_bs * self.a[:, None]).T.dot(E_u)
+
+        self.E_trans_stats = (J_stats, h_stats)
 
 
 class _SoftmaxRecurrentSLDSStatesMeanField(_SoftmaxRecurrentSLDSStatesBase):
@@ -305,8 +1023,7 @@ class _SoftmaxRecurrentSLDSStatesMeanField(_SoftmaxRecurrentSLDSStatesBase):
         E_W = self.trans_distn.expected_W
         E_logpi = self.trans_distn.expected_logpi
         E_logpi_WT = self.trans_distn.expected_logpi_WT
-        E_logpi_logpiT = self.trans_distn.expected_logpi_logpiT
-        E_logpisq = np.array([np.diag(Pk) for Pk in E_logpi_logpiT]).T
+        E_logpisq = self.trans_distn.expected_logpi_sq
 
         aBl[1:] += E_x[:-1].dot(E_W)
 
@@ -325,21 +1042,23 @@ class _SoftmaxRecurrentSLDSStatesMeanField(_SoftmaxRecurrentSLDSStatesBase):
         return aBl
 
     ### Updates for auxiliary variables of JJ96 bound (a and bs)
-    def meanfield_update_auxiliary_vars(self, n_iter=10):
+    def meanfield_update_auxiliary_vars(self, n_iter=None, tol=None):
         """
         Update a and bs via block coordinate updates
+
+        :param n_iter: maximum number of rounds (default: aux_max_iter)
+        :param tol:    convergence tolerance (default: aux_tol)
+        :return:       the number of rounds run
         """
-        K = self.num_states
         E_z = self.expected_states
         E_z /= E_z.sum(1, keepdims=True)
         E_x = self.smoothed_mus
-        E_xxT = self.smoothed_sigmas + E_x[:,:,None] * E_x[:,None,:]
+        E_xxT = self.E_xxT
         E_logpi = self.trans_distn.expected_logpi
         E_W = self.trans_distn.expected_W
         E_WWT = self.trans_distn.expected_WWT
         E_logpi_WT = self.trans_distn.expected_logpi_WT
-        E_logpi_logpiT = self.trans_distn.expected_logpi_logpiT
-        E_logpi_sq = np.array([np.diag(Pk) for Pk in E_logpi_logpiT]).T
+        E_logpi_sq = self.trans_distn.expected_logpi_sq
 
         # Compute m_{tk} = E[v_{tk}]
         m = E_z[:-1].dot(E_logpi) + E_x[:-1].dot(E_W)
@@ -371,15 +1090,20 @@ class _SoftmaxRecurrentSLDSStatesMeanField(_SoftmaxRecurrentSLDSStatesBase):
         # s_{tk} = E[v_{tk}^2]
         s = psi_1 + psi_2 + psi_3
         assert np.all(s > 0)
-        for itr in range(n_iter):
-            lambda_bs = self.lambda_bs
+        return self._update_auxiliary_vars(m, s, n_iter=n_iter, tol=tol)
 
-            # Eq (42)
-            self.a = 2 * (m * lambda_bs).sum(axis=1) + K / 2.0 - 1.0
-            self.a /= 2 * lambda_bs.sum(axis=1)
+    def meanfield_update_gaussian_states(self):
+        if not self.parallel_messages:
+            return super(_SoftmaxRecurrentSLDSStatesMeanField, self).\
+                meanfield_update_gaussian_states()
 
-            # Eq (43)
-            self.bs = np.sqrt(s - 2 * m * self.a[:, None] + self.a[:, None] ** 2)
+        self._mf_lds_normalizer, self.smoothed_mus, self.smoothed_sigmas, \
+            E_xtp1_xtT = info_messages.parallel_info_E_step(
+                *self.expected_info_params, num_chunks=self.num_time_chunks,
+                pool=self.message_pool)
+
+        self._set_gaussian_expected_stats(
+            self.smoothed_mus, self.smoothed_sigmas, E_xtp1_xtT)
 
     def meanfield_update_discrete_states(self):
         """
@@ -391,30 +1115,13 @@ class _SoftmaxRecurrentSLDSStatesMeanField(_SoftmaxRecurrentSLDSStatesBase):
         trans_potential = self.trans_distn.exp_expected_logpi
         init_potential = self.mf_pi_0
         likelihood_potential = self.mf_aBl
-        alphal = self._messages_forwards_log(trans_potential, init_potential, likelihood_potential)
-        betal = self._messages_backwards_log(trans_potential, likelihood_potential)
-
-        # Convert messages into expectations
-        expected_states = alphal + betal
-        expected_states -= expected_states.max(1)[:, None]
-        np.exp(expected_states, out=expected_states)
-        expected_states /= expected_states.sum(1)[:, None]
-
-        Al = np.log(trans_potential)
-        log_joints = alphal[:-1, :, None] + betal[1:, None, :] \
-                     + likelihood_potential[1:, None, :] \
-                     + Al[None, ...]
-        log_joints -= log_joints.max(axis=(1, 2), keepdims=True)
-        joints = np.exp(log_joints)
-        joints /= joints.sum(axis=(1, 2), keepdims=True)
-
-        # Compute the log normalizer log p(x_{1:T} | \theta, a, b)
-        normalizer = logsumexp(alphal[0] + betal[0])
+        expected_states, joints, expected_transcounts, normalizer = \
+            self._discrete_expected_stats(trans_potential, init_potential, likelihood_potential)
 
         # Save expected statistics
         self.expected_states = expected_states
         self.expected_joints = joints
-        self.expected_transcounts = joints.sum(0)
+        self.expected_transcounts = expected_transcounts
         self._normalizer = normalizer
 
         # Update the "stateseq" variable too
@@ -456,7 +1163,9 @@ class _SoftmaxRecurrentSLDSStatesMeanField(_SoftmaxRecurrentSLDSStatesBase):
     def _init_mf_from_gibbs(self):
         super(_SoftmaxRecurrentSLDSStatesBase, self)._init_mf_from_gibbs()
         self.meanfield_update_auxiliary_vars()
-        self.expected_joints = self.expected_states[:-1, :, None] * self.expected_states[1:, None, :]
+        self._discrete_potentials = self.expected_joints = None
+        if self.store_expected_joints:
+            self.expected_joints = self.expected_states[:-1, :, None] * self.expected_states[1:, None, :]
         self._mf_param_snapshot = \
             (self.trans_distn.expected_logpi, np.log(self.mf_pi_0),
              self.mf_aBl, self._normalizer)
@@ -479,9 +1188,8 @@ class _SoftmaxRecurrentSLDSStatesVBEM(_SoftmaxRecurrentSLDSStatesBase):
         """
         E_z = self.expected_states
         W = self.trans_distn.W
-        WWT = np.array([np.outer(wk, wk) for wk in W.T])
-        logpi = self.trans_distn.logpi
-        logpi_WT = np.array([np.outer(lpk, wk) for lpk, wk in zip(logpi.T, W.T)])
+        WWT = self.trans_distn.WWT
+        logpi_WT = self.trans_distn.logpi_WT
 
         # Eq (24) 2 * E[ W diag(lambda(b_t)) W^\trans ]
         J_rec = np.zeros((self.T, self.D_latent, self.D_latent))
@@ -524,8 +1232,8 @@ class _SoftmaxRecurrentSLDSStatesVBEM(_SoftmaxRecurrentSLDSStatesBase):
         E_x = self.smoothed_mus
         W = self.trans_distn.W
         logpi = self.trans_distn.logpi
-        logpi_WT = np.array([np.outer(lpk, wk) for lpk, wk in zip(logpi.T, W.T)])
-        logpisq = logpi**2
+        logpi_WT = self.trans_distn.logpi_WT
+        logpisq = self.trans_distn.logpi_sq
 
         aBl[1:] += E_x[:-1].dot(W)
 
@@ -544,20 +1252,23 @@ class _SoftmaxRecurrentSLDSStatesVBEM(_SoftmaxRecurrentSLDSStatesBase):
         return aBl
 
     ### Updates for auxiliary variables of JJ96 bound (a and bs)
-    def vbem_update_auxiliary_vars(self, n_iter=10):
+    def vbem_update_auxiliary_vars(self, n_iter=None, tol=None):
         """
         Update a and bs via block coordinate updates
+
+        :param n_iter: maximum number of rounds (default: aux_max_iter)
+        :param tol:    convergence tolerance (default: aux_tol)
+        :return:       the number of rounds run
         """
-        K = self.num_states
         E_z = self.expected_states
         E_z /= E_z.sum(1, keepdims=True)
         E_x = self.smoothed_mus
-        E_xxT = self.smoothed_sigmas + E_x[:,:,None] * E_x[:,None,:]
+        E_xxT = self.E_xxT
         logpi = self.trans_distn.logpi
         W = self.trans_distn.W
-        WWT = np.array([np.outer(wk, wk) for wk in W.T])
-        logpi_WT = np.array([np.outer(lpk, wk) for lpk, wk in zip(logpi.T, W.T)])
-        logpi_sq = logpi**2
+        WWT = self.trans_distn.WWT
+        logpi_WT = self.trans_distn.logpi_WT
+        logpi_sq = self.trans_distn.logpi_sq
 
         # Compute m_{tk} = E[v_{tk}]
         m = E_z[:-1].dot(logpi) + E_x[:-1].dot(W)
@@ -589,15 +1300,7 @@ class _SoftmaxRecurrentSLDSStatesVBEM(_SoftmaxRecurrentSLDSStatesBase):
         # s_{tk} = E[v_{tk}^2]
         s = psi_1 + psi_2 + psi_3
         assert np.all(s >= 0)
-        for itr in range(n_iter):
-            lambda_bs = self.lambda_bs
-
-            # Eq (42)
-            self.a = 2 * (m * lambda_bs).sum(axis=1) + K / 2.0 - 1.0
-            self.a /= 2 * lambda_bs.sum(axis=1)
-
-            # Eq (43)
-            self.bs = np.sqrt(s - 2 * m * self.a[:, None] + self.a[:, None] ** 2)
+        return self._update_auxiliary_vars(m, s, n_iter=n_iter, tol=tol)
 
     def vb_E_step_discrete_states(self):
         """
@@ -609,29 +1312,13 @@ class _SoftmaxRecurrentSLDSStatesVBEM(_SoftmaxRecurrentSLDSStatesBase):
         trans_potential = np.exp(self.trans_distn.logpi)
         init_potential = self.pi_0
         likelihood_potential = self.vbem_aBl
-        alphal = self._messages_forwards_log(trans_potential, init_potential, likelihood_potential)
-        betal = self._messages_backwards_log(trans_potential, likelihood_potential)
-
-        # Convert messages into expectations
-        expected_states = alphal + betal
-        expected_states -= expected_states.max(1)[:, None]
-        np.exp(expected_states, out=expected_states)
-        expected_states /= expected_states.sum(1)[:, None]
-
-        Al = np.log(trans_potential)
-        log_joints = alphal[:-1, :, None] + betal[1:, None, :] \
-            + likelihood_potential[1:, None, :] + Al[None, :, :]
-        log_joints -= log_joints.max(axis=(1, 2), keepdims=True)
-        joints = np.exp(log_joints)
-        joints /= joints.sum(axis=(1, 2), keepdims=True)
-
-        # Compute the log normalizer log p(x_{1:T} | \theta, a, b)
-        normalizer = logsumexp(alphal[0] + betal[0])
+        expected_states, joints, expected_transcounts, normalizer = \
+            self._discrete_expected_stats(trans_potential, init_potential, likelihood_potential)
 
         # Save expected statistics
         self.expected_states = expected_states
         self.expected_joints = joints
-        self.expected_transcounts = joints.sum(0)
+        self.expected_transcounts = expected_transcounts
         self._normalizer = normalizer
 
         # Update the "stateseq" variable too
@@ -650,7 +1337,7 @@ class _SoftmaxRecurrentSLDSStatesVBEM(_SoftmaxRecurrentSLDSStatesBase):
         # E_{q(z)}[log p(z)]
         # todo: fix this to computed expected VLB instead
         elp = np.dot(self.expected_states[0], np.log(self.pi_0))
-        elp += np.sum(self.expected_joints * np.log(self.trans_matrix + 1e-16))
+        elp += np.sum(self.expected_joints * self.log_trans_matrix)
 
         # E_{q(x)}[log p(y, x | z)]  is given by aBl
         # To get E_{q(x)}[ aBl ] we multiply and sum
@@ -660,7 +1347,9 @@ class _SoftmaxRecurrentSLDSStatesVBEM(_SoftmaxRecurrentSLDSStatesBase):
     def _init_vbem_from_gibbs(self):
         super(_SoftmaxRecurrentSLDSStatesBase, self)._init_mf_from_gibbs()
         self.vbem_update_auxiliary_vars()
-        self.expected_joints = self.expected_states[:-1, :, None] * self.expected_states[1:, None, :]
+        self._discrete_potentials = self.expected_joints = None
+        if self.store_expected_joints:
+            self.expected_joints = self.expected_states[:-1, :, None] * self.expected_states[1:, None, :]
         self._set_expected_trans_stats()
 
 
@@ -1,8 +1,229 @@
+import copy
+import itertools
 import numpy as np
-from pypolyagamma import MultinomialRegression
-from rslds.util import psi_to_pi, one_hot
+from pypolyagamma import MultinomialRegression, pgdrawvpar
+from pypolyagamma.utils import sample_gaussian
+from rslds.util import psi_to_pi, one_hot, log_logistic
 
-class InputHMMTransitions(MultinomialRegression):
+# Versions are drawn from a single counter so that they are
+# unique across transition objects, not just within one.
+_param_versions = itertools.count(1)
+
+class _VersionedParamsMixin(object):
+    """
+    Keep a version number that changes whenever the transition
+    parameters are updated. States use it to cache the transition
+    matrices they derive from the parameters.  Code that modifies
+    the parameters in place should call params_updated().
+    """
+    _param_version = 0
+
+    @property
+    def param_version(self):
+        return self._param_version
+
+    def params_updated(self):
+        self._param_version = next(_param_versions)
+
+
+def _grouped_sums(keys, values, num_groups):
+    """
+    Sum the rows of values that share the same integer key.
+
+    :param keys:       length T array of keys in [0, num_groups)
+    :param values:     (T x ...) array
+    :param num_groups: number of keys
+    :return:           (num_groups x ...) array of sums
+    """
+    sums = np.zeros((num_groups,) + values.shape[1:])
+    counts = np.bincount(keys, minlength=num_groups)
+    if counts.sum() == 0:
+        return sums
+
+    order = np.argsort(keys, kind="mergesort")
+    starts = np.cumsum(counts) - counts
+    occupied = counts > 0
+    sums[occupied] = np.add.reduceat(values[order], starts[occupied], axis=0)
+    return sums
+
+
+def _batch_solve(J, h):
+    """
+    Solve J[k] x[k] = h[k] for a stack of positive definite matrices.
+    J is factored with one batched Cholesky decomposition, and each
+    system is then solved from its factor with LAPACK's potrs.
+
+    :param J: (K x n x n) positive definite matrices
+    :param h: (K x n) right hand sides
+    :return:  (K x n) solutions
+    """
+    from scipy.linalg.lapack import dpotrs
+    L = np.linalg.cholesky(J)
+    return np.array([dpotrs(Lk, hk, lower=1)[0] for Lk, hk in zip(L, h)])
+
+
+def _batch_info_to_moments(J, h):
+    """
+    Convert a stack of Gaussians from information form to moments.  J is
+    factored with one batched Cholesky decomposition, and each covariance
+    is computed from its factor with LAPACK's potri.
+
+    :param J: (K x n x n) precision matrices
+    :param h: (K x n) linear terms
+    :return:  (K x n x n) covariances, (K x n) means, and
+              (K x n x n) second moments E[x x^T]
+    """
+    from scipy.linalg.lapack import dpotri
+    L = np.linalg.cholesky(J)
+
+    # potri only fills in the lower triangle
+    Sigma = np.array([dpotri(Lk, lower=1)[0] for Lk in L])
+    Sigma = np.tril(Sigma) + np.swapaxes(np.tril(Sigma, -1), 1, 2)
+    mu = np.matmul(Sigma, h[:, :, None])[:, :, 0]
+    return Sigma, mu, Sigma + mu[:, :, None] * mu[:, None, :]
+
+
+class _TransitionOperatorBase(object):
+    """
+    Common interface of the implicit transition operators.  Subclasses
+    list the attributes indexed by time step in _time_arrays; the first
+    one determines the number of transition matrices.
+    """
+    _time_arrays = ()
+
+    def __len__(self):
+        return getattr(self, self._time_arrays[0]).shape[0]
+
+    @property
+    def shape(self):
+        return (len(self), self.num_states, self.num_states)
+
+    def blocks(self, reverse=False):
+        """ iterate over (start, stop, log_block) triples """
+        starts = list(range(0, len(self), self.block_size))
+        for start in (reversed(starts) if reverse else starts):
+            stop = min(start + self.block_size, len(self))
+            yield start, stop, self.log_block(start, stop)
+
+    def view(self, start, stop, block_size=None):
+        """
+        Return the operator restricted to time steps start:stop.  The
+        time-indexed arrays are sliced, so the view shares their memory.
+        """
+        op = copy.copy(self)
+        for name in self._time_arrays:
+            setattr(op, name, getattr(self, name)[start:stop])
+        if block_size is not None:
+            op.block_size = block_size
+        return op
+
+
+class StickBreakingTransitionOperator(_TransitionOperatorBase):
+    """
+    Implicit stack of stick-breaking transition matrices.  Rather than
+    materializing the (T x K x K) stack, store only the covariate
+    contribution psi_X (T x K-1), the Markov weights W_markov (K-1 x K),
+    and the offset b (K-1), and compute the log transition matrices for
+    a block of time steps on demand.  This takes O(T*K) memory instead
+    of O(T*K^2).
+    """
+    _time_arrays = ("psi_X",)
+
+    def __init__(self, psi_X, W_markov, b, block_size=1024):
+        self.psi_X = psi_X
+        self.W_markov = W_markov
+        self.b = b.reshape((-1,))
+        self.block_size = block_size
+        self.num_states = W_markov.shape[1]
+        assert psi_X.ndim == 2 and psi_X.shape[1] == self.num_states - 1
+        assert W_markov.shape == (self.num_states - 1, self.num_states)
+
+    def log_block(self, start, stop):
+        """ return the (stop-start x K x K) log transition matrices """
+        trans_psi = self.psi_X[start:stop, None, :] + self.W_markov.T
+        trans_psi += self.b
+        return psi_to_pi(trans_psi, axis=2, log=True)
+
+    def log_row(self, t, k):
+        """ return log A[t, k, :], the transition distribution out of state k """
+        return psi_to_pi(self.psi_X[t] + self.W_markov[:, k] + self.b, log=True)
+
+
+class RowInvariantTransitionOperator(_TransitionOperatorBase):
+    """
+    Implicit stack of transition matrices whose rows are all the same,
+    as in the input-only models where p(z_{t+1} | z_t, x_t) = p(z_{t+1} | x_t).
+    Only the (T x K) log transition rows are stored, and the message
+    passing in rslds.messages uses the factorization to run in O(T*K).
+    """
+    row_invariant = True
+    _time_arrays = ("log_rows",)
+
+    def __init__(self, log_rows, block_size=1024):
+        assert log_rows.ndim == 2
+        self.log_rows = log_rows
+        self.block_size = block_size
+        self.num_states = log_rows.shape[1]
+
+    def log_block(self, start, stop):
+        """ return the (stop-start x K x K) log transition matrices """
+        K = self.num_states
+        return np.broadcast_to(self.log_rows[start:stop, None, :], (stop-start, K, K))
+
+    def log_row(self, t, k):
+        """ return log A[t, k, :], the transition distribution out of state k """
+        return self.log_rows[t]
+
+
+class SharedPlusDiagonalTransitionOperator(_TransitionOperatorBase):
+    """
+    Implicit stack of sticky input-only transition matrices.  Given the
+    shared activations psi_X (T x K-1) and the stickiness kappas (K-1),
+    row k of the transition matrix at time t has activations
+    psi_X[t] + kappas[k] e_k.  Under the stick-breaking transformation,
+    boosting stick k only changes pi_k and rescales pi_{k+1:K}, so
+
+        log A[t,k,j] = S[t,j]            if j < k
+                       S[t,j] + d[t,k]   if j = k
+                       S[t,j] + r[t,k]   if j > k
+
+    where S[t] is the shared log distribution and d and r are per-row
+    corrections (zero for the last row, which has no stick).  The message
+    passing in rslds.messages uses this to run in O(T*K).
+    """
+    shared_plus_diagonal = True
+    _time_arrays = ("psi_X", "log_shared", "log_diag", "log_tail")
+
+    def __init__(self, psi_X, kappas, block_size=1024):
+        assert psi_X.ndim == 2 and kappas.shape == (psi_X.shape[1],)
+        self.psi_X = psi_X
+        self.kappas = kappas
+        self.block_size = block_size
+        self.num_states = psi_X.shape[1] + 1
+
+        T, K = psi_X.shape[0], self.num_states
+        self.log_shared = psi_to_pi(psi_X, axis=1, log=True)
+        self.log_diag = np.zeros((T, K))
+        self.log_diag[:, :-1] = log_logistic(psi_X + kappas) - log_logistic(psi_X)
+        self.log_tail = np.zeros((T, K))
+        self.log_tail[:, :-1] = log_logistic(-psi_X - kappas) - log_logistic(-psi_X)
+
+    def log_block(self, start, stop):
+        """ return the (stop-start x K x K) log transition matrices """
+        K = self.num_states
+        trans_psi = np.tile(self.psi_X[start:stop, None, :], (1, K, 1))
+        trans_psi[:, np.arange(K-1), np.arange(K-1)] += self.kappas
+        return psi_to_pi(trans_psi, axis=2, log=True)
+
+    def log_row(self, t, k):
+        """ return log A[t, k, :], the transition distribution out of state k """
+        log_row = self.log_shared[t].copy()
+        log_row[k] += self.log_diag[t, k]
+        log_row[k+1:] += self.log_tail[t, k]
+        return log_row
+
+
+class InputHMMTransitions(_VersionedParamsMixin, MultinomialRegression):
     """
     Model the transition probability as a multinomial
     regression whose inputs include the previous state
@@ -16,8 +237,8 @@ class InputHMMTransitions(MultinomialRegression):
         self.num_states = num_states
         self.covariate_dim = covariate_dim
 
-    def get_trans_matrices(self, X):
-        """ return a stack of transition matrices, one for each input """
+    def _get_trans_psi(self, X):
+        """ return a stack of stick-breaking activations, one for each input """
         mu, W = self.b, self.A
         W_markov = W[:,:self.num_states]
         W_covs = W[:,self.num_states:]
@@ -34,29 +255,125 @@ class InputHMMTransitions(MultinomialRegression):
 
         # Add the (K-1) mean
         trans_psi += mu.reshape((self.D_out,))
+        return trans_psi
+
+    def get_log_trans_matrices(self, X):
+        """ return a stack of log transition matrices, one for each input """
+        log_pi_stack = psi_to_pi(self._get_trans_psi(X), axis=2, log=True)
+        log_pi_stack = np.ascontiguousarray(log_pi_stack)
+        return log_pi_stack
+
+    def get_trans_operator(self, X, block_size=1024):
+        """
+        return an implicit stack of log transition matrices that is only
+        ever evaluated a block of time steps at a time
+        """
+        W_covs = self.A[:, self.num_states:]
+        W_markov = self.A[:, :self.num_states].copy()
+        return StickBreakingTransitionOperator(
+            X.dot(W_covs.T), W_markov, self.b.copy(), block_size=block_size)
 
-        pi_stack = psi_to_pi(trans_psi, axis=2)
-        pi_stack = np.ascontiguousarray(pi_stack)
-        return pi_stack
+    def get_trans_matrices(self, X):
+        """ return a stack of transition matrices, one for each input """
+        return psi_to_pi(self._get_trans_psi(X), axis=2)
+
+    def _stick_counts(self, next_states):
+        """
+        Return the Polya-gamma counts b and the kappas of the stick-breaking
+        regression for the given next states, without a one-hot encoding.
+        Stick k is only reached if z_{t+1} >= k, and it is taken if z_{t+1} = k.
+        """
+        sticks = np.arange(self.num_states - 1)
+        b = (next_states[:, None] >= sticks).astype(float)
+        kappa = (next_states[:, None] == sticks) - b / 2.0
+        return b, kappa
+
+    def _resample_trans_omegas(self, prev_states, covs, next_states):
+        """ draw the Polya-gamma auxiliary variables with one call to pgdrawvpar """
+        W_markov = self.A[:, :self.num_states]
+        W_covs = self.A[:, self.num_states:]
+        psi = W_markov.T[prev_states] + covs.dot(W_covs.T) + self.b.T
+        b_pg, _ = self._stick_counts(next_states)
+
+        omega = np.zeros(psi.size)
+        pgdrawvpar(self.ppgs, b_pg.ravel(), psi.ravel(), omega)
+        return omega.reshape(psi.shape)
+
+    def _trans_suff_stats(self, stateseqs, covseqs, omegas=None):
+        """
+        Accumulate the sufficient statistics of the stick-breaking regression
+        directly from the discrete states, covariates, and auxiliary variables.
+        The regression inputs are [I[z_t], x_t, 1], but since the previous
+        state is one-hot, the Markov block of the omega-weighted Gram matrix
+        is diagonal and its cross terms are sums grouped by the previous
+        state.  No one-hot design matrix is formed.
+
+        :return: J (K-1 x M x M) and h (K-1 x M), where M = K + D + 1 and
+                 the inputs are ordered as [Markov, covariates, bias]
+        """
+        K, D = self.num_states, self.covariate_dim
+        prev_states = np.concatenate([z[:-1] for z in stateseqs]).astype(int)
+        next_states = np.concatenate([z[1:] for z in stateseqs]).astype(int)
+        covs = np.concatenate(covseqs, axis=0).reshape((-1, D))
+        assert covs.shape[0] == prev_states.shape[0]
+
+        if omegas is None:
+            omega = self._resample_trans_omegas(prev_states, covs, next_states)
+        else:
+            omega = np.concatenate(omegas, axis=0)
+        _, kappa = self._stick_counts(next_states)
+
+        # Covariates augmented with the bias
+        xa = np.column_stack((covs, np.ones(covs.shape[0])))
+
+        J = np.zeros((K-1, K+D+1, K+D+1))
+        h = np.zeros((K-1, K+D+1))
+
+        # Markov block and its cross terms
+        J_markov = _grouped_sums(prev_states, omega, K)
+        J_cross = _grouped_sums(prev_states, omega[:, :, None] * xa[:, None, :], K)
+        J[:, np.arange(K), np.arange(K)] = J_markov.T
+        J[:, :K, K:] = J_cross.transpose((1, 0, 2))
+        J[:, K:, :K] = J_cross.transpose((1, 2, 0))
+        h[:, :K] = _grouped_sums(prev_states, kappa, K).T
+
+        # Covariate and bias block
+        J[:, K:, K:] = np.einsum('tk,ti,tj->kij', omega, xa, xa)
+        h[:, K:] = kappa.T.dot(xa)
+        return J, h
+
+    def _resample_from_suff_stats(self, J, h, inputs=None):
+        """
+        Sample the weights and biases of each stick given the sufficient
+        statistics from _trans_suff_stats and the Gaussian prior.
+
+        :param inputs: indices of the weights to sample (default: all of them).
+                       The other weights are left as they are.
+        """
+        inputs = np.arange(self.D_in) if inputs is None else np.asarray(inputs)
+        active = np.append(inputs, self.D_in)
+
+        # Make copies of parameters (for sample collection in calling methods)
+        self.A = self.A.copy()
+        self.b = self.b.copy()
+        for n in range(self.D_out):
+            prior_Sigma = np.zeros((active.size, active.size))
+            prior_Sigma[:-1, :-1] = self.sigmasq_A[n][np.ix_(inputs, inputs)]
+            prior_Sigma[-1, -1] = self.sigmasq_b[n]
+            prior_J = np.linalg.inv(prior_Sigma)
+            prior_h = prior_J.dot(np.append(self.mu_A[n][inputs], self.mu_b[n]))
+
+            sample = sample_gaussian(J=prior_J + J[n][np.ix_(active, active)],
+                                     h=prior_h + h[n][active])
+            self.A[n, inputs] = sample[:-1]
+            self.b[n] = sample[-1]
 
     def resample(self, stateseqs=None, covseqs=None, omegas=None, **kwargs):
-        """ conditioned on stateseqs and covseqs, stack up all of the data
-        and use the PGMult class to resample """
-        # assemble all of the discrete states into a dataset
-        def align_lags(stateseq, covseq):
-            prev_state = one_hot(stateseq[:-1], self.num_states)
-            next_state = one_hot(stateseq[1:], self.num_states)
-            return np.column_stack([prev_state, covseq]), next_state
-
-        # Get the stacked previous states, covariates, and next states
-        datas = [align_lags(z,x) for z, x in zip(stateseqs, covseqs)]
-
-        # Clip the last data column since it is redundant
-        # and not expected by the MultinomialRegression
-        datas = [(x, y[:,:-1]) for x, y in datas]
-        masks = [np.ones(y.shape, dtype=bool) for _,y in datas]
-        super(InputHMMTransitions, self).\
-            resample(datas, mask=masks, omega=omegas)
+        """ conditioned on stateseqs and covseqs, accumulate the sufficient
+        statistics of the stick-breaking regression and resample """
+        J, h = self._trans_suff_stats(stateseqs, covseqs, omegas)
+        self._resample_from_suff_stats(J, h)
+        self.params_updated()
 
 
 class StickyInputHMMTransitions(InputHMMTransitions):
@@ -86,82 +403,116 @@ class InputOnlyHMMTransitions(InputHMMTransitions):
     For example, the covariates
     could be an external signal or even the latent states
     of a switching linear dynamical system.
+
+    Since the transition probabilities do not depend on the
+    previous state, every row of each transition matrix is the
+    same, and the message passing uses the (T x K) rows directly.
     """
+    compact_trans_operator = True
+
     def __init__(self, num_states, covariate_dim, **kwargs):
         super(InputOnlyHMMTransitions, self).\
             __init__(num_states, covariate_dim, **kwargs)
         self.A[:, :self.num_states] = 0
 
-    def resample(self, stateseqs=None, covseqs=None, omegas=None, **kwargs):
-        """ conditioned on stateseqs and covseqs, stack up all of the data
-        and use the PGMult class to resample """
-
-        # Zero out the previous state in the regression
-        def align_lags(stateseq, covseq):
-            prev_state = np.zeros((stateseq.shape[0]-1, self.num_states))
-            next_state = one_hot(stateseq[1:], self.num_states)
-            return np.column_stack([prev_state, covseq]), next_state
-
-        # Get the stacked previous states, covariates, and next states
-        datas = [align_lags(z,x) for z, x in zip(stateseqs, covseqs)]
-
-        # Clip the last data column since it is redundant
-        # and not expected by the MultinomialRegression
-        datas = [(x, y[:,:-1]) for x, y in datas]
-        masks = [np.ones(y.shape, dtype=bool) for _,y in datas]
-        super(InputHMMTransitions, self).\
-            resample(datas, mask=masks, omega=omegas)
+    def get_log_trans_rows(self, X):
+        """ return the (T x K) log transition probabilities shared by all rows """
+        W_covs = self.A[:, self.num_states:]
+        psi = X.dot(W_covs.T) + self.b.T
+        return psi_to_pi(psi, log=True)
 
-        # Zero out the weights on the previous state
-        # (the previous state inputs were all zero, so these
-        #  weights are meaningless)
-        self.A[:, :self.num_states] = 0
+    def get_trans_operator(self, X, block_size=1024):
+        return RowInvariantTransitionOperator(
+            self.get_log_trans_rows(X), block_size=block_size)
+
+    def resample(self, stateseqs=None, covseqs=None, omegas=None, **kwargs):
+        """ conditioned on stateseqs and covseqs, resample the weights on
+        the covariates; the weights on the previous state stay zero """
+        J, h = self._trans_suff_stats(stateseqs, covseqs, omegas)
+        self._resample_from_suff_stats(
+            J, h, inputs=np.arange(self.num_states, self.D_in))
+        self.params_updated()
 
 
 class StickyInputOnlyHMMTransitions(InputHMMTransitions):
     """
-    Hacky way to implement the sticky input only model in which
+    Sticky input only model in which
 
     psi_{t,k} | z_{t-1} =
-        kappa_k + w_j \dot x_{t-1} + b_j     if z_{t-1} = k
-        0       + w_j \dot x_{t-1} + b_j     otherwise
-
-    We just set the prior such that the off-diagonal entries of
-    W_{markov} are effectively zero by setting the variance of
-    these entries to be super small.
+        kappa_k + w_k \dot x_{t-1} + b_k     if z_{t-1} = k
+        0       + w_k \dot x_{t-1} + b_k     otherwise
+
+    The Markov weights W_{markov} are constrained to be diagonal,
+    W_{markov}[k,k] = kappa_k ~ N(kappa, sigmasq_kappa), so each
+    transition matrix is the shared input-only distribution with a
+    per-state boost of its own stick.  The message passing uses this
+    structure (see SharedPlusDiagonalTransitionOperator) and the
+    regression for each stick only involves kappa_k, w_k, and b_k.
     """
-    def __init__(self, num_states, covariate_dim, kappa=1.0, sigmasq_kappa=1e-8, **kwargs):
+    compact_trans_operator = True
 
-        # Set the mean of A
-        K, D = num_states, covariate_dim
-        assert "mu_A" not in kwargs, "StickyInputHMMTransitions overrides provided mu_A"
-        mu_A = np.zeros((K-1, K+D))
-        mu_A[:,:K-1] = kappa * np.eye(K-1)
-        kwargs["mu_A"] = mu_A
-
-        # Set the covariance of A
+    def __init__(self, num_states, covariate_dim, kappa=1.0, sigmasq_kappa=1e-8, **kwargs):
+        assert "mu_A" not in kwargs, "StickyInputOnlyHMMTransitions overrides provided mu_A"
         if "sigmasq_A" in kwargs:
             assert np.isscalar(kwargs["sigmasq_A"])
-            sig0 = kwargs["sigmasq_A"]
-        else:
-            sig0 = 1.0
-
-        sigmasq_A = np.zeros((K-1, K+D, K+D))
-        for k in range(K-1):
-            sigmasq_A[k, :K, :K] = 1e-8 * np.eye(K)
-            sigmasq_A[k,  k,  k] = sigmasq_kappa
-            sigmasq_A[k, K:, K:] = sig0 * np.eye(D)
-
-        kwargs["sigmasq_A"] = sigmasq_A
 
         super(StickyInputOnlyHMMTransitions, self).\
             __init__(num_states, covariate_dim, **kwargs)
 
+        # Only the diagonal of the Markov weights is free
+        K = num_states
+        self.mu_kappa = kappa
+        self.sigmasq_kappa = sigmasq_kappa
+        self.A[:, :K] = 0
+        self.A[:, :K-1] += np.diag(kappa + np.sqrt(sigmasq_kappa) * np.random.randn(K-1))
+
+    @property
+    def kappas(self):
+        return np.diag(self.A[:, :self.num_states-1]).copy()
+
+    def get_trans_operator(self, X, block_size=1024):
+        W_covs = self.A[:, self.num_states:]
+        psi_X = X.dot(W_covs.T) + self.b.T
+        return SharedPlusDiagonalTransitionOperator(
+            psi_X, self.kappas, block_size=block_size)
+
+    def resample(self, stateseqs=None, covseqs=None, omegas=None, **kwargs):
+        """
+        Resample kappa_k, w_k, and b_k for each stick given the discrete
+        states, covariates, and Polya-gamma auxiliary variables.  The
+        regression for stick k has inputs [I[z_{t-1} = k], x_{t-1}, 1].
+        """
+        K, D = self.num_states, self.covariate_dim
+        J_lkhd, h_lkhd = self._trans_suff_stats(stateseqs, covseqs, omegas)
+
+        self.A = self.A.copy()
+        self.b = self.b.copy()
+        for k in range(K-1):
+            # Prior on [kappa_k, w_k, b_k]
+            prior_Sigma = np.zeros((D + 2, D + 2))
+            prior_Sigma[0, 0] = self.sigmasq_kappa
+            prior_Sigma[1:D+1, 1:D+1] = self.sigmasq_A[k, K:, K:]
+            prior_Sigma[D+1, D+1] = self.sigmasq_b[k]
+            prior_mu = np.concatenate(([self.mu_kappa], self.mu_A[k, K:], [self.mu_b[k]]))
+            J = np.linalg.inv(prior_Sigma)
+            h = J.dot(prior_mu)
+
+            active = np.concatenate(([k], np.arange(K, K+D+1)))
+            J += J_lkhd[k][np.ix_(active, active)]
+            h += h_lkhd[k][active]
+
+            sample = sample_gaussian(J=J, h=h)
+            self.A[k, k] = sample[0]
+            self.A[k, K:] = sample[1:D+1]
+            self.b[k] = sample[D+1]
+
+        self.params_updated()
+
 import autograd.numpy as anp
 import autograd.scipy.misc as amisc
 from autograd import grad
 
-class _SoftmaxInputHMMTransitionsBase(object):
+class _SoftmaxInputHMMTransitionsBase(_VersionedParamsMixin):
     """
     Like above but with a softmax transition model.
 
@@ -201,6 +552,40 @@ class _SoftmaxInputHMMTransitionsBase(object):
         self.h_0 = np.linalg.solve(Sigma_0, mu_0)
         self.J_0 = np.linalg.inv(Sigma_0)
 
+    ### Derived tensors
+    # The updates of the softmax bound use products of the parameters, like
+    # the outer products of the columns of W.  They are computed once and
+    # cached until params_updated() is called, or until logpi, W, or the
+    # mean field expectations are reassigned.
+    _derived_cache = None
+
+    def _cached_derived(self, name, compute):
+        key = (self.param_version, self.logpi, self.W, getattr(self, "_mf_mumuT", None))
+        cache = self._derived_cache
+        if cache is None or cache[0][0] != key[0] or \
+                any(c is not k for c, k in zip(cache[0][1:], key[1:])):
+            cache = self._derived_cache = (key, {})
+
+        if name not in cache[1]:
+            cache[1][name] = compute()
+        return cache[1][name]
+
+    @property
+    def WWT(self):
+        """ (K x D x D) outer products of the columns of W """
+        return self._cached_derived(
+            "WWT", lambda: np.einsum('ik, jk -> kij', self.W, self.W))
+
+    @property
+    def logpi_WT(self):
+        """ (K x K x D) outer products of the columns of log pi and W """
+        return self._cached_derived(
+            "logpi_WT", lambda: np.einsum('ik, jk -> kij', self.logpi, self.W))
+
+    @property
+    def logpi_sq(self):
+        return self._cached_derived("logpi_sq", lambda: self.logpi ** 2)
+
     def log_prior(self):
         # Normal N(mu | mu_0, Sigma / kappa_0)
         from scipy.linalg import solve_triangular
@@ -307,6 +692,8 @@ class _SoftmaxInputHMMTransitionsBase(object):
                 self.logpi[:, 1] = lr.coef_[0, :K].T
                 self.logpi[:, 1] += lr.intercept_
 
+        self.params_updated()
+
 
 class _SoftmaxInputHMMTransitionsHMC(_SoftmaxInputHMMTransitionsBase):
     def __init__(self, num_states, covariate_dim,
@@ -382,24 +769,17 @@ class _SoftmaxInputHMMTransitionsEM(_SoftmaxInputHMMTransitionsBase):
     def max_likelihood(self, stats):
         """
         Update the expected transition matrix with a bunch of stats
-        :param stats: E_zp1_uT, E_uuT, E_u, a, lambda_bs from the states model
-        :param prob: minibatch probability
-        :param stepsize: svi step size
+        :param stats: J_stats, h_stats summed over the states objects
         """
         K, D = self.num_states, self.covariate_dim
-        E_u_zp1T, E_uuT, E_u, a, lambda_bs = stats
+        J_stats, h_stats = stats
 
-        # Update statistics each row of A
-        for k in range(self.D_out):
-            # Jk = self.J_0 + 2 * lambda_bs[:,k][:,None,None] * E_uuT
-            Jk = self.J_0 + 2 * np.einsum('t, tij -> ij', lambda_bs[:, k], E_uuT)
-            hk = self.h_0 + E_u_zp1T[:, :, k].sum(0)
-            hk -= np.einsum('t, ti -> i', (0.5 - 2 * lambda_bs[:, k] * a), E_u)
+        # Solve for all rows of A at once
+        A = _batch_solve(self.J_0 + J_stats, self.h_0 + h_stats)
+        self.logpi[:] = A[:, :K].T
+        self.W[:] = A[:, K:].T
 
-            # Update the mean field natural parameters
-            ak = np.linalg.solve(Jk, hk)
-            self.logpi[:,k] = ak[:K]
-            self.W[:,k] = ak[K:]
+        self.params_updated()
 
 
 class _SoftmaxInputHMMTransitionsMeanField(_SoftmaxInputHMMTransitionsBase):
@@ -444,41 +824,40 @@ class _SoftmaxInputHMMTransitionsMeanField(_SoftmaxInputHMMTransitionsBase):
     def expected_logpi_logpiT(self):
         return self._mf_mumuT[:, :self.num_states, :self.num_states]
 
+    @property
+    def expected_logpi_sq(self):
+        """ (K x K) E[log pi_{ik}^2] """
+        return self._cached_derived(
+            "expected_logpi_sq",
+            lambda: np.diagonal(self.expected_logpi_logpiT, axis1=1, axis2=2).T)
+
     def meanfieldupdate(self, stats, prob=1.0, stepsize=1.0):
         """
         Update the expected transition matrix with a bunch of stats
-        :param stats: E_zp1_uT, E_uuT, E_u, a, lambda_bs from the states model
+        :param stats: J_stats, h_stats summed over the states objects
         :param prob: minibatch probability
         :param stepsize: svi step size
         """
-        E_u_zp1T, E_uuT, E_u, a, lambda_bs = stats
+        J_stats, h_stats = stats
 
         update_param = lambda oldv, newv, stepsize: \
             oldv * (1 - stepsize) + newv * stepsize
 
-        # Update statistics each row of A
-        for k in range(self.D_out):
-            # Jk = self.J_0 + 2 * lambda_bs[:,k][:,None,None] * E_uuT
-            Jk = self.J_0 + 2 * np.einsum('t, tij -> ij', lambda_bs[:, k], E_uuT) / prob
-            hk = self.h_0 + E_u_zp1T[:, :, k].sum(0) / prob
-            hk -= np.einsum('t, ti -> i', (0.5 - 2 * lambda_bs[:, k] * a), E_u) / prob
-
-            # Update the mean field natural parameters
-            self.mf_J[k] = update_param(self.mf_J[k], Jk, stepsize)
-            self.mf_h[k] = update_param(self.mf_h[k], hk, stepsize)
+        # Update the mean field natural parameters of all rows of A
+        self.mf_J = update_param(self.mf_J, self.J_0 + J_stats / prob, stepsize)
+        self.mf_h = update_param(self.mf_h, self.h_0 + h_stats / prob, stepsize)
 
         self._set_standard_expectations()
 
         # Update log pi and W with meanfield expectations
         self.logpi = self.expected_logpi
         self.W = self.expected_W
+        self.params_updated()
 
     def _set_standard_expectations(self):
-        # Compute expectations
-        self._mf_Sigma = np.array([np.linalg.inv(Jk) for Jk in self.mf_J])
-        self._mf_mu = np.array([np.dot(Sk, hk) for Sk, hk in zip(self._mf_Sigma, self.mf_h)])
-        self._mf_mumuT = np.array([Sd + np.outer(md, md)
-                                   for Sd, md in zip(self._mf_Sigma, self._mf_mu)])
+        # Compute expectations of all rows of A from one batched factorization
+        self._mf_Sigma, self._mf_mu, self._mf_mumuT = \
+            _batch_info_to_moments(self.mf_J, self.mf_h)
 
     def get_vlb(self):
         # TODO
@@ -489,8 +868,9 @@ class _SoftmaxInputHMMTransitionsMeanField(_SoftmaxInputHMMTransitionsBase):
         # Initializing with mean zero is pathological. Break symmetry by starting with sampled A.
         # self.mf_h_A = np.array([self.h_0.copy() for _ in range(D_out)])
         A = np.hstack((self.logpi, self.W.T))
-        self.mf_h = np.array([Jd.dot(Ad) for Jd, Ad in zip(self.mf_J, A)])
+        self.mf_h = np.matmul(self.mf_J, A[:, :, None])[:, :, 0]
         self._set_standard_expectations()
+        self.params_updated()
 
 
 class SoftmaxInputHMMTransitions(_SoftmaxInputHMMTransitionsHMC,
@@ -504,6 +884,7 @@ class SoftmaxInputOnlyHMMTransitions(SoftmaxInputHMMTransitions):
     Like above but with logpi constant for all rows (prev states)
     Assume a variational factor q(b) q(W)
     """
+    compact_trans_operator = True
 
     def __init__(self, num_states, covariate_dim,
                  mu_0=None, Sigma_0=None,
@@ -539,6 +920,16 @@ class SoftmaxInputOnlyHMMTransitions(SoftmaxInputHMMTransitions):
     def b(self, value):
         assert value.shape == (self.num_states,)
         self.logpi = np.tile(value[None, :], (self.num_states, 1))
+        self.params_updated()
+
+    def get_log_trans_rows(self, X):
+        """ return the (T x K) log transition probabilities shared by all rows """
+        psi = np.dot(X, self.W) + self.b
+        return psi - amisc.logsumexp(psi, axis=1, keepdims=True)
+
+    def get_trans_operator(self, X, block_size=1024):
+        return RowInvariantTransitionOperator(
+            self.get_log_trans_rows(X), block_size=block_size)
 
     def resample(self, stateseqs=None, covseqs=None,
                  n_steps=10, step_sz=0.01, **kwargs):
@@ -566,50 +957,38 @@ class SoftmaxInputOnlyHMMTransitions(SoftmaxInputHMMTransitions):
                 adaptive_step_sz=True,
                 avg_accept_rate=self.accept_rate)
 
-        self.b = xf[:K]
         self.W = xf[K:].reshape((D, K))
+        self.b = xf[:K]
+
+    def _reduce_stats(self, stats):
+        """
+        The states' statistics are for u = [z, x].  Combine them across
+        all preceding states, z, to get statistics for [1, x], i.e. of
+        shape (1+covariate_dim).  This is linear, so it applies to the
+        contracted sums as u -> R u.
+        """
+        K, D = self.num_states, self.covariate_dim
+        J_stats, h_stats = stats
+
+        R = np.zeros((1+D, K+D))
+        R[0, :K] = 1
+        R[1:, K:] = np.eye(D)
+        return np.matmul(np.matmul(R, J_stats), R.T), h_stats.dot(R.T)
 
     ### EM
     def max_likelihood(self, stats):
         """
         Update the expected transition matrix with a bunch of stats
-        :param stats: E_zp1_uT, E_uuT, E_u, a, lambda_bs from the states model
-        :param prob: minibatch probability
-        :param stepsize: svi step size
+        :param stats: J_stats, h_stats summed over the states objects
         """
-        K, D = self.num_states, self.covariate_dim
-        E_u_zp1T, E_uuT, E_u, a, lambda_bs = stats
-        T = E_u.shape[0]
-
-        # Remember u = [z, x]
-        # Combine statistics across all preceding states, z,
-        # to get statistics of shape (1+covariate_dim)
-        E_u_zp1T_new = np.zeros((T, 1+D, K))
-        E_u_zp1T_new[:, 0, :] = E_u_zp1T[:, :K, :].sum(axis=1)
-        E_u_zp1T_new[:, 1:, :] = E_u_zp1T[:, K:, :]
-        E_u_zp1T = E_u_zp1T_new
-
-        E_uuT_new = np.zeros((T, 1+D, 1+D))
-        E_uuT_new[:,0,0] = E_uuT[:, :K, :K].sum(axis=(1,2))
-        E_uuT_new[:,0,1:] = E_uuT[:, :K, K:].sum(axis=1)
-        E_uuT_new[:,1:,0] = E_uuT[:, K:, :K].sum(axis=2)
-        E_uuT_new[:,1:,1:] = E_uuT[:, K:, K:]
-        E_uuT = E_uuT_new
-
-        E_u_new = np.zeros((T, 1+D))
-        E_u_new[:,0] = E_u[:, :K].sum(axis=1)
-        E_u_new[:,1:] = E_u[:, K:]
-        E_u = E_u_new
-
-        # Update statistics each row of A
-        for k in range(self.D_out):
-            Jk = self.J_0 + 2 * np.einsum('t, tij -> ij', lambda_bs[:, k], E_uuT)
-            hk = self.h_0 + E_u_zp1T[:, :, k].sum(0)
-            hk -= np.einsum('t, ti -> i', (0.5 - 2 * lambda_bs[:, k] * a), E_u)
-
-            ak = np.linalg.solve(Jk, hk)
-            self.logpi[:, k] = ak[0]
-            self.W[:, k] = ak[1:]
+        J_stats, h_stats = self._reduce_stats(stats)
+
+        # Solve for all rows of A at once
+        A = _batch_solve(self.J_0 + J_stats, self.h_0 + h_stats)
+        self.logpi[:] = A[:, 0]
+        self.W[:] = A[:, 1:].T
+
+        self.params_updated()
 
     ### Mean field
     @property
@@ -623,7 +1002,9 @@ class SoftmaxInputOnlyHMMTransitions(SoftmaxInputHMMTransitions):
 
     @property
     def expected_logpi(self):
-        return np.tile(self.expected_b[None,:], (self.num_states, 1))
+        return self._cached_derived(
+            "expected_logpi",
+            lambda: np.tile(self.expected_b[None,:], (self.num_states, 1)))
 
     @property
     def expected_WWT(self):
@@ -639,77 +1020,47 @@ class SoftmaxInputOnlyHMMTransitions(SoftmaxInputHMMTransitions):
 
     @property
     def expected_logpi_WT(self):
-        return np.tile(self.expected_bWT[:,None,:], (1, self.num_states, 1))
+        return self._cached_derived(
+            "expected_logpi_WT",
+            lambda: np.tile(self.expected_bWT[:,None,:], (1, self.num_states, 1)))
 
     @property
     def expected_logpi_logpiT(self):
-        return np.tile(self.expected_bsq[:,None,None], (1, self.num_states, self.num_states))
+        return self._cached_derived(
+            "expected_logpi_logpiT",
+            lambda: np.tile(self.expected_bsq[:,None,None], (1, self.num_states, self.num_states)))
 
     def meanfieldupdate(self, stats, prob=1.0, stepsize=1.0):
         """
         Update the expected transition matrix with a bunch of stats
-        :param stats: E_zp1_uT, E_uuT, E_u, a, lambda_bs from the states model
+        :param stats: J_stats, h_stats summed over the states objects
         :param prob: minibatch probability
         :param stepsize: svi step size
         """
-        K, D = self.num_states, self.covariate_dim
-        E_u_zp1T, E_uuT, E_u, a, lambda_bs = stats
-        T = E_u.shape[0]
-
-        # Remember u = [z, x]
-        # Combine statistics across all preceding states, z,
-        # to get statistics of shape (1+covariate_dim)
-        E_u_zp1T_new = np.zeros((T, 1+D, K))
-        E_u_zp1T_new[:, 0, :] = E_u_zp1T[:, :K, :].sum(axis=1)
-        E_u_zp1T_new[:, 1:, :] = E_u_zp1T[:, K:, :]
-        E_u_zp1T = E_u_zp1T_new
-
-        E_uuT_new = np.zeros((T, 1+D, 1+D))
-        E_uuT_new[:,0,0] = E_uuT[:, :K, :K].sum(axis=(1,2))
-        E_uuT_new[:,0,1:] = E_uuT[:, :K, K:].sum(axis=1)
-        E_uuT_new[:,1:,0] = E_uuT[:, K:, :K].sum(axis=2)
-        E_uuT_new[:,1:,1:] = E_uuT[:, K:, K:]
-        E_uuT = E_uuT_new
-
-        E_u_new = np.zeros((T, 1+D))
-        E_u_new[:,0] = E_u[:, :K].sum(axis=1)
-        E_u_new[:,1:] = E_u[:, K:]
-        E_u = E_u_new
+        J_stats, h_stats = self._reduce_stats(stats)
 
         update_param = lambda oldv, newv, stepsize: \
             oldv * (1 - stepsize) + newv * stepsize
 
-        # Update statistics each row of A
-        for k in range(self.D_out):
-            # Jk = self.J_0 + 2 * lambda_bs[:,k][:,None,None] * E_uuT
-            Jk = self.J_0 + 2 * np.einsum('t, tij -> ij', lambda_bs[:, k], E_uuT) / prob
-            hk = self.h_0 + E_u_zp1T[:, :, k].sum(0) / prob
-            hk -= np.einsum('t, ti -> i', (0.5 - 2 * lambda_bs[:, k] * a), E_u) / prob
-
-            # Update the mean field natural parameters
-            self.mf_J[k] = update_param(self.mf_J[k], Jk, stepsize)
-            self.mf_h[k] = update_param(self.mf_h[k], hk, stepsize)
+        # Update the mean field natural parameters of all rows of A
+        self.mf_J = update_param(self.mf_J, self.J_0 + J_stats / prob, stepsize)
+        self.mf_h = update_param(self.mf_h, self.h_0 + h_stats / prob, stepsize)
 
         self._set_standard_expectations()
 
         # Update log pi and W with meanfield expectations
         self.logpi = self.expected_logpi
         self.W = self.expected_W
-
-    def _set_standard_expectations(self):
-        # Compute expectations
-        self._mf_Sigma = np.array([np.linalg.inv(Jk) for Jk in self.mf_J])
-        self._mf_mu = np.array([np.dot(Sk, hk) for Sk, hk in zip(self._mf_Sigma, self.mf_h)])
-        self._mf_mumuT = np.array([Sd + np.outer(md, md)
-                                   for Sd, md in zip(self._mf_Sigma, self._mf_mu)])
+        self.params_updated()
 
     def _initialize_mean_field(self):
         self.mf_J = np.array([1e2 * self.J_0.copy() for _ in range(self.D_out)])
 
         # Initializing with given b and W
         A = np.hstack((self.b[:,None], self.W.T))
-        self.mf_h = np.array([Jk.dot(ak) for Jk, ak in zip(self.mf_J, A)])
+        self.mf_h = np.matmul(self.mf_J, A[:, :, None])[:, :, 0]
         self._set_standard_expectations()
+        self.params_updated()
 
     def initialize_with_logistic_regression(self, zs, xs):
         from sklearn.linear_model.logistic import LogisticRegression
@@ -738,7 +1089,7 @@ class SoftmaxInputOnlyHMMTransitions(SoftmaxInputHMMTransitions):
 
 
 
-class NNInputHMMTransitions(object):
+class NNInputHMMTransitions(_VersionedParamsMixin):
     """
     Use a neural net to predict transitions.
     """
@@ -799,3 +1150,4 @@ class NNInputHMMTransitions(object):
         lr_X = np.column_stack((one_hot(zps, K), xps))
         lr_y = one_hot(zns, K)
         self.mlp.fit(lr_X, lr_y)
+        self.params_updated()
@@ -54,59 +54,105 @@ def plot_2d_plane(ax, normal, point=None, d=0,
 
 
 
-def psi_to_pi(psi, axis=None):
+def log_logistic(x):
+    """
+    Numerically stable log(logistic(x)) = -log(1 + exp(-x))
+    """
+    return -np.logaddexp(0, -x)
+
+def psi_to_log_pi(psi, axis=-1):
+    """
+    Convert psi to log probabilities with the logistic stick breaking
+    transformation.  With sigma the logistic function,
+
+        log pi_k = log sigma(psi_k) + sum_{j<k} log sigma(-psi_j)
+        log pi_K = sum_{j<K} log sigma(-psi_j)
+
+    The sticks are broken with a cumulative sum in log space rather
+    than a loop, so the cost is a single pass over psi.
+
+    :param psi:     Array with K-1 entries along axis
+    :param axis:    Axis along which to break sticks
+    :return:        Array with K log probabilities along axis
+    """
+    psi = np.asarray(psi, dtype=float)
+    psi = np.moveaxis(psi, axis, -1)
+    K = psi.shape[-1] + 1
+
+    # log sigma(-psi) = -log(1 + e^psi) and log sigma(psi) = psi + log sigma(-psi)
+    log_rest = -np.logaddexp(0, psi)
+    log_stick = np.cumsum(log_rest, axis=-1)
+
+    log_pi = np.zeros(psi.shape[:-1] + (K,))
+    log_pi[..., :-1] = psi + log_rest
+    log_pi[..., 1:-1] += log_stick[..., :-1]
+    if K > 1:
+        log_pi[..., -1] = log_stick[..., -1]
+
+    return np.moveaxis(log_pi, -1, axis)
+
+def _psi_to_pi_direct(psi, axis=-1):
+    """
+    Convert psi to probabilities with the logistic stick breaking
+    transformation, working with the probabilities themselves:
+
+        pi_k = sigma(psi_k) prod_{j<k} sigma(-psi_j)
+
+    This takes one exponential per stick, where going through
+    psi_to_log_pi and exponentiating takes three.
+
+    :param psi:     Array with K-1 entries along axis
+    :param axis:    Axis along which to break sticks
+    :return:        Array with K probabilities along axis
+    """
+    psi = np.asarray(psi, dtype=float)
+    psi = np.moveaxis(psi, axis, -1)
+    K = psi.shape[-1] + 1
+
+    # sigma(psi) = 1 / (1 + e^{-psi}) and sigma(-psi) = e^{-psi} sigma(psi).
+    # Clipping psi keeps e^{-psi} finite; it only changes probabilities
+    # that are already below 1e-300.
+    rest = np.clip(psi, -700, 700)
+    np.negative(rest, out=rest)
+    np.exp(rest, out=rest)
+    take = np.reciprocal(rest + 1)
+    rest *= take
+    stick = np.cumprod(rest, axis=-1)
+
+    pi = np.ones(psi.shape[:-1] + (K,))
+    if K > 1:
+        pi[..., :-1] = take
+        pi[..., 1:-1] *= stick[..., :-1]
+        pi[..., -1] = stick[..., -1]
+
+    return np.moveaxis(pi, -1, axis)
+
+def psi_to_pi(psi, axis=None, log=False, check=False):
     """
     Convert psi to a probability vector pi
-    :param psi:     Length K-1 vector
+    :param psi:     Length K-1 vector (or a stack of them)
+    :param axis:    Axis along which to break sticks. If None, psi
+                    must be 1 or 2D and the last axis is used.
+    :param log:     If True, return log pi instead of pi
+    :param check:   If True, assert that the outputs are normalized
     :return:        Length K normalized probability vector
     """
     if axis is None:
-        if psi.ndim == 1:
-            K = psi.size + 1
-            pi = np.zeros(K)
-
-            # Set pi[1..K-1]
-            stick = 1.0
-            for k in range(K-1):
-                pi[k] = logistic(psi[k]) * stick
-                stick -= pi[k]
-
-            # Set the last output
-            pi[-1] = stick
-            # DEBUG
-            assert np.allclose(pi.sum(), 1.0)
-
-        elif psi.ndim == 2:
-            M, Km1 = psi.shape
-            K = Km1 + 1
-            pi = np.zeros((M,K))
-
-            # Set pi[1..K-1]
-            stick = np.ones(M)
-            for k in range(K-1):
-                pi[:,k] = logistic(psi[:,k]) * stick
-                stick -= pi[:,k]
-
-            # Set the last output
-            pi[:,-1] = stick
-
-            # DEBUG
-            assert np.allclose(pi.sum(axis=1), 1.0)
-
-        else:
+        if psi.ndim not in (1, 2):
             raise ValueError("psi must be 1 or 2D")
+        axis = -1
+
+    if log:
+        log_pi = psi_to_log_pi(psi, axis=axis)
+        pi = np.exp(log_pi) if check else None
     else:
-        K = psi.shape[axis] + 1
-        pi = np.zeros([psi.shape[dim] if dim != axis else K for dim in range(psi.ndim)])
-        stick = np.ones(psi.shape[:axis] + psi.shape[axis+1:])
-        for k in range(K-1):
-            inds = [slice(None) if dim != axis else k for dim in range(psi.ndim)]
-            pi[inds] = logistic(psi[inds]) * stick
-            stick -= pi[inds]
-        pi[[slice(None) if dim != axis else -1 for dim in range(psi.ndim)]] = stick
-        assert np.allclose(pi.sum(axis=axis), 1.)
+        pi = _psi_to_pi_direct(psi, axis=axis)
+
+    # DEBUG
+    if check:
+        assert np.allclose(pi.sum(axis=axis), 1.0)
 
-    return pi
+    return log_pi if log else pi
 
 def pi_to_psi(pi):
     """
@@ -142,6 +188,23 @@ def pi_to_psi(pi):
     return psi
 
 
+def polya_gamma_samplers(num_threads=None, seed=None):
+    """
+    Create a pool of Polya-gamma samplers for pypolyagamma.pgdrawvpar,
+    which runs one thread per sampler.
+
+    :param num_threads: number of samplers (default: the OpenMP thread count)
+    :param seed:        seed for the samplers' seeds.  If None, they are drawn
+                        from numpy's global random state.
+    :return:            list of PyPolyaGamma samplers
+    """
+    import pypolyagamma as ppg
+    if num_threads is None:
+        num_threads = ppg.get_omp_num_threads()
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    seeds = rng.randint(2 ** 16, size=num_threads)
+    return [ppg.PyPolyaGamma(seed) for seed in seeds]
+
 def compute_psi_cmoments(alphas):
     K = alphas.shape[0]
     psi = np.linspace(-10,10,1000)
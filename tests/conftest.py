@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+K, D_obs, D_latent, T = 3, 4, 2, 50
+
+
+@pytest.fixture
+def rslds_params():
+    """
+    Dynamics, initial state, and emission distributions of a small
+    recurrent SLDS, with conjugate priors.  The dynamics take an input
+    of ones as their last column, like the examples.
+    """
+    # The model fixtures import the model stack here, so that the message
+    # passing tests don't need it
+    from pybasicbayes.distributions import Regression, Gaussian, DiagonalRegression
+    from pylds.util import random_rotation
+
+    np.random.seed(0)
+    dynamics_distns = [
+        Regression(
+            A=np.column_stack((0.95 * random_rotation(D_latent, np.pi / 12),
+                               0.1 * np.random.randn(D_latent))),
+            sigma=0.01 * np.eye(D_latent),
+            nu_0=D_latent + 2,
+            S_0=0.01 * np.eye(D_latent),
+            M_0=np.zeros((D_latent, D_latent + 1)),
+            K_0=np.eye(D_latent + 1))
+        for _ in range(K)]
+
+    init_dynamics_distns = [
+        Gaussian(
+            mu=np.zeros(D_latent),
+            sigma=np.eye(D_latent),
+            nu_0=D_latent + 2, sigma_0=np.eye(D_latent),
+            mu_0=np.zeros(D_latent), kappa_0=1.0)
+        for _ in range(K)]
+
+    emission_distns = \
+        DiagonalRegression(D_obs, D_latent + 1,
+                           A=np.random.randn(D_obs, D_latent + 1),
+                           sigmasq=0.1 * np.ones(D_obs),
+                           alpha_0=2.0, beta_0=2.0)
+
+    return dict(dynamics_distns=dynamics_distns,
+                init_dynamics_distns=init_dynamics_distns,
+                emission_distns=emission_distns)
+
+
+@pytest.fixture
+def make_pg_model(rslds_params):
+    """ construct PGRecurrentSLDS models with random recurrent transition weights """
+    from rslds.models import PGRecurrentSLDS
+
+    def _make_pg_model(**kwargs):
+        trans_params = dict(
+            A=np.hstack((np.zeros((K - 1, K)), 2 * np.random.randn(K - 1, D_latent))),
+            b=np.zeros((K - 1, 1)), sigmasq_A=1., sigmasq_b=1.)
+        return PGRecurrentSLDS(trans_params=trans_params, init_state_distn='uniform',
+                               pg_seed=0, **dict(rslds_params, **kwargs))
+    return _make_pg_model
+
+
+@pytest.fixture
+def pg_model(make_pg_model):
+    """ a PGRecurrentSLDS with one sequence sampled from it """
+    model = make_pg_model()
+    model.generate(T=T, inputs=np.ones((T, 1)))
+    return model
+
+
+@pytest.fixture
+def softmax_model(rslds_params):
+    """ a SoftmaxRecurrentSLDS with three sequences sampled from it """
+    from rslds.models import SoftmaxRecurrentSLDS
+
+    model = SoftmaxRecurrentSLDS(
+        trans_params=dict(W=2 * np.random.randn(D_latent, K)),
+        init_state_distn='uniform', **rslds_params)
+    for _ in range(3):
+        model.generate(T=T, inputs=np.ones((T, 1)))
+    return model
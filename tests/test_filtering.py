@@ -0,0 +1,105 @@
+import numpy as np
+from scipy.stats import multivariate_normal
+
+from rslds.filtering import _systematic_resample
+
+
+def test_filter_first_step(pg_model):
+    # After one observation the filter is the exact posterior of z_0 and x_0
+    f = pg_model.online_filter()
+    y, u = pg_model.states_list[0].data[0], np.ones(1)
+    probs, mean = f.step(y, u)
+
+    C, d = pg_model.emission_distns[0].A[:, :-1], pg_model.emission_distns[0].A[:, -1]
+    R = pg_model.emission_distns[0].sigma
+    log_p = np.log(pg_model.init_state_distn.pi_0)
+    mus = []
+    for k, init in enumerate(pg_model.init_dynamics_distns):
+        S = C.dot(init.sigma).dot(C.T) + R
+        log_p[k] += multivariate_normal.logpdf(y, C.dot(init.mu) + d, S)
+        gain = init.sigma.dot(C.T).dot(np.linalg.inv(S))
+        mus.append(init.mu + gain.dot(y - C.dot(init.mu) - d))
+
+    assert np.isclose(f.log_likelihood, np.logaddexp.reduce(log_p))
+    p = np.exp(log_p - np.logaddexp.reduce(log_p))
+    assert np.allclose(probs, p)
+    assert np.allclose(mean, p.dot(mus))
+
+
+def test_filter_update(pg_model):
+    s = pg_model.states_list[0]
+    f = pg_model.online_filter()
+    probs, means = f.update(s.data, s.inputs)
+    assert probs.shape == (s.T, len(pg_model.dynamics_distns))
+    assert np.allclose(probs.sum(1), 1)
+    assert np.all(np.isfinite(means))
+    log_likelihood = f.log_likelihood
+
+    # Stepping through the same data gives the same results
+    f.reset()
+    for t in range(s.T):
+        probs_t, mean_t = f.step(s.data[t], s.inputs[t])
+        assert np.allclose(probs_t, probs[t])
+        assert np.allclose(mean_t, means[t])
+    assert np.isclose(f.log_likelihood, log_likelihood)
+
+    # Missing observations leave the likelihood unchanged
+    f.step(np.nan * s.data[0], s.inputs[0])
+    assert np.isclose(f.log_likelihood, log_likelihood)
+    assert np.allclose(f.state_probs.sum(), 1)
+
+
+def test_systematic_resample():
+    np.random.seed(0)
+    weights = np.random.dirichlet(np.ones(10))
+    counts = np.bincount(_systematic_resample(weights), minlength=10)
+    assert counts.sum() == 10
+    assert np.all(np.abs(counts - 10 * weights) < 1)
+
+
+def test_particle_filter(pg_model):
+    s = pg_model.states_list[0]
+    f = pg_model.particle_filter(num_particles=2000)
+    imm = pg_model.online_filter()
+
+    # With the exact proposal, the first step's likelihood is exact
+    probs, _ = f.step(s.data[0], s.inputs[0])
+    imm_probs, _ = imm.step(s.data[0], s.inputs[0])
+    assert np.isclose(f.log_likelihood, imm.log_likelihood)
+    assert np.allclose(probs, imm_probs, atol=0.05)
+
+    probs, means = f.update(s.data[1:], s.inputs[1:])
+    assert np.allclose(probs.sum(1), 1)
+    assert np.all(np.isfinite(means))
+    assert np.isfinite(f.log_likelihood)
+    assert np.isclose(f.weights.sum(), 1)
+    assert 1 <= f.effective_sample_size <= f.num_particles
+
+    f.reset()
+    assert f.t == 0 and f.log_likelihood == 0
+
+
+def test_fixed_lag_smoother(pg_model):
+    s = pg_model.states_list[0]
+    K, D, lag = len(pg_model.dynamics_distns), s.D_latent, 4
+    smoother = pg_model.fixed_lag_smoother(lag, num_sweeps=2)
+
+    outputs = [smoother.step(s.data[t], s.inputs[t]) for t in range(s.T)]
+    assert all(out is None for out in outputs[:lag])
+    for t, out in enumerate(outputs[lag:]):
+        t_smoothed, probs, mean = out
+        assert t_smoothed == t
+        assert probs.shape == (K,) and np.isclose(probs.sum(), 1)
+        assert mean.shape == (D,) and np.all(np.isfinite(mean))
+
+    probs, means = smoother.flush()
+    assert probs.shape == (lag, K) and np.allclose(probs.sum(1), 1)
+    assert means.shape == (lag, D)
+
+
+def test_fixed_lag_smoother_short_stream(pg_model):
+    s = pg_model.states_list[0]
+    smoother = pg_model.fixed_lag_smoother(10)
+    assert all(smoother.step(s.data[t], s.inputs[t]) is None for t in range(3))
+    probs, means = smoother.flush()
+    assert probs.shape[0] == means.shape[0] == 3
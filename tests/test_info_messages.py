@@ -0,0 +1,105 @@
+import numpy as np
+
+from rslds.info_messages import parallel_info_E_step, parallel_info_sample, _info_lognorm
+
+
+def _random_spd(n, size=()):
+    X = np.random.randn(*(size + (n, n + 2)))
+    return np.matmul(X, np.swapaxes(X, -1, -2)) / n + np.eye(n)
+
+
+def _random_chain(T, n, shared=False):
+    """ information form potentials of a random linear Gaussian chain """
+    size = () if shared else (T - 1,)
+    A = 0.5 * np.random.randn(*(size + (n, n)))
+    Q_inv = np.linalg.inv(_random_spd(n, size))
+    J_pair_11 = np.matmul(np.matmul(np.swapaxes(A, -1, -2), Q_inv), A)
+    J_pair_21 = -np.matmul(Q_inv, A)
+    J_pair_22 = Q_inv
+    h_pair_1 = np.random.randn(*(size + (n,)))
+    h_pair_2 = np.random.randn(*(size + (n,)))
+    log_Z_pair = np.random.randn(*size)
+
+    J_node = np.linalg.inv(_random_spd(n, (T,)))
+    h_node = np.random.randn(T, n)
+    log_Z_node = np.random.randn(T)
+
+    J_init = np.linalg.inv(_random_spd(n))
+    return (J_init, np.random.randn(n), np.random.randn(),
+            J_pair_11, J_pair_21, J_pair_22, h_pair_1, h_pair_2, log_Z_pair,
+            J_node, h_node, log_Z_node)
+
+
+def _dense(J_init, h_init, log_Z_init,
+           J_pair_11, J_pair_21, J_pair_22, h_pair_1, h_pair_2, log_Z_pair,
+           J_node, h_node, log_Z_node):
+    """ the full (Tn x Tn) precision and (Tn) linear term of the chain """
+    T, n = h_node.shape
+    _t = lambda X, t, ndim: X if np.ndim(X) == ndim else X[t]
+    J = np.zeros((T * n, T * n))
+    h = np.zeros(T * n)
+    log_Z = log_Z_init + np.sum(log_Z_node) + np.sum(np.broadcast_to(log_Z_pair, (T - 1,)))
+
+    J[:n, :n] += J_init
+    h[:n] += h_init
+    for t in range(T):
+        J[t*n:(t+1)*n, t*n:(t+1)*n] += J_node[t]
+        h[t*n:(t+1)*n] += h_node[t]
+    for t in range(T - 1):
+        s, u = slice(t*n, (t+1)*n), slice((t+1)*n, (t+2)*n)
+        J[s, s] += _t(J_pair_11, t, 2)
+        J[u, s] += _t(J_pair_21, t, 2)
+        J[s, u] += _t(J_pair_21, t, 2).T
+        J[u, u] += _t(J_pair_22, t, 2)
+        h[s] += _t(h_pair_1, t, 1)
+        h[u] += _t(h_pair_2, t, 1)
+    return J, h, log_Z
+
+
+def test_parallel_info_E_step():
+    np.random.seed(0)
+    T, n = 12, 3
+    for shared in (False, True):
+        params = _random_chain(T, n, shared=shared)
+        J, h, log_Z = _dense(*params)
+        Sigma = np.linalg.inv(J)
+        mu = Sigma.dot(h).reshape((T, n))
+        lognorm_true = log_Z + _info_lognorm(J, h)
+
+        for num_chunks in (1, 2, 5, T):
+            lognorm, mus, sigmas, E_xtp1_xtT = parallel_info_E_step(
+                *params, num_chunks=num_chunks)
+            assert np.isclose(lognorm, lognorm_true)
+            assert np.allclose(mus, mu)
+            for t in range(T):
+                assert np.allclose(sigmas[t], Sigma[t*n:(t+1)*n, t*n:(t+1)*n])
+            for t in range(T - 1):
+                assert np.allclose(E_xtp1_xtT[t],
+                                   Sigma[(t+1)*n:(t+2)*n, t*n:(t+1)*n]
+                                   + np.outer(mu[t+1], mu[t]))
+
+
+def test_parallel_info_E_step_pool():
+    from multiprocessing.pool import ThreadPool
+    np.random.seed(0)
+    params = _random_chain(20, 2)
+    with ThreadPool(2) as pool:
+        results = parallel_info_E_step(*params, num_chunks=4, pool=pool)
+    for x, y in zip(results, parallel_info_E_step(*params)):
+        assert np.allclose(x, y)
+
+
+def test_parallel_info_sample():
+    np.random.seed(0)
+    T, n, N = 8, 2, 2000
+    params = _random_chain(T, n)
+    J, h, log_Z = _dense(*params)
+    Sigma = np.linalg.inv(J)
+
+    samples = np.empty((N, T * n))
+    for i in range(N):
+        lognorm, x = parallel_info_sample(*params, num_chunks=3)
+        samples[i] = x.ravel()
+    assert np.isclose(lognorm, log_Z + _info_lognorm(J, h))
+    assert np.allclose(samples.mean(0), Sigma.dot(h), atol=0.1)
+    assert np.allclose(np.cov(samples.T), Sigma, atol=0.1)
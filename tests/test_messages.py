@@ -0,0 +1,262 @@
+import itertools
+
+import numpy as np
+
+from rslds import messages
+
+
+def _random_hmm(T, K, shared=False):
+    """ random log transition matrices, initial distribution, and likelihoods """
+    shape = (K, K) if shared else (T - 1, K, K)
+    log_trans = np.log(np.random.dirichlet(np.ones(K), size=shape[:-1]))
+    log_pi_0 = np.log(np.random.dirichlet(np.ones(K)))
+    aBl = 3 * np.random.randn(T, K)
+    return log_trans, log_pi_0, aBl
+
+
+def _enumerate(log_trans, log_pi_0, aBl):
+    """
+    Brute force marginals over all K^T state sequences
+    :return: paths, their log joint probabilities with the data,
+             expected states, and expected transition counts
+    """
+    T, K = aBl.shape
+    if log_trans.ndim == 2:
+        log_trans = np.tile(log_trans, (T - 1, 1, 1))
+
+    paths = np.array(list(itertools.product(range(K), repeat=T)))
+    ts = np.arange(T - 1)
+    log_joints = log_pi_0[paths[:, 0]] + aBl[np.arange(T), paths].sum(1) \
+        + log_trans[ts, paths[:, :-1], paths[:, 1:]].sum(1)
+
+    probs = np.exp(log_joints - log_joints.max())
+    probs /= probs.sum()
+    expected_states = np.zeros((T, K))
+    expected_transcounts = np.zeros((K, K))
+    for path, p in zip(paths, probs):
+        expected_states[np.arange(T), path] += p
+        np.add.at(expected_transcounts, (path[:-1], path[1:]), p)
+    return paths, log_joints, expected_states, expected_transcounts
+
+
+def test_messages_vs_enumeration():
+    np.random.seed(0)
+    for shared in (False, True):
+        log_trans, log_pi_0, aBl = _random_hmm(5, 3, shared=shared)
+        _, log_joints, E_z, E_trans = _enumerate(log_trans, log_pi_0, aBl)
+        log_Z = np.logaddexp.reduce(log_joints)
+
+        alphal = messages.messages_forwards_log(log_trans, log_pi_0, aBl)
+        betal = messages.messages_backwards_log(log_trans, aBl)
+        assert np.isclose(np.logaddexp.reduce(alphal[-1]), log_Z)
+        assert np.allclose(np.logaddexp.reduce(log_pi_0 + aBl[0] + betal[0]), log_Z)
+
+        expected_states, expected_transcounts, normalizer = \
+            messages.expected_statistics_log(log_trans, aBl, alphal, betal)
+        assert np.isclose(normalizer, log_Z)
+        assert np.allclose(expected_states, E_z)
+        assert np.allclose(expected_transcounts, E_trans)
+
+        # The same statistics from the transition probabilities
+        expected_states, expected_transcounts, normalizer = \
+            messages.expected_statistics(np.exp(log_trans), aBl, alphal, betal)
+        assert np.isclose(normalizer, log_Z)
+        assert np.allclose(expected_states, E_z)
+        assert np.allclose(expected_transcounts, E_trans)
+
+
+def test_sample_forwards_log():
+    np.random.seed(0)
+    log_trans, log_pi_0, aBl = _random_hmm(3, 2)
+    aBl /= 3
+    paths, log_joints, _, _ = _enumerate(log_trans, log_pi_0, aBl)
+    probs = np.exp(log_joints - np.logaddexp.reduce(log_joints))
+
+    betal = messages.messages_backwards_log(log_trans, aBl)
+    N = 4000
+    counts = np.zeros(len(paths))
+    for _ in range(N):
+        z = messages.sample_forwards_log(betal, log_trans, log_pi_0, aBl)
+        counts[np.ravel_multi_index(z, (2,) * 3)] += 1
+    assert np.allclose(counts / N, probs, atol=0.03)
+
+
+def test_parallel_messages():
+    np.random.seed(0)
+    T, K = 40, 3
+    for shared in (False, True):
+        log_trans, log_pi_0, aBl = _random_hmm(T, K, shared=shared)
+        alphal = messages.messages_forwards_log(log_trans, log_pi_0, aBl)
+        betal = messages.messages_backwards_log(log_trans, aBl)
+
+        for num_chunks in (1, 3, 7, T):
+            products = messages.chunk_transfer_matrices(log_trans, aBl, num_chunks)
+            assert np.allclose(messages.parallel_messages_forwards_log(
+                log_trans, log_pi_0, aBl, num_chunks), alphal)
+            assert np.allclose(messages.parallel_messages_backwards_log(
+                log_trans, aBl, num_chunks, products=products), betal)
+
+
+def test_parallel_messages_pool():
+    from multiprocessing.pool import ThreadPool
+    np.random.seed(0)
+    log_trans, log_pi_0, aBl = _random_hmm(30, 3)
+    with ThreadPool(2) as pool:
+        alphal = messages.parallel_messages_forwards_log(
+            log_trans, log_pi_0, aBl, 4, pool=pool)
+        betal = messages.parallel_messages_backwards_log(log_trans, aBl, 4, pool=pool)
+    assert np.allclose(alphal, messages.messages_forwards_log(log_trans, log_pi_0, aBl))
+    assert np.allclose(betal, messages.messages_backwards_log(log_trans, aBl))
+
+
+def test_parallel_sample_forwards_log():
+    np.random.seed(0)
+    T, K, N = 6, 2, 3000
+    log_trans, log_pi_0, aBl = _random_hmm(T, K)
+    aBl /= 3
+    paths, log_joints, _, _ = _enumerate(log_trans, log_pi_0, aBl)
+    probs = np.exp(log_joints - np.logaddexp.reduce(log_joints))
+
+    betal = messages.messages_backwards_log(log_trans, aBl)
+    products = messages.chunk_transfer_matrices(log_trans, aBl, 2)
+    counts = np.zeros(len(paths))
+    for _ in range(N):
+        z = messages.parallel_sample_forwards_log(
+            betal, log_trans, log_pi_0, aBl, 2, products=products)
+        counts[np.ravel_multi_index(z, (K,) * T)] += 1
+    assert np.allclose(counts / N, probs, atol=0.03)
+
+
+def _joints(log_trans, log_pi_0, aBl):
+    """ (T-1 x K x K) joint probabilities of consecutive states """
+    alphal = messages.messages_forwards_log(log_trans, log_pi_0, aBl)
+    betal = messages.messages_backwards_log(log_trans, aBl)
+    log_joints = alphal[:-1, :, None] + (betal[1:] + aBl[1:])[:, None, :] + log_trans
+    joints = np.exp(log_joints - log_joints.max(axis=(1, 2), keepdims=True))
+    return joints / joints.sum(axis=(1, 2), keepdims=True)
+
+
+def test_expected_statistics_blocked():
+    np.random.seed(0)
+    T, K = 30, 3
+    for shared in (False, True):
+        log_trans, log_pi_0, aBl = _random_hmm(T, K, shared=shared)
+        alphal = messages.messages_forwards_log(log_trans, log_pi_0, aBl)
+        betal = messages.messages_backwards_log(log_trans, aBl)
+        E_z, E_trans, log_Z = messages.expected_statistics_log(log_trans, aBl, alphal, betal)
+        joints = _joints(log_trans, log_pi_0, aBl)
+
+        for block_size in (None, 1, 4, T):
+            for checkpoint in (False, True):
+                blocked_joints = np.zeros((T - 1, K, K))
+
+                def _store(start, stop, joints_block):
+                    blocked_joints[start:stop] = joints_block
+
+                expected_states, expected_transcounts, normalizer = \
+                    messages.expected_statistics_blocked(
+                        log_trans, log_pi_0, aBl, block_size=block_size,
+                        checkpoint=checkpoint, joints_callback=_store)
+                assert np.allclose(expected_states, E_z)
+                assert np.allclose(expected_transcounts, E_trans)
+                assert np.isclose(normalizer, log_Z)
+                assert np.allclose(blocked_joints, joints)
+
+
+def test_pruned_messages_full_beam():
+    # Without pruning the messages are exact
+    np.random.seed(0)
+    T, K = 20, 4
+    log_trans, log_pi_0, aBl = _random_hmm(T, K)
+    alphal = messages.messages_forwards_log(log_trans, log_pi_0, aBl)
+    betal = messages.messages_backwards_log(log_trans, aBl)
+    E_z, E_trans, log_Z = messages.expected_statistics_log(log_trans, aBl, alphal, betal)
+
+    for beam_size in (None, K):
+        pruned_alphal, discarded = messages.pruned_messages_forwards_log(
+            log_trans, log_pi_0, aBl, beam_size=beam_size)
+        pruned_betal = messages.pruned_messages_backwards_log(log_trans, aBl, pruned_alphal)
+        assert np.allclose(pruned_alphal, alphal)
+        assert np.allclose(pruned_betal, betal)
+        assert np.allclose(discarded, 0)
+
+        pruned_joints = np.zeros((T - 1, K, K))
+
+        def _store(start, stop, joints):
+            pruned_joints[start:stop] = joints
+
+        expected_states, expected_transcounts, normalizer = \
+            messages.pruned_expected_statistics_log(
+                log_trans, aBl, pruned_alphal, pruned_betal, joints_callback=_store)
+        assert np.allclose(expected_states, E_z)
+        assert np.allclose(expected_transcounts, E_trans)
+        assert np.isclose(normalizer, log_Z)
+        assert np.allclose(pruned_joints, _joints(log_trans, log_pi_0, aBl))
+
+
+def test_pruned_messages_beam():
+    np.random.seed(0)
+    T, K, B = 20, 6, 2
+    log_trans, log_pi_0, aBl = _random_hmm(T, K)
+    alphal, discarded = messages.pruned_messages_forwards_log(
+        log_trans, log_pi_0, aBl, beam_size=B)
+    betal = messages.pruned_messages_backwards_log(log_trans, aBl, alphal)
+    assert np.all(np.isfinite(alphal).sum(1) == B)
+    assert np.all(np.isfinite(betal) == np.isfinite(alphal))
+    assert np.all((discarded >= 0) & (discarded < 1))
+
+    expected_states, expected_transcounts, _ = \
+        messages.pruned_expected_statistics_log(log_trans, aBl, alphal, betal)
+    assert np.allclose(expected_states.sum(1), 1)
+    assert np.all(expected_states[~np.isfinite(alphal)] == 0)
+    assert np.isclose(expected_transcounts.sum(), T - 1)
+
+    # Sampled states stay in the beams
+    z = messages.pruned_sample_backwards_log(alphal, log_trans)
+    assert np.all(np.isfinite(alphal[np.arange(T), z]))
+
+    # A threshold keeps the states above it, and always the most likely one
+    alphal, discarded = messages.pruned_messages_forwards_log(
+        log_trans, log_pi_0, aBl, log_threshold=np.log(0.05))
+    assert np.all(np.isfinite(alphal).sum(1) >= 1)
+    logp = alphal - np.logaddexp.reduce(alphal, axis=1)[:, None]
+    assert np.all(logp[np.isfinite(alphal)] >= np.log(0.05))
+
+
+def test_pruned_sample_backwards_log():
+    np.random.seed(0)
+    T, K, N = 4, 2, 3000
+    log_trans, log_pi_0, aBl = _random_hmm(T, K)
+    aBl /= 3
+    paths, log_joints, _, _ = _enumerate(log_trans, log_pi_0, aBl)
+    probs = np.exp(log_joints - np.logaddexp.reduce(log_joints))
+
+    alphal, _ = messages.pruned_messages_forwards_log(log_trans, log_pi_0, aBl)
+    counts = np.zeros(len(paths))
+    for _ in range(N):
+        z = messages.pruned_sample_backwards_log(alphal, log_trans)
+        counts[np.ravel_multi_index(z, (K,) * T)] += 1
+    assert np.allclose(counts / N, probs, atol=0.03)
+
+
+def test_viterbi_vs_enumeration():
+    np.random.seed(0)
+    for shared in (False, True):
+        for _ in range(5):
+            log_trans, log_pi_0, aBl = _random_hmm(6, 3, shared=shared)
+            paths, log_joints, _, _ = _enumerate(log_trans, log_pi_0, aBl)
+            stateseq, score = messages.viterbi_log(log_trans, log_pi_0, aBl)
+            assert np.array_equal(stateseq, paths[log_joints.argmax()])
+            assert np.isclose(score, log_joints.max())
+
+
+def test_batch_viterbi_log():
+    from multiprocessing.pool import ThreadPool
+    np.random.seed(0)
+    problems = [_random_hmm(T, 3) for T in (1, 5, 12)]
+    with ThreadPool(2) as pool:
+        stateseqs, scores = messages.batch_viterbi_log(problems, pool=pool)
+    for problem, stateseq, score in zip(problems, stateseqs, scores):
+        expected_stateseq, expected_score = messages.viterbi_log(*problem)
+        assert np.array_equal(stateseq, expected_stateseq)
+        assert np.isclose(score, expected_score)
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+T = 50
+
+
+def _check_states(s):
+    K, D = s.num_states, s.D_latent
+    assert s.stateseq.shape == (s.T,)
+    assert np.all((s.stateseq >= 0) & (s.stateseq < K))
+    assert s.gaussian_states.shape == (s.T, D)
+    assert np.all(np.isfinite(s.gaussian_states))
+
+
+def test_window_bounds(pg_model):
+    s = pg_model.states_list[0]
+    for window_size, offset in ((7, 0), (7, 3), (T, 0)):
+        windows = s.window_bounds(window_size, offset)
+        assert windows[0][0] == 0 and windows[-1][1] == s.T
+        assert all(stop == start for (_, stop), (start, _) in zip(windows[:-1], windows[1:]))
+        assert all(stop - start <= window_size for start, stop in windows)
+
+
+@pytest.mark.parametrize("order", ["cycle", "random"])
+def test_windowed_gibbs(make_pg_model, order):
+    model = make_pg_model(window_size=7, window_order=order)
+    model.generate(T=T, inputs=np.ones((T, 1)))
+    for _ in range(3):
+        model.resample_model()
+        _check_states(model.states_list[0])
+    assert np.isfinite(model.log_likelihood())
+
+    with pytest.raises(ValueError):
+        model.states_list[0].resample_windowed(7, order="backward")
+
+
+def test_smooth_window(pg_model):
+    s = pg_model.states_list[0]
+    expected_states, mus = s.smooth_window(10, 20)
+    assert expected_states.shape == (10, s.num_states)
+    assert np.allclose(expected_states.sum(1), 1)
+    assert mus.shape == (10, s.D_latent)
+    assert np.all(np.isfinite(mus))
+
+
+@pytest.mark.parametrize("estep_kwargs", [
+    dict(estep_block_size=4), dict(estep_checkpoint=True), dict(store_expected_joints=False)])
+def test_low_memory_estep(softmax_model, estep_kwargs):
+    s = softmax_model.states_list[0]
+    softmax_model.add_data(s.data, inputs=s.inputs, **estep_kwargs)
+    s_lm = softmax_model.states_list[-1]
+    s_lm.stateseq, s_lm.gaussian_states = s.stateseq.copy(), s.gaussian_states.copy()
+    assert s.store_expected_joints and not s_lm.store_expected_joints
+
+    softmax_model._init_mf_from_gibbs()
+    for states in (s, s_lm):
+        states.vb_E_step()
+    assert np.allclose(s_lm.expected_states, s.expected_states)
+    assert np.allclose(s_lm.expected_transcounts, s.expected_transcounts)
+    for x, y in zip(s_lm.E_trans_stats, s.E_trans_stats):
+        assert np.allclose(x, y)
+
+    # The joints aren't stored, but they can still be recomputed
+    assert s_lm._expected_joints is None
+    assert np.allclose(s_lm.expected_joints, s.expected_joints)
+
+
+def test_svi(softmax_model):
+    softmax_model._init_mf_from_gibbs()
+    stepsizes = softmax_model.svi(num_iters=3, minibatch_size=2)
+    assert len(stepsizes) == 3
+    assert all(0 < stepsize <= 1 for stepsize in stepsizes)
+
+    for d in softmax_model.init_dynamics_distns:
+        assert np.all(np.isfinite(d.mu_mf))
+        assert np.all(np.linalg.eigvalsh(d.sigma_mf) > 0)
+    for s in softmax_model.states_list:
+        assert np.allclose(s.expected_states.sum(1), 1)
+        assert np.all(np.isfinite(s.smoothed_mus))
+
+    # With a full minibatch and a step size of one, the initial state
+    # distributions get the mean field update from the local factors
+    softmax_model.svi(num_iters=1, minibatch_size=3, stepsize_schedule=lambda itr: 1.0)
+    for k, d in enumerate(softmax_model.init_dynamics_distns):
+        E_stats = [[s.expected_states[0, k] * stat for stat in s.E_init_stats]
+                   for s in softmax_model.states_list]
+        stats = d._stats_ensure_array([sum(x) for x in zip(*E_stats)])
+        assert np.allclose(d.mf_natural_hypparam, d.natural_hypparam + stats)
@@ -0,0 +1,130 @@
+import numpy as np
+
+from rslds import messages
+from rslds.transitions import InputHMMTransitions, InputOnlyHMMTransitions, \
+    StickyInputOnlyHMMTransitions, _batch_solve, _batch_info_to_moments
+
+
+def _random_transitions(cls, K, D, random_markov=False, **kwargs):
+    """ transitions with random weights on the covariates and random biases """
+    trans = cls(K, D, **kwargs)
+    trans.A[:, K:] = np.random.randn(K - 1, D)
+    if random_markov:
+        trans.A[:, :K] = np.random.randn(K - 1, K)
+    trans.b = np.random.randn(*trans.b.shape)
+    return trans
+
+
+def test_log_trans_matrices():
+    np.random.seed(0)
+    trans = _random_transitions(InputHMMTransitions, 4, 2, random_markov=True)
+    X = 3 * np.random.randn(20, 2)
+    log_P = trans.get_log_trans_matrices(X)
+    P = trans.get_trans_matrices(X)
+    assert log_P.shape == P.shape == (20, 4, 4)
+    assert np.allclose(P.sum(2), 1)
+    assert np.allclose(np.exp(log_P), P)
+
+
+def _dense(op):
+    return np.concatenate([Al for _, _, Al in op.blocks()])
+
+
+def _check_messages(op, log_trans, K):
+    """ the message passing on op matches that on the dense stack """
+    T = len(log_trans) + 1
+    log_pi_0 = np.log(np.random.dirichlet(np.ones(K)))
+    aBl = 3 * np.random.randn(T, K)
+
+    alphal = messages.messages_forwards_log(log_trans, log_pi_0, aBl)
+    betal = messages.messages_backwards_log(log_trans, aBl)
+    assert np.allclose(messages.messages_forwards_log(op, log_pi_0, aBl), alphal)
+    assert np.allclose(messages.messages_backwards_log(op, aBl), betal)
+    for x, y in zip(messages.expected_statistics_log(op, aBl, alphal, betal),
+                    messages.expected_statistics_log(log_trans, aBl, alphal, betal)):
+        assert np.allclose(x, y)
+
+    stateseq, score = messages.viterbi_log(op, log_pi_0, aBl)
+    expected_stateseq, expected_score = messages.viterbi_log(log_trans, log_pi_0, aBl)
+    assert np.array_equal(stateseq, expected_stateseq)
+    assert np.isclose(score, expected_score)
+
+
+def test_stick_breaking_operator():
+    np.random.seed(0)
+    K, T = 4, 50
+    trans = _random_transitions(InputHMMTransitions, K, 2, random_markov=True)
+    X = np.random.randn(T - 1, 2)
+    op = trans.get_trans_operator(X, block_size=7)
+    log_trans = trans.get_log_trans_matrices(X)
+
+    assert op.shape == log_trans.shape
+    assert np.allclose(_dense(op), log_trans)
+    assert np.allclose(op.log_row(10, 2), log_trans[10, 2])
+    assert np.allclose(_dense(op.view(5, 20, block_size=4)), log_trans[5:20])
+    _check_messages(op, log_trans, K)
+
+
+def test_row_invariant_operator():
+    np.random.seed(0)
+    K, T = 4, 50
+    trans = _random_transitions(InputOnlyHMMTransitions, K, 2)
+    X = np.random.randn(T - 1, 2)
+    op = trans.get_trans_operator(X, block_size=7)
+    log_trans = trans.get_log_trans_matrices(X)
+
+    assert op.row_invariant
+    assert np.allclose(_dense(op), log_trans)
+    assert np.allclose(op.log_rows, log_trans[:, 0])
+    _check_messages(op, log_trans, K)
+
+
+def test_shared_plus_diagonal_operator():
+    np.random.seed(0)
+    K, T = 4, 50
+    trans = _random_transitions(StickyInputOnlyHMMTransitions, K, 2, kappa=3.0)
+
+    # Large activations make the suffix sums of the messages ill conditioned
+    for scale in (1., 60.):
+        X = scale * np.random.randn(T - 1, 2)
+        op = trans.get_trans_operator(X, block_size=7)
+        log_trans = trans.get_log_trans_matrices(X)
+
+        assert op.shared_plus_diagonal
+        assert np.allclose(_dense(op), log_trans)
+        assert np.allclose(op.log_row(3, 1), log_trans[3, 1])
+        _check_messages(op, log_trans, K)
+
+
+def test_shared_plus_diagonal_sampling():
+    np.random.seed(0)
+    K, T, N = 3, 6, 2000
+    trans = _random_transitions(StickyInputOnlyHMMTransitions, K, 2, kappa=2.0)
+    op = trans.get_trans_operator(np.random.randn(T - 1, 2))
+    log_pi_0 = np.log(np.ones(K) / K)
+    aBl = np.random.randn(T, K)
+
+    alphal = messages.messages_forwards_log(op, log_pi_0, aBl)
+    betal = messages.messages_backwards_log(op, aBl)
+    expected_states, _, _ = messages.expected_statistics_log(op, aBl, alphal, betal)
+
+    counts = np.zeros((T, K))
+    for _ in range(N):
+        z = messages.sample_forwards_log(betal, op, log_pi_0, aBl)
+        counts[np.arange(T), z] += 1
+    assert np.allclose(counts / N, expected_states, atol=0.05)
+
+
+def test_batch_solve():
+    np.random.seed(0)
+    X = np.random.randn(5, 4, 6)
+    J = np.matmul(X, np.swapaxes(X, 1, 2)) + 0.1 * np.eye(4)
+    h = np.random.randn(5, 4)
+
+    mu = np.array([np.linalg.solve(Jk, hk) for Jk, hk in zip(J, h)])
+    assert np.allclose(_batch_solve(J, h), mu)
+
+    Sigma, mu_info, E_xxT = _batch_info_to_moments(J, h)
+    assert np.allclose(Sigma, np.linalg.inv(J))
+    assert np.allclose(mu_info, mu)
+    assert np.allclose(E_xxT, Sigma + mu[:, :, None] * mu[:, None, :])
@@ -0,0 +1,43 @@
+import numpy as np
+
+from rslds.util import psi_to_pi, psi_to_log_pi, logistic
+
+
+def _psi_to_pi_loop(psi):
+    """ reference stick breaking, one stick at a time """
+    K = psi.size + 1
+    pi = np.zeros(K)
+    stick = 1.0
+    for k in range(K - 1):
+        pi[k] = logistic(psi[k]) * stick
+        stick -= pi[k]
+    pi[-1] = stick
+    return pi
+
+
+def test_psi_to_pi():
+    np.random.seed(0)
+    psi = np.random.randn(10, 4)
+    expected = np.array([_psi_to_pi_loop(p) for p in psi])
+    assert np.allclose(psi_to_pi(psi), expected)
+    assert np.allclose(psi_to_pi(psi, log=True), np.log(expected))
+    assert np.allclose(psi_to_pi(psi[0]), expected[0])
+
+
+def test_psi_to_pi_axis():
+    np.random.seed(0)
+    psi = np.random.randn(5, 3, 4)
+    expected = np.array([[_psi_to_pi_loop(p) for p in P] for P in psi.transpose((0, 2, 1))])
+    assert np.allclose(psi_to_pi(psi, axis=1), expected.transpose((0, 2, 1)))
+    assert np.allclose(psi_to_log_pi(psi, axis=1), np.log(expected.transpose((0, 2, 1))))
+
+
+def test_psi_to_pi_extreme():
+    # Large activations must not overflow or lose the small probabilities
+    psi = np.array([[800., -800., 30.], [-40., -40., -40.]])
+    log_pi = psi_to_pi(psi, log=True)
+    pi = psi_to_pi(psi)
+    assert np.all(np.isfinite(log_pi))
+    assert np.allclose(pi.sum(1), 1)
+    assert np.allclose(np.exp(log_pi), pi)
+    assert np.allclose(log_pi[1], np.log(_psi_to_pi_loop(psi[1])))